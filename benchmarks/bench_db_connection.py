@@ -0,0 +1,65 @@
+"""Measure the per-request overhead of getting a Mongo database handle.
+
+Compare the former behaviour (a new `PyMongo(current_app)` in every request
+context) with the app-lifetime client of `MongoConnection`. Each simulated
+request runs one `find_one` on the `users` collection.
+
+Usage:
+
+    $ MONGO_URI=mongodb://localhost:27017/hpcdb python benchmarks/bench_db_connection.py
+"""
+import os
+import statistics
+import sys
+import time
+
+from flask import Flask
+from flask_pymongo import PyMongo
+
+from hpc_gateway.model.database import MongoConnection, get_db
+
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/hpcdb")
+N_REQUESTS = int(os.environ.get("N_REQUESTS", 200))
+
+
+def per_request_pymongo(app):
+    with app.test_request_context():
+        mongo = PyMongo(app)
+        mongo.db.users.find_one({"email": "bench@example.com"})
+        mongo.cx.close()
+
+
+def app_lifetime_client(app):
+    with app.test_request_context():
+        get_db().users.find_one({"email": "bench@example.com"})
+
+
+def measure(func, app):
+    timings = []
+    for _ in range(N_REQUESTS):
+        start = time.perf_counter()
+        func(app)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return timings
+
+
+def main():
+    app = Flask(__name__)
+    app.config["MONGO_URI"] = MONGO_URI
+    MongoConnection(app)
+
+    for name, func in [
+        ("PyMongo per request", per_request_pymongo),
+        ("app-lifetime MongoClient", app_lifetime_client),
+    ]:
+        timings = measure(func, app)
+        print(
+            f"{name:<26} mean {statistics.mean(timings):8.2f} ms  "
+            f"median {statistics.median(timings):8.2f} ms  "
+            f"max {max(timings):8.2f} ms  (n={N_REQUESTS})"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
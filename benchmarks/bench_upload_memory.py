@@ -0,0 +1,107 @@
+"""Measure the memory cost of uploading a file through `Firecrest.simple_upload`.
+
+A local fake firecrest server accepts `POST /utilities/upload` and discards
+the body. Large synthetic files are uploaded from a werkzeug `FileStorage`
+(as the file API receives them) either the former way, reading the whole
+file and letting requests build the multipart body, or streamed with
+`MultipartStream`. The peak of Python allocations is reported.
+
+Usage:
+
+    $ SIZES_MB=50,200 python benchmarks/bench_upload_memory.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from werkzeug.datastructures import FileStorage
+
+from hpc_gateway.model.f7t import Firecrest, HardCodeTokenAuth
+
+SIZES_MB = [int(s) for s in os.environ.get("SIZES_MB", "50,200").split(",")]
+
+
+class FakeFirecrestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1 << 20)))
+
+        body = b"{}"
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def buffered_upload(url, file_storage):
+    """What the file API did before: read the file and hand over the bytes."""
+    content = file_storage.read()
+    resp = requests.post(
+        f"{url}/utilities/upload",
+        headers={"Authorization": "Bearer token", "X-Machine-Name": "fake"},
+        data={"targetPath": "/tmp"},
+        files={"file": (file_storage.filename, content)},
+    )
+    assert resp.status_code == 201
+
+
+def streamed_upload(url, file_storage):
+    client = Firecrest(firecrest_url=url, authorization=HardCodeTokenAuth("token"))
+    client.simple_upload(
+        machine="fake",
+        source_path=file_storage.stream,
+        target_path="/tmp",
+        filename=file_storage.filename,
+    )
+
+
+def measure(func, url, path):
+    with open(path, "rb") as fh:
+        file_storage = FileStorage(stream=fh, filename=os.path.basename(path))
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(url, file_storage)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return peak / 2**20, elapsed
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeFirecrestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    for size_mb in SIZES_MB:
+        with tempfile.NamedTemporaryFile(suffix=".in") as tmp:
+            chunk = os.urandom(1 << 20)
+            for _ in range(size_mb):
+                tmp.write(chunk)
+            tmp.flush()
+
+            for name, func in [
+                ("buffered", buffered_upload),
+                ("streamed", streamed_upload),
+            ]:
+                peak_mb, elapsed = measure(func, url, tmp.name)
+                print(
+                    f"{size_mb:>6} MB  {name:<9} peak {peak_mb:9.1f} MB  "
+                    f"time {elapsed:6.2f} s"
+                )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,18 +3,53 @@ destroyed from job API instead of here.
 These apis allow user to upload/download the files for calculation.
 """
 import io
+import mimetypes
 import os
+import shutil
+import tempfile
+from collections import deque
+from datetime import datetime
+from fnmatch import fnmatch
 
-from flask import Blueprint, current_app, jsonify, request, send_file
+from firecrest.FirecrestException import (
+    StorageDownloadException,
+    StorageUploadException,
+)
+from flask import Blueprint, Response, current_app, jsonify, request, send_file
 
+from hpc_gateway.api.utils import (
+    error_response,
+    idempotent,
+    stream_size,
+    upload_file_name,
+)
 from hpc_gateway.auth import token_required
-from hpc_gateway.model.database import get_job
-from hpc_gateway.model.f7t import create_f7t_client
+from hpc_gateway.model.archive import tar_stream, zip_stream
+from hpc_gateway.model.database import create_transfer, get_job, get_transfer
+from hpc_gateway.model.f7t import (
+    create_f7t_client,
+    get_max_file_size,
+    get_transfer_task,
+    get_upload_executor,
+    invalidate_job_files,
+    list_job_files,
+    start_external_download,
+    start_external_upload,
+)
+from hpc_gateway.model.file_cache import get_file_cache
+from hpc_gateway.model.resilience import RejectedError
 
 # For the direct DB data manipulate, basically the
 # capabilies of DataSink and DataSource.
 file_api_v1 = Blueprint("file_api_v1", "file_api_v1", url_prefix="/api/v1/file")
 
+# format: (mimetype, file extension)
+ARCHIVE_FORMATS = {
+    "zip": ("application/zip", ".zip"),
+    "tar": ("application/x-tar", ".tar"),
+    "tar.gz": ("application/gzip", ".tar.gz"),
+}
+
 
 @file_api_v1.route("/", methods=["GET"])
 @token_required
@@ -42,6 +77,47 @@ def api_fetch_file_from_repo(current_user, jobid):
         )
 
     remote_file_path = os.path.join(remote_folder, filename)
+    streaming = current_app.config["FILE_STREAM_DOWNLOAD"] or request.range is not None
+    file_cache = get_file_cache()
+
+    if current_app.config["FILE_STAGED_TRANSFER"] or streaming or file_cache:
+        try:
+            f7t_client = create_f7t_client()
+            stat = f7t_client.stat(machine=machine, target_path=remote_file_path)
+
+            if current_app.config["FILE_STAGED_TRANSFER"] and int(
+                stat["size"]
+            ) > get_max_file_size(f7t_client):
+                # too large for simple download, stage through object storage
+                task_id = start_external_download(f7t_client, machine, remote_file_path)
+                create_transfer(
+                    task_id, current_user.get("email"), jobid, "download", filename
+                )
+                return (
+                    jsonify(
+                        message="File download staged.",
+                        task_id=task_id,
+                    ),
+                    202,
+                )
+
+            if file_cache is not None:
+                return send_cached_file(
+                    file_cache, f7t_client, machine, jobid, remote_file_path, stat
+                )
+
+            if streaming:
+                return stream_remote_file(
+                    f7t_client, machine, remote_file_path, filename, stat=stat
+                )
+        except Exception as e:
+            return error_response(
+                e,
+                500,
+                error="unable to download file.",
+                debug=f"filename: {filename}",
+            )
+
     binary_stream = io.BytesIO()
 
     try:
@@ -55,16 +131,261 @@ def api_fetch_file_from_repo(current_user, jobid):
         binary_stream.seek(0)  # buffer position from start
         response = send_file(path_or_file=binary_stream, download_name=filename)
     except Exception as e:
+        return error_response(
+            e,
+            500,
+            error="unable to download file.",
+            debug=f"filename: {filename}",
+        )
+    else:
+        return (response, 200)
+
+
+def send_cached_file(file_cache, f7t_client, machine, jobid, remote_file_path, stat):
+    """Serve a remote file from the local download cache, fetch it into the
+    cache first if this version (size, mtime) of the file is not there."""
+    filename = os.path.basename(remote_file_path)
+    if int(stat["size"]) > file_cache.max_bytes:
+        # would evict the whole cache and itself
+        return stream_remote_file(
+            f7t_client, machine, remote_file_path, filename, stat=stat
+        )
+
+    key = file_cache.key(jobid, remote_file_path, stat["size"], stat["mtime"])
+    cached_file = file_cache.get(key)
+    if cached_file is None:
+        upstream = f7t_client.stream_download(
+            machine=machine, source_path=remote_file_path
+        )
+        try:
+            cached_file = file_cache.put(
+                key,
+                upstream.iter_content(
+                    chunk_size=current_app.config["FILE_DOWNLOAD_CHUNK_SIZE"]
+                ),
+            )
+        finally:
+            upstream.close()
+
+    # served from the open file, the entry may be evicted meanwhile
+    size = os.fstat(cached_file.fileno()).st_size
+    response = send_file(
+        cached_file,
+        download_name=filename,
+        conditional=False,
+        etag=remote_etag(stat),
+        last_modified=int(stat["mtime"]),
+    )
+    response.content_length = size
+    try:
+        return response.make_conditional(
+            request.environ, accept_ranges=True, complete_length=size
+        )
+    except Exception:
+        cached_file.close()
+        raise
+
+
+def remote_etag(stat):
+    """Strong validator of a remote file from its `stat`: size and mtime."""
+    return f"{int(stat['size']):x}-{int(stat['mtime']):x}"
+
+
+def stream_remote_file(f7t_client, machine, remote_file_path, filename, stat=None):
+    """Pipe a remote file to the client chunk by chunk.
+
+    Honour `Range` (single range) and `If-Range`, answer conditional
+    requests with 304 and set `Content-Length`/`ETag` from the remote stat.
+    """
+    if stat is None:
+        stat = f7t_client.stat(machine=machine, target_path=remote_file_path)
+    size = int(stat["size"])
+    etag = remote_etag(stat)
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    byte_range = None
+    if request.range is not None and len(request.range.ranges) == 1:
+        if_range = request.if_range
+        if (if_range.etag is None and if_range.date is None) or if_range.etag == etag:
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                return Response(
+                    status=416, headers={"Content-Range": f"bytes */{size}"}
+                )
+
+    upstream = f7t_client.stream_download(
+        machine=machine, source_path=remote_file_path, byte_range=byte_range
+    )
+    start, stop = byte_range or (0, size)
+    # firecrest may ignore the range and send the whole file
+    skip = start if upstream.status_code == 200 else 0
+    chunk_size = current_app.config["FILE_DOWNLOAD_CHUNK_SIZE"]
+
+    def generate():
+        remaining = stop - start
+        to_skip = skip
+        try:
+            for chunk in upstream.iter_content(chunk_size=chunk_size):
+                if to_skip:
+                    dropped = min(to_skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    to_skip -= dropped
+                if not chunk:
+                    continue
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+                yield chunk
+                if remaining <= 0:
+                    break
+        finally:
+            upstream.close()
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = Response(generate(), mimetype=mimetype, direct_passthrough=True)
+    # the body may never be iterated (HEAD, client gone before the first chunk)
+    response.call_on_close(upstream.close)
+    response.headers.set("Content-Disposition", "inline", filename=filename)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["ETag"] = f'"{etag}"'
+    response.content_length = stop - start
+    if byte_range is not None:
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+    return response
+
+
+@file_api_v1.route("/archive/<jobid>", methods=["GET"])
+@token_required
+def api_fetch_archive_from_repo(current_user, jobid):
+    """fetch (download) the files of a job folder as one archive.
+
+    The archive (`format`: zip, tar or tar.gz) is streamed while the files
+    are fetched, a few of them ahead concurrently. Optional `include` glob
+    patterns (repeatable) select the files, e.g. `?include=*.out&include=*.log`.
+    Files above the small-file limit are left out and named in the
+    `X-Skipped-Files` header, fetch them by the download API.
+    """
+    machine = current_app.config["MACHINE"]
+
+    job = get_job(job_id=jobid)
+    remote_folder = job.get("remote_folder")
+
+    archive_format = request.args.get("format", "zip")
+    if archive_format not in ARCHIVE_FORMATS:
         return (
             jsonify(
-                error="unable to download file.",
-                except_type=str(type(e)),
-                debug=f"filename: {filename}",
+                error=f"Unsupported archive format {archive_format}, "
+                f"use one of {', '.join(ARCHIVE_FORMATS)}.",
             ),
             500,
         )
+    patterns = request.args.getlist("include") or ["*"]
+
+    try:
+        f7t_client = create_f7t_client()
+        listing = list_job_files(f7t_client, machine, remote_folder)
+        if current_app.config["FILE_STAGED_TRANSFER"]:
+            max_file_size = get_max_file_size(f7t_client)
+        else:
+            max_file_size = None
+    except Exception as e:
+        return error_response(
+            e,
+            500,
+            error="unable to list files to job folder.",
+        )
+
+    files, skipped = [], []
+    for f in listing:
+        if f["type"] == "d" or not any(fnmatch(f["name"], p) for p in patterns):
+            continue
+        size = int(f["size"])
+        if max_file_size is not None and size > max_file_size:
+            skipped.append(f["name"])
+            continue
+        mtime = datetime.fromisoformat(f["last_modified"]).timestamp()
+        files.append((f["name"], size, mtime))
+
+    # every download holds a transfer slot until streamed, the request
+    # leaves one slot free of its own downloads for the streamed file
+    prefetch = current_app.config["ARCHIVE_PREFETCH"]
+    transfer_limit = current_app.config["F7T_BULKHEAD_LIMITS"].get("transfer")
+    if transfer_limit:
+        prefetch = max(min(prefetch, transfer_limit - 1), 0)
+
+    entries = _archive_entries(
+        f7t_client,
+        machine,
+        remote_folder,
+        files,
+        executor=get_upload_executor(),
+        prefetch=prefetch,
+        chunk_size=current_app.config["FILE_DOWNLOAD_CHUNK_SIZE"],
+    )
+    if archive_format == "zip":
+        body = zip_stream(entries)
     else:
-        return (response, 200)
+        body = tar_stream(entries, gzip=archive_format == "tar.gz")
+
+    mimetype, extension = ARCHIVE_FORMATS[archive_format]
+    response = Response(body, mimetype=mimetype)
+    response.headers.set(
+        "Content-Disposition", "attachment", filename=f"{jobid}{extension}"
+    )
+    if skipped:
+        response.headers["X-Skipped-Files"] = ",".join(skipped)
+
+    return response
+
+
+def _archive_entries(
+    f7t_client, machine, remote_folder, files, executor, prefetch, chunk_size
+):
+    """Archive entries of remote files, the downloads of the next `prefetch`
+    files are started while the current one is streamed: at most
+    `prefetch` + 1 downloads are open at a time."""
+    pending = deque()
+    remaining = iter(files)
+
+    def start_next():
+        f = next(remaining, None)
+        if f is not None:
+            future = executor.submit(
+                f7t_client.stream_download,
+                machine=machine,
+                source_path=os.path.join(remote_folder, f[0]),
+            )
+            pending.append((f, future))
+
+    for _ in range(prefetch + 1):
+        start_next()
+
+    try:
+        while pending:
+            (name, size, mtime), future = pending.popleft()
+            try:
+                upstream = future.result()
+            except RejectedError:
+                # no transfer slot while started ahead, the previous file
+                # released its own
+                upstream = f7t_client.stream_download(
+                    machine=machine, source_path=os.path.join(remote_folder, name)
+                )
+            try:
+                yield name, size, mtime, upstream.iter_content(chunk_size=chunk_size)
+            finally:
+                upstream.close()
+            start_next()
+    finally:
+        # client went away, release the connections opened ahead
+        for _, future in pending:
+            if not future.cancel():
+                future.add_done_callback(
+                    lambda done: done.exception() or done.result().close()
+                )
 
 
 @file_api_v1.route("/list/<jobid>", methods=["GET"])
@@ -80,14 +401,12 @@ def api_list_repo(current_user, jobid):
 
     try:
         f7t_client = create_f7t_client()
-        response = f7t_client.list_files(machine=machine, target_path=remote_folder)
+        response = list_job_files(f7t_client, machine, remote_folder)
     except Exception as e:
-        return (
-            jsonify(
-                error="unable to list files to job folder.",
-                except_type=str(type(e)),
-            ),
+        return error_response(
+            e,
             500,
+            error="unable to list files to job folder.",
         )
     else:
         return (
@@ -101,6 +420,7 @@ def api_list_repo(current_user, jobid):
 
 @file_api_v1.route("/upload/<jobid>", methods=["PUT"])
 @token_required
+@idempotent
 def api_push_file_to_repo(current_user, jobid):
     """push (upload) file to job repository."""
     machine = current_app.config["MACHINE"]
@@ -108,37 +428,231 @@ def api_push_file_to_repo(current_user, jobid):
     job = get_job(job_id=jobid)
     remote_folder = job.get("remote_folder")
 
+    uploaded_files = request.files.getlist("file")
+    if len(uploaded_files) > 1:
+        return _upload_files(current_user, jobid, remote_folder, uploaded_files)
+
     uploaded_file = request.files["file"]
 
     filename = request.args.get("filename", None)
-    if filename:
-        upload_filename = filename
-    else:
-        upload_filename = uploaded_file.filename
+    try:
+        upload_filename = upload_file_name(filename or uploaded_file.filename)
+    except ValueError as e:
+        return error_response(e, 400, error=str(e))
 
     try:
         f7t_client = create_f7t_client()
+        if current_app.config["FILE_STAGED_TRANSFER"] and stream_size(
+            uploaded_file.stream
+        ) > get_max_file_size(f7t_client):
+            # too large for simple upload, stage through object storage
+            task_id = _stage_upload(
+                f7t_client, machine, remote_folder, uploaded_file, upload_filename
+            )
+            create_transfer(
+                task_id, current_user.get("email"), jobid, "upload", upload_filename
+            )
+            return (
+                jsonify(
+                    message="File upload staged.",
+                    task_id=task_id,
+                ),
+                202,
+            )
+
         f7t_client.simple_upload(
             machine=machine,
-            source_path=uploaded_file.read(),
+            source_path=uploaded_file.stream,
             target_path=remote_folder,
             filename=upload_filename,
         )
+        invalidate_job_files(machine, remote_folder)
     except Exception as e:
+        return error_response(
+            e,
+            500,
+            error="unable to upload file to job folder.",
+        )
+    else:
         return (
             jsonify(
-                error="unable to upload file to job folder.",
-                except_type=str(type(e)),
+                message="File uploaded.",
             ),
+            200,
+        )
+
+
+@file_api_v1.route("/batch/<jobid>", methods=["PUT"])
+@token_required
+@idempotent
+def api_push_files_to_repo(current_user, jobid):
+    """push (upload) several files (all as `file` fields of one multipart
+    request) to job repository. They are uploaded concurrently and the
+    status of every file is returned.
+    """
+    job = get_job(job_id=jobid)
+    remote_folder = job.get("remote_folder")
+
+    uploaded_files = request.files.getlist("file")
+    if not uploaded_files:
+        return (
+            jsonify(
+                error="Please provide the files to upload.",
+            ),
+            500,
+        )
+
+    return _upload_files(current_user, jobid, remote_folder, uploaded_files)
+
+
+def _upload_files(current_user, jobid, remote_folder, uploaded_files):
+    machine = current_app.config["MACHINE"]
+
+    try:
+        f7t_client = create_f7t_client()
+        if current_app.config["FILE_STAGED_TRANSFER"]:
+            max_file_size = get_max_file_size(f7t_client)
+        else:
+            max_file_size = None
+    except Exception as e:
+        return error_response(
+            e,
             500,
+            error="unable to upload files to job folder.",
         )
+
+    results = []
+    futures = []
+    executor = get_upload_executor()
+    for uploaded_file in uploaded_files:
+        result = {"filename": uploaded_file.filename}
+        results.append(result)
+        try:
+            filename = upload_file_name(uploaded_file.filename)
+        except ValueError as e:
+            result.update(status="failed", except_type=str(type(e)))
+            continue
+
+        if max_file_size is not None and (
+            stream_size(uploaded_file.stream) > max_file_size
+        ):
+            # staging only saves the file locally, the transfer runs in background
+            try:
+                task_id = _stage_upload(
+                    f7t_client, machine, remote_folder, uploaded_file, filename
+                )
+                create_transfer(
+                    task_id, current_user.get("email"), jobid, "upload", filename
+                )
+            except Exception as e:
+                result.update(status="failed", except_type=str(type(e)))
+            else:
+                result.update(status="staged", task_id=task_id)
+            continue
+
+        future = executor.submit(
+            f7t_client.simple_upload,
+            machine=machine,
+            source_path=uploaded_file.stream,
+            target_path=remote_folder,
+            filename=filename,
+        )
+        futures.append((result, future))
+
+    for result, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            result.update(status="failed", except_type=str(type(e)))
+        else:
+            result.update(status="uploaded")
+
+    invalidate_job_files(machine, remote_folder)
+
+    failed = sum(result["status"] == "failed" for result in results)
+    if failed == 0:
+        status_code, message = 200, "Files uploaded."
+    elif failed < len(results):
+        status_code, message = 207, "Some files failed to upload."
     else:
+        status_code, message = 500, "unable to upload files to job folder."
+
+    return (
+        jsonify(
+            message=message,
+            files=results,
+        ),
+        status_code,
+    )
+
+
+def _stage_upload(f7t_client, machine, remote_folder, uploaded_file, filename):
+    """Save an uploaded file locally and start its staged upload, the file
+    takes its remote name `filename` from the name of the staged file."""
+    staging_folder = tempfile.mkdtemp(dir=current_app.config["FILE_STAGING_DIR"])
+    try:
+        local_path = os.path.join(staging_folder, upload_file_name(filename))
+        uploaded_file.save(local_path)
+
+        return start_external_upload(f7t_client, machine, local_path, remote_folder)
+    except BaseException:
+        # removed by the upload once started
+        shutil.rmtree(staging_folder, ignore_errors=True)
+        raise
+
+
+@file_api_v1.route("/transfer/<taskid>", methods=["GET"])
+@token_required
+def api_get_transfer(current_user, taskid):
+    """progress of a staged (large file) upload or download.
+    Once a download is staged the response contains the `url` from where
+    the file can be fetched directly.
+    """
+    transfer = get_transfer(taskid)
+    if transfer is None or transfer.get("email") != current_user.get("email"):
         return (
             jsonify(
-                message="File uploaded.",
+                error=f"Transfer {taskid} not found.",
+            ),
+            404,
+        )
+
+    output = {
+        "task_id": taskid,
+        "jobid": transfer["job_id"],
+        "direction": transfer["direction"],
+        "filename": transfer["filename"],
+    }
+
+    try:
+        f7t_client = create_f7t_client()
+        task = get_transfer_task(f7t_client, taskid)
+    except (StorageUploadException, StorageDownloadException):
+        return (
+            jsonify(
+                status="failed",
+                done=True,
+                **output,
             ),
             200,
         )
+    except Exception as e:
+        return error_response(
+            e,
+            500,
+            error="unable to get the transfer state.",
+        )
+
+    status = str(task.get("status"))
+    output.update(
+        status=status,
+        description=task.get("description"),
+        done=status in ("114", "117"),
+    )
+    if transfer["direction"] == "download" and status == "117":
+        output["url"] = task.get("data")
+
+    return (jsonify(**output), 200)
 
 
 @file_api_v1.route("/delete/<jobid>", methods=["DELETE"])
@@ -167,13 +681,12 @@ def api_delete_file_from_repo(current_user, jobid):
             machine=machine,
             target_path=file_path,
         )
+        invalidate_job_files(machine, remote_folder)
     except Exception as e:
-        return (
-            jsonify(
-                error="unable to delete file.",
-                except_type=str(type(e)),
-            ),
+        return error_response(
+            e,
             500,
+            error="unable to delete file.",
         )
     else:
         return (
@@ -1,31 +1,97 @@
+import base64
 import os
+import re
+import time
 import uuid
+from concurrent.futures import wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    json,
+    jsonify,
+    request,
+    stream_with_context,
+    url_for,
+)
+from pymongo.errors import PyMongoError
 
-from flask import Blueprint, current_app, jsonify, request
-
+from hpc_gateway.api.utils import (
+    error_response,
+    idempotent,
+    stream_size,
+    upload_file_name,
+)
 from hpc_gateway.auth import token_required
 from hpc_gateway.model.database import (
+    CREATED,
+    FAILED,
+    QUEUED,
+    SUCCEEDED,
+    TERMINAL_STATES,
     EntityNotFoundError,
+    begin_job_submission,
     create_job,
+    create_operation,
+    create_sweep_jobs,
+    find_job_transitions,
+    find_jobs,
     get_job,
-    get_jobs,
+    get_jobs_by_ids,
+    get_operation,
     get_user,
+    queue_job,
+    release_job_submission,
+    set_job_states,
     update_job,
+    utcnow,
+    watch_job_transitions,
+)
+from hpc_gateway.model.f7t import (
+    create_f7t_client,
+    get_max_file_size,
+    get_upload_executor,
+    list_job_files,
 )
-from hpc_gateway.model.f7t import create_f7t_client
-from hpc_gateway.model.job import create_job_script
+from hpc_gateway.model.job import (
+    JOB_SCRIPT_FILENAME,
+    create_job_script,
+    expand_sweep,
+    submit_job_script,
+    upload_job_script,
+)
+from hpc_gateway.model.operations import CREATE_JOB, LAUNCH_JOB, get_operation_workers
+from hpc_gateway.model.resilience import RejectedError, is_transient
+from hpc_gateway.model.tracker import poll_job_states
 
 # For the job manipulate, basically the
 # capabilies relate to simulation.
 job_api_v1 = Blueprint("job_api_v1", "job_api_v1", url_prefix="/api/v1/job")
 
-JOB_SCRIPT_FILENAME = "job.sh"
+JOB_FIELD_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+EPOCH = datetime(1970, 1, 1)
 
 
 @job_api_v1.route("/", methods=["GET"])
 @token_required
 def api_get_jobs(current_user):
-    """get jobs from DB of the user."""
+    """get jobs from DB of the user.
+
+    The jobs are streamed one by one as `{"jobs": {_id: details}, "next": ...}`,
+    the optional query parameters are:
+
+    - limit: number of jobs per page, `next` is the cursor of the next page
+      (null on the last page)
+    - cursor: `next` of the previous page
+    - fields: comma separated fields of the jobs to return
+    - state: comma separated states of the jobs to return
+    - created_after, created_before: ISO 8601 creation time range
+    """
     email = current_user.get("email")
     try:
         user = get_user(email)
@@ -34,53 +100,326 @@ def api_get_jobs(current_user):
     else:
         user_id = user.get("_id")
 
-    jobs = get_jobs(user_id)
+    try:
+        query = parse_jobs_query(request.args)
+    except (ValueError, InvalidId) as e:
+        return (jsonify(error=f"invalid query: {e}"), 400)
 
-    # arrange output where the jobs is
-    # as dict of key: value -> _id: details
-    output_jobs = {}
-    for job in jobs:
-        output_jobs[str(job.get("_id"))] = job
+    limit = query.pop("limit")
+    # one more job tells whether there is a next page
+    jobs = find_jobs(user_id, limit=limit + 1 if limit else None, **query)
 
-    return jsonify(
-        jobs=output_jobs,
+    return Response(
+        stream_with_context(stream_jobs(jobs, limit)), mimetype="application/json"
     )
 
 
+def parse_jobs_query(args):
+    """Arguments of `find_jobs` from the query parameters of a job listing."""
+    config = current_app.config
+    limit = args.get("limit", config["JOB_LIST_DEFAULT_LIMIT"], type=int)
+    if limit is not None:
+        limit = min(max(limit, 1), config["JOB_LIST_MAX_LIMIT"])
+
+    fields = None
+    if args.get("fields"):
+        fields = args["fields"].split(",")
+        if not all(JOB_FIELD_PATTERN.match(field) for field in fields):
+            raise ValueError(f"fields {args['fields']}")
+
+    def date(name):
+        return datetime.fromisoformat(args[name]) if args.get(name) else None
+
+    return {
+        "limit": limit,
+        "after": decode_cursor(args["cursor"]) if args.get("cursor") else None,
+        "fields": fields,
+        "states": args["state"].split(",") if args.get("state") else None,
+        "created_after": date("created_after"),
+        "created_before": date("created_before"),
+    }
+
+
+def encode_cursor(job_id):
+    return base64.urlsafe_b64encode(ObjectId(job_id).binary).decode()
+
+
+def decode_cursor(cursor):
+    return ObjectId(base64.urlsafe_b64decode(cursor.encode()))
+
+
+def stream_jobs(jobs, limit=None):
+    """Write the JSON listing of the jobs piece by piece, the jobs are never
+    all in memory.
+
+    The status is sent before the jobs are read: a DB error in between
+    still closes the JSON, with an `error` and the `next` cursor from where
+    the listing can be resumed."""
+    yield '{"jobs": {'
+    end = {"next": None}
+    last_id = None
+    try:
+        for count, job in enumerate(jobs):
+            if limit and count == limit:
+                end["next"] = encode_cursor(last_id)
+                break
+            last_id = job["_id"]
+            separator = ", " if count else ""
+            yield f"{separator}{json.dumps(str(last_id))}: {json.dumps(job)}"
+    except PyMongoError:
+        current_app.logger.exception("Job listing interrupted.")
+        end["error"] = "Job listing interrupted, resume from next."
+        end["next"] = encode_cursor(last_id) if last_id else None
+
+    yield f"}}, {json.dumps(end)[1:]}\n"
+
+
 @job_api_v1.route("/state/<jobid>", methods=["GET"])
 def api_get_job_state(jobid):
     """get state (return by files in the folder) of a job through firecrest.
     list files of a job.
     file contain also the folder and the format is list.
+
+    When the job state tracker runs, the state recorded in the DB is
+    returned without calling firecrest, unless `files` are requested.
     """
     machine = current_app.config["MACHINE"]
 
     job = get_job(job_id=jobid)
     remote_folder = job.get("remote_folder")
+    state = {
+        "state": job.get("state"),
+        "state_updated_at": job.get("state_updated_at"),
+    }
 
-    try:
-        f7t_client = create_f7t_client()
-        response = f7t_client.list_files(machine=machine, target_path=remote_folder)
-    except Exception as e:
+    if current_app.config["JOB_TRACKER_ENABLED"] and "files" not in request.args:
         return (
             jsonify(
-                error="unable to list files to job folder.",
-                except_type=str(type(e)),
+                **state,
+                message="State of the job.",
             ),
+            200,
+        )
+
+    try:
+        f7t_client = create_f7t_client()
+        response = list_job_files(f7t_client, machine, remote_folder)
+    except Exception as e:
+        return error_response(
+            e,
             500,
+            error="unable to list files to job folder.",
         )
     else:
         return (
             jsonify(
                 files=response,
                 message="Files in the job folder.",
+                **state,
             ),
             200,
         )
 
 
+@job_api_v1.route("/states", methods=["GET"])
+@token_required
+def api_get_job_states(current_user):
+    """get the state of several jobs of the user at once.
+    `jobids`: comma separated ids of the jobs.
+
+    The jobs are read with one DB query. Unless the job state tracker runs,
+    the launched jobs not in a terminal state are polled with one firecrest
+    call per machine and their transitions recorded.
+    """
+    email = current_user.get("email")
+    try:
+        user = get_user(email)
+    except EntityNotFoundError:
+        return (jsonify(error="We can not find your are registered."), 500)
+    else:
+        user_id = user.get("_id")
+
+    job_ids = [jobid for jobid in request.args.get("jobids", "").split(",") if jobid]
+    if len(job_ids) > current_app.config["JOB_LIST_MAX_LIMIT"]:
+        return (jsonify(error="Too many job ids."), 400)
+    try:
+        jobs = list(
+            get_jobs_by_ids(
+                job_ids,
+                user_id=user_id,
+                fields=["state", "state_updated_at", "f7t_job_id", "machine"],
+            )
+        )
+    except InvalidId as e:
+        return (jsonify(error=f"invalid job id: {e}"), 400)
+
+    if not current_app.config["JOB_TRACKER_ENABLED"]:
+        active_jobs = [
+            job
+            for job in jobs
+            if job.get("f7t_job_id") and job.get("state") not in TERMINAL_STATES
+        ]
+        if active_jobs:
+            try:
+                f7t_client = create_f7t_client()
+                transitions = poll_job_states(f7t_client, active_jobs)
+            except Exception as e:
+                return error_response(e, 500, error="unable to poll the jobs.")
+
+            now = utcnow()
+            set_job_states(transitions, now=now)
+            new_states = {job_id: state for job_id, _, state in transitions}
+            for job in jobs:
+                if job["_id"] in new_states:
+                    job.update(state=new_states[job["_id"]], state_updated_at=now)
+
+    states = {
+        str(job["_id"]): {
+            "state": job.get("state"),
+            "state_updated_at": job.get("state_updated_at"),
+        }
+        for job in jobs
+    }
+    return (
+        jsonify(
+            states=states,
+            missing=[job_id for job_id in job_ids if job_id not in states],
+        ),
+        200,
+    )
+
+
+@job_api_v1.route("/events", methods=["GET"])
+@token_required
+def api_get_job_events(current_user):
+    """Stream the state changes of the jobs of the user as Server-Sent Events.
+
+    Every event is `{"jobid", "state", "state_updated_at"}` of a job whose
+    state changed, its id is the position to resume from with the
+    `Last-Event-ID` header (or `last_event_id` parameter), without it the
+    stream starts now. Comments are sent as heartbeats and the stream ends
+    after JOB_EVENTS_MAX_DURATION seconds, clients reconnect transparently.
+    """
+    email = current_user.get("email")
+    try:
+        user = get_user(email)
+    except EntityNotFoundError:
+        return (jsonify(error="We can not find your are registered."), 500)
+    else:
+        user_id = user.get("_id")
+
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get(
+        "last_event_id"
+    )
+    try:
+        after = decode_event_id(last_event_id) if last_event_id else (utcnow(), None)
+    except (ValueError, InvalidId) as e:
+        return (jsonify(error=f"invalid last event id: {e}"), 400)
+
+    response = Response(
+        stream_with_context(stream_job_events(user_id, after)),
+        mimetype="text/event-stream",
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    # no buffering by a reverse proxy (nginx)
+    response.headers["X-Accel-Buffering"] = "no"
+
+    return response
+
+
+def encode_event_id(updated_at, job_id):
+    return f"{(updated_at - EPOCH) // timedelta(milliseconds=1)}-{job_id}"
+
+
+def decode_event_id(event_id):
+    milliseconds, _, job_id = event_id.partition("-")
+    updated_at = EPOCH + timedelta(milliseconds=int(milliseconds))
+    return updated_at, ObjectId(job_id) if job_id else None
+
+
+def is_after(position, after):
+    """Whether the event `position` follows `after`, where the job id of
+    `after` may be None (no event of that millisecond sent)."""
+    updated_at, job_id = after
+    if position[0] != updated_at:
+        return position[0] > updated_at
+    return job_id is not None and position[1] > job_id
+
+
+def stream_job_events(user_id, after):
+    """Events of the state changes of the jobs of the user after the
+    position `after`, from the jobs change stream where available and by
+    polling the jobs otherwise."""
+    config = current_app.config
+    heartbeat = config["JOB_EVENTS_HEARTBEAT"]
+    page = 100
+    deadline = time.monotonic() + config["JOB_EVENTS_MAX_DURATION"]
+
+    # watch before reading the backlog, no change is missed in between
+    try:
+        changes = watch_job_transitions(
+            user_id, max_await_time_ms=int(heartbeat * 1000)
+        )
+    except PyMongoError:
+        changes = None
+
+    def event(job):
+        position = (job["state_updated_at"], job["_id"])
+        data = {
+            "jobid": job["_id"],
+            "state": job.get("state"),
+            "state_updated_at": job["state_updated_at"],
+        }
+        return position, (
+            f"id: {encode_event_id(*position)}\n"
+            f"event: state\n"
+            f"data: {json.dumps(data)}\n\n"
+        )
+
+    # state_updated_at of the last state sent per job: the change stream
+    # delivers in write order, not in the order of the positions (the jobs
+    # of a bulk write share their time), and may repeat the backlog
+    sent = {}
+
+    try:
+        yield f"retry: {config['JOB_EVENTS_RETRY_MS']}\n\n"
+        last_sent = time.monotonic()
+        backlog = True
+        while time.monotonic() < deadline:
+            jobs = []
+            if backlog or changes is None:
+                jobs = list(find_job_transitions(user_id, after=after, limit=page))
+                # a full page, the backlog goes on
+                backlog = len(jobs) == page
+            else:
+                change = changes.try_next()
+                if change is not None and change.get("fullDocument"):
+                    jobs = [change["fullDocument"]]
+
+            for job in jobs:
+                position, message = event(job)
+                if job["state_updated_at"] <= sent.get(job["_id"], EPOCH):
+                    continue
+                sent[job["_id"]] = job["state_updated_at"]
+                if is_after(position, after):
+                    after = position
+                last_sent = time.monotonic()
+                yield message
+
+            if time.monotonic() - last_sent >= heartbeat:
+                last_sent = time.monotonic()
+                yield ": heartbeat\n\n"
+
+            if changes is None and not jobs:
+                time.sleep(config["JOB_EVENTS_POLL_INTERVAL"])
+    finally:
+        if changes is not None:
+            changes.close()
+
+
 @job_api_v1.route("/create", methods=["POST"])
 @token_required
+@idempotent
 def api_create_job(current_user):
     """create a job and
     return jobid for job modification and data manipulation
@@ -89,6 +428,9 @@ def api_create_job(current_user):
     folder(repository) name.
     It will also create a slurm script to run the job inside the container
     controlled by singularity.
+
+    With `?async=true` (or the `Prefer: respond-async` header) the folder
+    and script are created by the background workers, see `respond_async`.
     """
     machine = current_app.config["MACHINE"]
 
@@ -106,31 +448,46 @@ def api_create_job(current_user):
     remote_folder = os.path.join(user_home, fd)
 
     request_obj = request.get_json()
+    # recorded with the job, to pack it in a task farm
+    job_params = dict(request_obj)
     request_obj["email"] = email
 
+    if is_async_request():
+        try:
+            job_script = create_job_script(**request_obj, machine=machine)
+        except (ValueError, TypeError) as e:
+            return error_response(e, 400, error="invalid job parameters.")
+
+        operation = create_operation(
+            CREATE_JOB,
+            email,
+            params={
+                "user_id": user_id,
+                "machine": machine,
+                "remote_folder": remote_folder,
+                "job_script": job_script,
+                "job_params": job_params,
+            },
+            job_id=ObjectId(),
+        )
+        return respond_async(operation)
+
     try:
         f7t_client = create_f7t_client()
-        f7t_client.mkdir(machine=machine, target_path=remote_folder)
         # create a script file and upload, the content is read from parameters
-        job_script = create_job_script(**request_obj)
-
-        f7t_client.simple_upload(
-            machine=machine,
-            source_path=job_script.encode(),
-            target_path=remote_folder,
-            filename=JOB_SCRIPT_FILENAME,
-        )
+        job_script = create_job_script(**request_obj, machine=machine)
+        upload_job_script(f7t_client, machine, remote_folder, job_script)
     except Exception as e:
         # faild to create job to remote folder
-        return (
-            jsonify(
-                error=f"unable to create job in machine {machine}.",
-                except_type=str(type(e)),
-            ),
+        return error_response(
+            e,
             400,
+            error=f"unable to create job in machine {machine}.",
         )
     else:
-        job = create_job(user_id=user_id, remote_folder=remote_folder)
+        job = create_job(
+            user_id=user_id, remote_folder=remote_folder, params=job_params
+        )
         return (
             jsonify(
                 jobid=job["_id"],
@@ -139,35 +496,320 @@ def api_create_job(current_user):
         )
 
 
+@job_api_v1.route("/submit", methods=["POST"])
+@token_required
+@idempotent
+def api_submit_job(current_user):
+    """create and launch a job in one request, return its jobid.
+
+    multipart form with the job parameters (as for `/create`) as JSON in the
+    `params` field and the input files as `file` fields. The job folder is
+    created once, the job script and the input files are uploaded
+    concurrently, the job is submitted and recorded with a single DB write.
+    The time (ms) spent in every stage is returned as `timings`.
+    """
+    machine = current_app.config["MACHINE"]
+    timings = {}
+    started = time.perf_counter()
+
+    email = current_user.get("email")
+    try:
+        user = get_user(email)
+    except EntityNotFoundError:
+        return (jsonify(error="We can not find your are registered."), 500)
+    else:
+        user_id = user.get("_id")
+        user_home = user.get("home")
+
+    try:
+        request_obj = json.loads(request.form.get("params", ""))
+        request_obj["email"] = email
+        job_script = create_job_script(**request_obj, machine=machine)
+    except (ValueError, TypeError) as e:
+        return (
+            jsonify(
+                error="Please provide the job parameters as JSON in `params`.",
+                except_type=str(type(e)),
+            ),
+            400,
+        )
+
+    uploaded_files = request.files.getlist("file")
+    try:
+        sources = [(job_script.encode(), JOB_SCRIPT_FILENAME)] + [
+            (uploaded_file.stream, upload_file_name(uploaded_file.filename))
+            for uploaded_file in uploaded_files
+        ]
+    except ValueError as e:
+        return error_response(e, 400, error=str(e))
+
+    remote_folder = os.path.join(user_home, str(uuid.uuid4()))
+
+    stage = "mkdir"
+    created = False
+    try:
+        f7t_client = create_f7t_client()
+        max_file_size = get_max_file_size(f7t_client)
+        too_large = [
+            uploaded_file.filename
+            for uploaded_file in uploaded_files
+            if stream_size(uploaded_file.stream) > max_file_size
+        ]
+        if too_large:
+            return (
+                jsonify(
+                    error="Files too large to submit with the job, upload them "
+                    "to the job folder with the file API.",
+                    files=too_large,
+                ),
+                413,
+            )
+
+        with timed(timings, stage):
+            f7t_client.mkdir(machine=machine, target_path=remote_folder)
+        created = True
+
+        stage = "upload"
+        with timed(timings, stage):
+            executor = get_upload_executor()
+            futures = [
+                executor.submit(
+                    f7t_client.simple_upload,
+                    machine=machine,
+                    source_path=source,
+                    target_path=remote_folder,
+                    filename=filename,
+                )
+                for source, filename in sources
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                # the job fails as a whole, the uploads not started are not
+                # needed anymore, the running ones end before the cleanup
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+                raise
+
+        stage = "submit"
+        with timed(timings, stage):
+            response = f7t_client.submit(
+                machine=machine,
+                job_script=os.path.join(remote_folder, JOB_SCRIPT_FILENAME),
+                local_file=False,
+            )
+            f7t_job_id = response.get("jobid")
+    except Exception as e:
+        if created:
+            discard_job(f7t_client, machine, remote_folder)
+        return error_response(
+            e,
+            600 if stage == "submit" else 400,
+            error=f"unable to {stage} the job in machine {machine}.",
+            timings=timings,
+        )
+
+    try:
+        with timed(timings, "db"):
+            job = create_job(
+                user_id=user_id,
+                remote_folder=remote_folder,
+                f7t_job_id=f7t_job_id,
+                machine=machine,
+            )
+    except PyMongoError as e:
+        # nobody could follow or cancel the job
+        discard_job(f7t_client, machine, remote_folder, f7t_job_id)
+        return error_response(
+            e, 500, error="unable to record the job.", timings=timings
+        )
+    timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+
+    return (
+        jsonify(
+            jobid=job["_id"],
+            f7t_job_id=f7t_job_id,
+            timings=timings,
+        ),
+        200,
+    )
+
+
+@job_api_v1.route("/sweep", methods=["POST"])
+@token_required
+@idempotent
+def api_create_sweep(current_user):
+    """create and launch a parameter sweep as a single SLURM job array.
+
+    JSON of the job parameters (as for `/create`) with `parameters`, the
+    grid `{name: [values]}` of the sweep: every combination of the values is
+    a task of the array, run in its own folder of the job folder with the
+    parameters as environment variables. The job folder and script are
+    created once and the array submitted once, the sweep and its tasks are
+    recorded as a parent job and a child job per task.
+
+    Return the jobid of the sweep and the jobid and parameters of the tasks.
+    """
+    machine = current_app.config["MACHINE"]
+
+    email = current_user.get("email")
+    try:
+        user = get_user(email)
+    except EntityNotFoundError:
+        return (jsonify(error="We can not find your are registered."), 500)
+    else:
+        user_id = user.get("_id")
+        user_home = user.get("home")
+
+    request_obj = request.get_json()
+    request_obj["email"] = email
+    try:
+        tasks = expand_sweep(
+            request_obj.pop("parameters", None),
+            max_tasks=current_app.config["SWEEP_MAX_TASKS"],
+        )
+        job_script = create_job_script(
+            **request_obj, sweep_tasks=tasks, machine=machine
+        )
+    except (ValueError, TypeError) as e:
+        return error_response(e, 400, error=f"invalid sweep: {e}")
+
+    remote_folder = os.path.join(user_home, str(uuid.uuid4()))
+    f7t_client = None
+    try:
+        f7t_client = create_f7t_client()
+        upload_job_script(f7t_client, machine, remote_folder, job_script)
+    except Exception as e:
+        if f7t_client is not None:
+            discard_job(f7t_client, machine, remote_folder)
+        return error_response(
+            e,
+            400,
+            error=f"unable to create sweep in machine {machine}.",
+        )
+
+    try:
+        f7t_job_id = submit_job_script(f7t_client, machine, remote_folder)
+    except Exception as e:
+        discard_job(f7t_client, machine, remote_folder)
+        return error_response(
+            e,
+            600,
+            error=f"unable to submit sweep in machine {machine}.",
+        )
+
+    try:
+        parent, children = create_sweep_jobs(
+            user_id=user_id,
+            remote_folder=remote_folder,
+            tasks=tasks,
+            f7t_job_id=f7t_job_id,
+            machine=machine,
+        )
+    except PyMongoError as e:
+        # nobody could follow or cancel the array
+        discard_job(f7t_client, machine, remote_folder, f7t_job_id)
+        return error_response(e, 500, error="unable to record the sweep.")
+    return (
+        jsonify(
+            jobid=parent["_id"],
+            f7t_job_id=f7t_job_id,
+            tasks=[
+                {"jobid": child["_id"], "parameters": child["parameters"]}
+                for child in children
+            ],
+        ),
+        200,
+    )
+
+
+def discard_job(f7t_client, machine, remote_folder, f7t_job_id=None):
+    """Cancel the job of a failed submission and remove its folder, as far
+    as firecrest lets."""
+    try:
+        if f7t_job_id is not None:
+            f7t_client.cancel(machine=machine, job_id=f7t_job_id)
+        f7t_client.simple_delete(machine=machine, target_path=remote_folder)
+    except Exception as e:
+        current_app.logger.warning(f"Unable to discard the job in {remote_folder}: {e}")
+
+
+@contextmanager
+def timed(timings, stage):
+    """Record the time (ms) spent in the block as `timings[stage]`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round((time.perf_counter() - started) * 1000, 1)
+
+
 @job_api_v1.route("/launch/<jobid>", methods=["PATCH"])
 @token_required
+@idempotent
 def api_launch_job(current_user, jobid):
-    """launch the job."""
+    """launch the job.
+
+    With `?async=true` (or the `Prefer: respond-async` header) the job is
+    submitted by the background workers, see `respond_async`.
+
+    With `?pack=true` the job is QUEUED to run with other small jobs of the
+    same image and partition in a task farm (one allocation), launched by
+    the job packer.
+    """
     machine = current_app.config["MACHINE"]
 
     job = get_job(jobid)
     remote_folder = job.get("remote_folder")
 
+    if request.args.get("pack", "").lower() in ("1", "true"):
+        if not current_app.config["JOB_PACKER_ENABLED"]:
+            return (jsonify(error="Packing of jobs is disabled."), 400)
+        if not job.get("params"):
+            return (
+                jsonify(error=f"Job {jobid} has no recorded parameters to pack."),
+                400,
+            )
+        job = queue_job(jobid, machine)
+        if job is None:
+            return (jsonify(error=f"Job {jobid} already launched."), 409)
+        return (jsonify(jobid=job["_id"], state=job["state"]), 202)
+
+    if job.get("state") != CREATED and not job.get("f7t_job_id"):
+        # queued or packed in a task farm
+        return (jsonify(error=f"Job {jobid} is {job.get('state')}."), 409)
+
+    if is_async_request():
+        operation = create_operation(
+            LAUNCH_JOB,
+            current_user.get("email"),
+            params={"machine": machine},
+            job_id=job["_id"],
+        )
+        return respond_async(operation)
+
+    # taken atomically, the job is not packed or launched meanwhile
+    if not begin_job_submission(job["_id"], ObjectId()):
+        return (jsonify(error=f"Job {jobid} already launched."), 409)
+
     try:
         f7t_client = create_f7t_client()
-        response = f7t_client.submit(
-            machine=machine,
-            job_script=os.path.join(remote_folder, JOB_SCRIPT_FILENAME),
-            local_file=False,
-        )
-        f7t_job_id = response.get("jobid")
+        f7t_job_id = submit_job_script(f7t_client, machine, remote_folder)
     except Exception as e:
         print(e)
+        if isinstance(e, RejectedError) or not is_transient(e):
+            # not attempted or refused, the launch can be retried
+            release_job_submission(job["_id"])
         # faild to create job to remote folder
-        return (
-            jsonify(
-                error=f"unable to submit job in machine {machine}.",
-                except_type=str(type(e)),
-            ),
+        return error_response(
+            e,
             600,
+            error=f"unable to submit job in machine {machine}.",
         )
     else:
-        job = update_job(job_id=jobid, f7t_job_id=f7t_job_id)
+        job = update_job(job_id=jobid, f7t_job_id=f7t_job_id, machine=machine)
         return (
             jsonify(
                 jobid=job["_id"],
@@ -176,22 +818,112 @@ def api_launch_job(current_user, jobid):
         )
 
 
+def is_async_request():
+    return request.args.get("async", "").lower() in ("1", "true") or (
+        "respond-async" in request.headers.get("Prefer", "")
+    )
+
+
+def respond_async(operation):
+    """`202 Accepted` for a queued operation, its status is polled (or
+    awaited) at the `Location` of the response."""
+    workers = get_operation_workers()
+    if workers is not None:
+        workers.notify()
+
+    location = url_for(
+        "job_api_v1.api_get_operation", operation_id=str(operation["_id"])
+    )
+    response = jsonify(
+        operation=operation["_id"],
+        jobid=operation["job_id"],
+        status=operation["status"],
+        message="Operation queued.",
+    )
+    response.headers["Location"] = location
+    response.headers["Retry-After"] = "1"
+
+    return response, 202
+
+
+@job_api_v1.route("/operation/<operation_id>", methods=["GET"])
+@token_required
+def api_get_operation(current_user, operation_id):
+    """status of an asynchronous job operation, with its `result` (`jobid`
+    and `f7t_job_id` once launched) or `error`.
+
+    `wait`: seconds to wait for the operation to finish (at most
+    OPERATION_MAX_WAIT), the status is returned as soon as it is done.
+    """
+    config = current_app.config
+    wait = min(request.args.get("wait", 0, type=float), config["OPERATION_MAX_WAIT"])
+    deadline = time.monotonic() + wait
+
+    while True:
+        try:
+            operation = get_operation(operation_id)
+        except InvalidId:
+            operation = None
+        if operation is None or operation["email"] != current_user.get("email"):
+            return (jsonify(error=f"Operation {operation_id} not found."), 404)
+
+        remaining = deadline - time.monotonic()
+        if operation["status"] in (SUCCEEDED, FAILED) or remaining <= 0:
+            break
+        time.sleep(min(config["OPERATION_POLL_INTERVAL"], remaining))
+
+    return (
+        jsonify(
+            operation=operation["_id"],
+            kind=operation["kind"],
+            jobid=operation["job_id"],
+            status=operation["status"],
+            attempts=operation["attempts"],
+            result=operation["result"],
+            error=operation["error"],
+            created_at=operation["created_at"],
+            updated_at=operation["updated_at"],
+        ),
+        200,
+    )
+
+
 @job_api_v1.route("/cancel/<jobid>", methods=["DELETE"])
 @token_required
 def api_cancel_job(current_user, jobid):
     """cancel the job, by call cancel f7t operation.
     Simply send a f7t signal and do nothing to the DB entity.
     """
-    machine = current_app.config["MACHINE"]
-
     job = get_job(jobid)
-    if job.get("state") != "ACTIVATED":
+    machine = job.get("machine", current_app.config["MACHINE"])
+    if job.get("state") == QUEUED and set_job_states(
+        [(job["_id"], QUEUED, "CANCELLED")]
+    ):
+        return (
+            jsonify(message=f"Removed job-{jobid} from the packing queue."),
+            200,
+        )
+    if job.get("farm_id"):
+        return (
+            jsonify(
+                error=f"Job {jobid} runs in a task farm, it can not be cancelled.",
+            ),
+            409,
+        )
+    if not job.get("f7t_job_id"):
         return (
             jsonify(
                 error=f"Job {jobid} not launched yet.",
             ),
             505,
         )
+    if job.get("state") in TERMINAL_STATES:
+        return (
+            jsonify(
+                error=f"Job {jobid} already {job.get('state')}.",
+            ),
+            505,
+        )
 
     try:
         f7t_client = create_f7t_client()
@@ -202,12 +934,10 @@ def api_cancel_job(current_user, jobid):
         )
     except Exception as e:
         # faild to create job to remote folder
-        return (
-            jsonify(
-                error=f"unable to cancel job in machine {machine}.",
-                except_type=str(type(e)),
-            ),
+        return error_response(
+            e,
             600,
+            error=f"unable to cancel job in machine {machine}.",
         )
     else:
         return (
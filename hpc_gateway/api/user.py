@@ -5,6 +5,7 @@ from pathlib import Path
 
 from flask import Blueprint, current_app, jsonify
 
+from hpc_gateway.api.utils import error_response
 from hpc_gateway.auth import token_required
 from hpc_gateway.model.database import create_user
 from hpc_gateway.model.f7t import create_f7t_client
@@ -41,12 +42,10 @@ def api_create_user(current_user):
         f7t_client = create_f7t_client()
         f7t_client.mkdir(machine=machine, target_path=user_home, p=True)
     except Exception as e:
-        return (
-            jsonify(
-                error=f"mkdir {user_home} on {machine} fail.",
-                except_type=str(type(e)),
-            ),
+        return error_response(
+            e,
             501,
+            error=f"mkdir {user_home} on {machine} fail.",
         )
     else:
         # DB operation
@@ -1,3 +1,25 @@
+import hashlib
+import math
+import os
+import uuid
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request
+
+from hpc_gateway.model.database import (
+    begin_idempotent_request,
+    complete_idempotent_request,
+    release_idempotent_request,
+)
+from hpc_gateway.model.resilience import RejectedError
+
+# headers of a response replayed for a retried request
+REPLAYED_HEADERS = ("Location", "Retry-After")
+# errors of the request itself (validation), the other errors come from
+# firecrest or the DB and may not happen again
+CLIENT_ERRORS = (ValueError, TypeError)
+
+
 def expect(input, expected_type, field):
     """To validate the input of the field.
     Only check that the type is expected.
@@ -5,3 +27,148 @@ def expect(input, expected_type, field):
     if isinstance(input, expected_type):
         return input
     raise AssertionError("Invalid input for type", field)
+
+
+def error_response(e, status_code, **body):
+    """JSON response of a request failed because of `e`.
+
+    Calls rejected to protect firecrest (known to be unavailable or already
+    busy with too many calls) are answered right away with 503 and a
+    `Retry-After` header instead of `status_code`. Only the responses of
+    CLIENT_ERRORS are replayed to the retries of an idempotent request.
+    """
+    response = jsonify(except_type=str(type(e)), **body)
+    response.replayable = isinstance(e, CLIENT_ERRORS)
+    if isinstance(e, RejectedError):
+        response.status_code = 503
+        response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+    else:
+        response.status_code = status_code
+
+    return response
+
+
+def stream_size(stream):
+    """Number of bytes left in a seekable stream."""
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell() - position
+    stream.seek(position)
+
+    return size
+
+
+def upload_file_name(filename):
+    """The name of an uploaded file in the job folder: the client may only
+    name a file, never a path out of the job (or staging) folder."""
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    if name in ("", ".", ".."):
+        raise ValueError(f"Invalid file name {filename!r}.")
+
+    return name
+
+
+def request_fingerprint():
+    """Hash of the method, path, query and payload of the request, the
+    files of a multipart upload are identified by their names and size,
+    any other (raw) body by its type and length: it is not read."""
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.full_path}".encode())
+    if request.is_json:
+        digest.update(request.get_data())
+    elif request.files or request.form:
+        for name, uploaded_file in request.files.items(multi=True):
+            size = stream_size(uploaded_file.stream)
+            digest.update(f"{name}={uploaded_file.filename}:{size}".encode())
+        for name, value in request.form.items(multi=True):
+            digest.update(f"{name}={value}".encode())
+    else:
+        digest.update(f"{request.mimetype}:{request.content_length}".encode())
+
+    return digest.hexdigest()
+
+
+def idempotent(f):
+    """Honour the `Idempotency-Key` header of a (token authenticated) request:
+    the response of the first request with a key is recorded in the DB for
+    IDEMPOTENCY_KEY_TTL seconds and replayed to the retries with the same
+    key, instead of doing the remote work again.
+
+    A key reused for another request is answered with 422, a retry while
+    the first request is running with 409. Only the successful (2xx) and
+    the client error (4xx, not caused by firecrest or the DB) responses are
+    recorded, after another failure the request can be retried with the
+    same key.
+    """
+
+    @wraps(f)
+    def decorated(current_user, *args, **kwargs):
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if not idempotency_key:
+            return f(current_user, *args, **kwargs)
+
+        config = current_app.config
+        key = f"{current_user.get('email')}:{idempotency_key}"
+        fingerprint = request_fingerprint()
+        # the key may be taken over if this request outlives its lock
+        owner = uuid.uuid4().hex
+        record = begin_idempotent_request(
+            key,
+            fingerprint,
+            owner,
+            ttl=config["IDEMPOTENCY_KEY_TTL"],
+            lock_ttl=config["IDEMPOTENCY_KEY_LOCK_TTL"],
+        )
+        if record is not None:
+            if record.get("fingerprint", fingerprint) != fingerprint:
+                return (
+                    jsonify(error="Idempotency-Key already used for another request."),
+                    422,
+                )
+            if record["status"] != "completed":
+                response = jsonify(error="A request with this Idempotency-Key runs.")
+                response.status_code = 409
+                response.headers["Retry-After"] = "1"
+                return response
+
+            recorded = record["response"]
+            response = current_app.response_class(
+                recorded["body"],
+                status=recorded["status"],
+                mimetype=recorded["mimetype"],
+                headers=recorded["headers"],
+            )
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = make_response(f(current_user, *args, **kwargs))
+        except BaseException:
+            release_idempotent_request(key, owner)
+            raise
+
+        status = response.status_code
+        replayed = 200 <= status < 300 or (
+            400 <= status < 500 and getattr(response, "replayable", True)
+        )
+        if not replayed or response.is_streamed:
+            release_idempotent_request(key, owner)
+        else:
+            complete_idempotent_request(
+                key,
+                owner,
+                {
+                    "status": response.status_code,
+                    "body": response.get_data(as_text=True),
+                    "mimetype": response.mimetype,
+                    "headers": {
+                        name: response.headers[name]
+                        for name in REPLAYED_HEADERS
+                        if name in response.headers
+                    },
+                },
+            )
+
+        return response
+
+    return decorated
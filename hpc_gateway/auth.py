@@ -1,9 +1,193 @@
+import hashlib
+import threading
+import time
 from functools import wraps
 
+import jwt
 import requests
 from flask import current_app, jsonify, request
 from requests.exceptions import ConnectionError
 
+from hpc_gateway.cache import TTLCache
+
+_NOT_CACHED = object()
+_REJECTED = False
+
+
+def get_token_cache():
+    """The userinfo cache of the current app, keyed by token digest.
+
+    A valid token maps to its userinfo, a token rejected by the marketplace
+    maps to `_REJECTED` for the (shorter) negative TTL."""
+    cache = current_app.extensions.get("token_cache")
+    if cache is None:
+        cache = current_app.extensions["token_cache"] = TTLCache(
+            maxsize=current_app.config["AUTH_CACHE_MAXSIZE"],
+            ttl=current_app.config["AUTH_CACHE_TTL"],
+        )
+
+    return cache
+
+
+def token_digest(token):
+    """Never keep the raw bearer token in memory longer than the request."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def fetch_userinfo(token):
+    """Query the marketplace userinfo endpoint, go through the token cache.
+
+    Return the userinfo dict or None if the token is rejected."""
+    cache = get_token_cache()
+    key = token_digest(token)
+    current_user = cache.get(key, _NOT_CACHED)
+    if current_user is not _NOT_CACHED:
+        return current_user or None
+
+    headers = {
+        "Accept": "application/json",
+        "User-Agent": "HPC-app",
+        "Authorization": f"Bearer {token}",
+    }
+
+    # Use GET request method
+
+    resp = requests.get(
+        current_app.config["MP_USERINFO_URL"],
+        headers=headers,
+        verify=None,
+    )
+
+    if resp.status_code == 200:
+        current_user = resp.json()
+        cache.set(key, current_user)
+    else:
+        current_user = None
+        # Only remember a definitive rejection, not a marketplace failure.
+        if 400 <= resp.status_code < 500:
+            cache.set(
+                key,
+                _REJECTED,
+                ttl=current_app.config["AUTH_CACHE_NEGATIVE_TTL"],
+            )
+
+    return current_user
+
+
+class AuthUnavailableError(Exception):
+    """The token can not be verified for now (signing keys unavailable)."""
+
+
+class JWKSCache:
+    """Signing keys of the marketplace realm, fetched once and kept in memory.
+
+    The key set is refreshed when a token refers to an unknown key id (key
+    rotation), at most once every `min_refresh_interval` seconds so that
+    forged key ids can not be used to hammer the JWKS endpoint. A failed
+    fetch is rate limited the same way, the tokens of the unknown keys are
+    meanwhile answered with `AuthUnavailableError`."""
+
+    def __init__(self, jwks_url, min_refresh_interval=30):
+        self.jwks_url = jwks_url
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._fetched_at = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        self._fetched_at = time.monotonic()
+        try:
+            resp = requests.get(
+                self.jwks_url, headers={"Accept": "application/json"}, verify=None
+            )
+            resp.raise_for_status()
+            jwk_set = jwt.PyJWKSet.from_dict(resp.json())
+        except (requests.RequestException, ValueError, jwt.PyJWTError) as e:
+            self._error = e
+            return
+
+        self._keys = {key.key_id: key for key in jwk_set.keys}
+        self._error = None
+
+    def get_signing_key(self, kid):
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        with self._lock:
+            key = self._keys.get(kid)
+            if key is None and (
+                self._fetched_at is None
+                or time.monotonic() - self._fetched_at > self.min_refresh_interval
+            ):
+                self._refresh()
+                key = self._keys.get(kid)
+
+        if key is None and self._error is not None:
+            raise AuthUnavailableError(
+                f"Unable to fetch the signing keys from {self.jwks_url}: "
+                f"{self._error}"
+            )
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key id {kid}.")
+
+        return key
+
+
+def get_jwks_cache():
+    cache = current_app.extensions.get("jwks_cache")
+    if cache is None:
+        cache = current_app.extensions["jwks_cache"] = JWKSCache(
+            current_app.config["MP_JWKS_URL"],
+            min_refresh_interval=current_app.config["AUTH_JWKS_MIN_REFRESH_INTERVAL"],
+        )
+
+    return cache
+
+
+def decode_token(token):
+    """Verify the bearer JWT locally (signature, exp, aud, iss) and return
+    its claims. Raise `jwt.InvalidTokenError` if the token is not valid,
+    every token is rejected while AUTH_JWT_AUDIENCE is not set."""
+    config = current_app.config
+    audience = config["AUTH_JWT_AUDIENCE"]
+    if not audience:
+        current_app.logger.error("AUTH_JWT_AUDIENCE is required with AUTH_MODE=jwt.")
+        raise jwt.InvalidAudienceError("No audience configured.")
+
+    header = jwt.get_unverified_header(token)
+    signing_key = get_jwks_cache().get_signing_key(header.get("kid"))
+
+    return jwt.decode(
+        token,
+        signing_key.key,
+        algorithms=config["AUTH_JWT_ALGORITHMS"],
+        audience=audience,
+        issuer=config["MP_ISSUER"],
+        options={"require": ["exp", "iss", "aud"]},
+    )
+
+
+def authenticate(token):
+    """Return the current user (a userinfo-like dict) of the token,
+    or None if the token is not valid.
+
+    With AUTH_MODE="jwt" the token is verified locally and the userinfo
+    endpoint is only queried if the claims lack `email` or `name`."""
+    if current_app.config["AUTH_MODE"] != "jwt":
+        return fetch_userinfo(token)
+
+    try:
+        claims = decode_token(token)
+    except jwt.InvalidTokenError:
+        return None
+
+    if claims.get("email") and claims.get("name"):
+        return claims
+
+    return fetch_userinfo(token)
+
 
 def token_required(f):
     @wraps(f)
@@ -22,24 +206,7 @@ def token_required(f):
                 401,
             )
         try:
-            headers = {
-                "Accept": "application/json",
-                "User-Agent": "HPC-app",
-                "Authorization": f"Bearer {token}",
-            }
-
-            # Use GET request method
-
-            resp = requests.get(
-                userinfo_url,
-                headers=headers,
-                verify=None,
-            )
-
-            if resp.status_code == 200:
-                current_user = resp.json()
-            else:
-                current_user = None
+            current_user = authenticate(token)
 
             if current_user is None:
                 return (
@@ -51,6 +218,15 @@ def token_required(f):
                     401,
                 )
 
+        except AuthUnavailableError as e:
+            return (
+                jsonify(
+                    message="Unable to verify the Authentication token.",
+                    data=None,
+                    error=str(e),
+                ),
+                503,
+            )
         except ConnectionError as e:
             return (
                 jsonify(
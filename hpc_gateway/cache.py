@@ -0,0 +1,168 @@
+"""Caches shared by the request handlers of a worker (or of all workers)."""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from hpc_gateway.model import database
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded, thread-safe mapping whose entries expire after a TTL.
+
+    When full, the least recently used entry is evicted. Every entry may
+    carry its own TTL (e.g. a shorter one for negative results). Hits and
+    misses are counted for monitoring.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                value, expires_at = item
+                if expires_at > self._timer():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, self._timer() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+            if item is _MISSING:
+                return default
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class MongoTTLCache:
+    """TTLCache counterpart shared by all workers, backed by a collection.
+
+    Expired documents are ignored on read and removed by a TTL index.
+    Values must be BSON serializable.
+    """
+
+    def __init__(self, collection_name, ttl=60):
+        self.collection_name = collection_name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._indexed = False
+
+    @property
+    def _collection(self):
+        collection = database.db[self.collection_name]
+        if not self._indexed:
+            collection.create_index("expires_at", expireAfterSeconds=0)
+            self._indexed = True
+
+        return collection
+
+    def get(self, key, default=None):
+        document = self._collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+        if document is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return document["value"]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._collection.replace_one(
+            {"_id": key},
+            {"value": value, "expires_at": datetime.utcnow() + timedelta(seconds=ttl)},
+            upsert=True,
+        )
+
+    def pop(self, key, default=None):
+        document = self._collection.find_one_and_delete({"_id": key})
+        if document is None:
+            return default
+        return document["value"]
+
+    def clear(self):
+        self._collection.delete_many({})
+
+    def stats(self):
+        return {"backend": "mongo", "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one.
+
+    The first caller runs the function, the others arriving meanwhile wait
+    for it and get the same result (or exception)."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
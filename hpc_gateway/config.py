@@ -10,7 +10,9 @@ load_dotenv
 # Find the absolute file path to the top level project directory
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-USERINFO_ENDPOINT = "auth/realms/marketplace/protocol/openid-connect/userinfo"
+REALM_ENDPOINT = "auth/realms/marketplace"
+USERINFO_ENDPOINT = f"{REALM_ENDPOINT}/protocol/openid-connect/userinfo"
+JWKS_ENDPOINT = f"{REALM_ENDPOINT}/protocol/openid-connect/certs"
 
 
 class Config:
@@ -25,6 +27,137 @@ class Config:
 
     PORT = 5000
 
+    # Cache of the marketplace userinfo per bearer token (seconds)
+    AUTH_CACHE_TTL = 60
+    AUTH_CACHE_NEGATIVE_TTL = 5
+    AUTH_CACHE_MAXSIZE = 1024
+
+    # "userinfo": validate the token by the marketplace userinfo endpoint
+    # "jwt": verify the token locally against the realm JWKS
+    AUTH_MODE = "userinfo"
+    AUTH_JWT_ALGORITHMS = ["RS256"]
+    # required with "jwt", the tokens are rejected while it is not set
+    AUTH_JWT_AUDIENCE = os.environ.get("AUTH_JWT_AUDIENCE")
+    AUTH_JWKS_MIN_REFRESH_INTERVAL = 30
+
+    # Firecrest clients are shared per worker process
+    F7T_POOL_MAXSIZE = 20
+    # Reuse the access token until this many seconds before expiry ...
+    F7T_TOKEN_MIN_VALIDITY = 30
+    # ... and fetch the next one in background this many seconds before expiry
+    F7T_TOKEN_REFRESH_AHEAD = 60
+    # Socket timeout (seconds) of firecrest operations, per operation name
+    F7T_DEFAULT_TIMEOUT = 30
+    F7T_TIMEOUTS = {
+        "simple_upload": 300,
+        "simple_download": 300,
+        "stream_download": 60,
+        "submit": 120,
+    }
+    # Retries of idempotent operations on transient errors, with jittered
+    # exponential backoff (seconds)
+    F7T_RETRIES = 2
+    F7T_BACKOFF_BASE = 0.5
+    F7T_BACKOFF_MAX = 8
+    # Fail fast for a machine after consecutive transient errors, until a
+    # trial call is let through after the reset timeout (seconds)
+    F7T_BREAKER_FAILURE_THRESHOLD = 5
+    F7T_BREAKER_RESET_TIMEOUT = 30
+    # Calls in flight per machine and operation class, per worker process;
+    # extra calls wait up to F7T_BULKHEAD_MAX_WAIT seconds in a queue of
+    # F7T_BULKHEAD_MAX_QUEUE before being answered 503
+    F7T_BULKHEAD_LIMITS = {"listing": 16, "transfer": 8, "submit": 4}
+    F7T_BULKHEAD_MAX_QUEUE = 32
+    F7T_BULKHEAD_MAX_WAIT = 5
+
+    # Pipe downloads chunk by chunk instead of buffering the whole file,
+    # always done for requests with a Range header.
+    FILE_STREAM_DOWNLOAD = False
+    FILE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    # Local cache of downloaded files, disabled if no folder is set
+    FILE_CACHE_DIR = None
+    FILE_CACHE_MAX_BYTES = 10 * 2**30
+
+    # Files above the firecrest small-file limit go through object storage
+    FILE_STAGED_TRANSFER = True
+    # Used when the firecrest parameters do not tell the limit (bytes)
+    F7T_DEFAULT_MAX_FILE_SIZE = 5 * 2**20
+    # Local folder holding large uploads until staged, default: system tmp
+    FILE_STAGING_DIR = None
+    # Concurrent transfers of batch uploads and archives, per worker process
+    FILE_UPLOAD_WORKERS = 4
+    # Files downloaded ahead while streaming a job folder archive
+    ARCHIVE_PREFETCH = 2
+
+    # Jobs per page of the job listing, None: all the jobs in one response
+    JOB_LIST_DEFAULT_LIMIT = None
+    JOB_LIST_MAX_LIMIT = 1000
+
+    # Responses of the requests with an `Idempotency-Key` are replayed to
+    # retries for IDEMPOTENCY_KEY_TTL seconds, a retry waits (409) until the
+    # first request is done, or IDEMPOTENCY_KEY_LOCK_TTL seconds
+    IDEMPOTENCY_KEY_TTL = 24 * 3600
+    IDEMPOTENCY_KEY_LOCK_TTL = 600
+
+    # Job script templates, compiled once per worker process, the bytecode
+    # cache (if set) is shared by the processes and kept across restarts
+    JOB_TEMPLATES_DIR = os.path.join(os.path.dirname(basedir), "templates")
+    JOB_TEMPLATES_CACHE_DIR = None
+    # Template per kind of script, for "<machine>:<partition>", "<machine>"
+    # or any machine ("*")
+    JOB_TEMPLATES = {
+        "job": {"*": "cscs_job_script.j2"},
+        "farm": {"*": "cscs_farm_script.j2"},
+    }
+
+    # Tasks of a parameter sweep (job array), within the MaxArraySize of SLURM
+    SWEEP_MAX_TASKS = 1000
+
+    # Background polling of the SLURM state of the launched jobs, the state
+    # endpoint answers from the DB when enabled
+    JOB_TRACKER_ENABLED = False
+    JOB_TRACKER_INTERVAL = 30
+    # Run the tracker thread in every worker process (if enabled)
+    JOB_TRACKER_THREAD = True
+    # Jobs per firecrest poll call
+    JOB_TRACKER_BATCH_SIZE = 200
+
+    # Background packing of the jobs launched with `pack` into task farms: a
+    # group of queued jobs (same machine, image and partition) is launched in
+    # one allocation of JOB_PACKER_NTASKS tasks once it has JOB_PACKER_MAX_JOBS
+    # jobs or waited JOB_PACKER_MAX_WAIT seconds
+    JOB_PACKER_ENABLED = False
+    JOB_PACKER_INTERVAL = 30
+    JOB_PACKER_MAX_JOBS = 32
+    JOB_PACKER_MAX_WAIT = 120
+    JOB_PACKER_NTASKS = 12
+    JOB_PACKER_TIME_LIMIT = "01:00:00"
+
+    # Server-Sent Events of job state changes (seconds), every open stream
+    # holds a worker thread: run gunicorn with threads or gevent workers
+    JOB_EVENTS_POLL_INTERVAL = 2
+    JOB_EVENTS_HEARTBEAT = 15
+    JOB_EVENTS_MAX_DURATION = 300
+    JOB_EVENTS_RETRY_MS = 3000
+
+    # Background workers (threads per worker process) of the asynchronous
+    # job operations, 0: the process runs none (queued operations wait for
+    # another process)
+    OPERATION_WORKERS = 2
+    # Seconds between polls of the queue by an idle worker
+    OPERATION_POLL_INTERVAL = 1
+    # Seconds an operation is held by a worker, then claimed again as lost
+    OPERATION_LEASE_TTL = 600
+    OPERATION_MAX_ATTEMPTS = 3
+    OPERATION_RETRY_BACKOFF = 2
+    # Longest wait (seconds) for the outcome of an operation in a request
+    OPERATION_MAX_WAIT = 30
+
+    # Job folder listings, "memory" (per worker) or "mongo" (shared) backend
+    LISTING_CACHE_BACKEND = "memory"
+    LISTING_CACHE_TTL = 5
+    LISTING_CACHE_MAXSIZE = 4096
+
 
 class StagingConfig(Config):
     """Staging server registries"""
@@ -34,6 +167,8 @@ class StagingConfig(Config):
     TESTING = False
     MP_URL = "http://staging.materials-marketplace.eu"
     MP_USERINFO_URL = urljoin(MP_URL, USERINFO_ENDPOINT)
+    MP_JWKS_URL = urljoin(MP_URL, JWKS_ENDPOINT)
+    MP_ISSUER = urljoin(MP_URL, REALM_ENDPOINT)
 
 
 class StagingMCConfig(StagingConfig):
@@ -62,15 +197,26 @@ class StagingIWMConfig(StagingConfig):
 
     MACHINE = "cluster"
     CLUSTER_HOME = "/home/jyu/firecrest"
+    JOB_TEMPLATES = {
+        "job": {"*": "slurm_job_script.j2"},
+        "farm": {"*": "slurm_farm_script.j2"},
+    }
     F7T_AUTH_URL = "http://192.168.220.21:8000"
     F7T_TOKEN = os.environ.get("F7T_TOKEN")
 
 
 class TestingConfig(Config):
     TESTING = True
-    MONGO_URI = "mongodb://"
+    MONGO_URI = "mongodb://localhost:27017/hpcdb"
+    MONGO_ENSURE_INDEXES = False
+    # operations and tracking rounds are run by the tests
+    OPERATION_WORKERS = 0
+    JOB_TRACKER_THREAD = False
     MP_URL = "http://staging.materials-marketplace.eu"
     MP_USERINFO_URL = urljoin(MP_URL, USERINFO_ENDPOINT)
+    MP_JWKS_URL = urljoin(MP_URL, JWKS_ENDPOINT)
+    MP_ISSUER = urljoin(MP_URL, REALM_ENDPOINT)
+    AUTH_JWT_AUDIENCE = "hpc-gateway"
 
 
 class TestingMCConfig(TestingConfig):
@@ -87,5 +233,9 @@ class TestingMCConfig(TestingConfig):
 class TestingIWMConfig(TestingConfig):
     MACHINE = "cluster"
     CLUSTER_HOME = "/home/jyu/firecrest"
+    JOB_TEMPLATES = {
+        "job": {"*": "slurm_job_script.j2"},
+        "farm": {"*": "slurm_farm_script.j2"},
+    }
     F7T_AUTH_URL = "http://192.168.220.21:8000"
     F7T_TOKEN = os.environ.get("F7T_TOKEN")
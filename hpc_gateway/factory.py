@@ -9,6 +9,12 @@ from hpc_gateway.api.file import file_api_v1
 from hpc_gateway.api.image import image_api_v1
 from hpc_gateway.api.job import job_api_v1
 from hpc_gateway.api.user import user_api_v1
+from hpc_gateway.model.database import MongoConnection, db, ensure_indexes
+from hpc_gateway.model.job import init_job_templates
+from hpc_gateway.model.operations import init_operation_workers
+from hpc_gateway.model.packer import init_job_packer
+from hpc_gateway.model.resilience import breaker_stats, bulkhead_stats
+from hpc_gateway.model.tracker import init_job_tracker
 
 
 class MongoJsonEncoder(JSONEncoder):
@@ -31,11 +37,24 @@ def create_app():
         template_folder=TEMPLATE_FOLDER,
     )
     app.json_encoder = MongoJsonEncoder
+
+    # One MongoClient (connection pool) per app and per worker process
+    MongoConnection(app)
+    init_job_templates(app)
+    init_job_tracker(app)
+    init_operation_workers(app)
+    init_job_packer(app)
+
     app.register_blueprint(file_api_v1)
     app.register_blueprint(job_api_v1)
     app.register_blueprint(user_api_v1)
     app.register_blueprint(image_api_v1)
 
+    @app.cli.command("ensure-indexes")
+    def ensure_indexes_command():
+        """Create the indexes of the users and jobs collections."""
+        ensure_indexes(db)
+
     @app.route("/")
     def serve():
         return render_template("index.html")
@@ -49,4 +68,14 @@ def create_app():
             200,
         )
 
+    @app.route("/status")
+    def status():
+        """Circuit breakers and bulkheads of the firecrest machines."""
+        return (
+            jsonify(
+                firecrest=dict(breakers=breaker_stats(), bulkheads=bulkhead_stats())
+            ),
+            200,
+        )
+
     return app
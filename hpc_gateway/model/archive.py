@@ -0,0 +1,99 @@
+"""Build zip or tar archives on the fly from streamed files.
+
+Every entry is `(name, size, mtime, chunks)` where `chunks` is an iterable
+of bytes. The archives are produced chunk by chunk as generators of bytes,
+neither the entries nor the archive are held in memory or written to disk.
+"""
+import tarfile
+import time
+import zipfile
+import zlib
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+class _ChunkWriter:
+    """Write-only, unseekable file object collecting what zipfile writes."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_stream(entries, compression=zipfile.ZIP_DEFLATED):
+    """Yield a zip archive of the entries.
+
+    The output is unseekable so zipfile writes sizes and CRCs in data
+    descriptors after each member."""
+    writer = _ChunkWriter()
+    with zipfile.ZipFile(writer, mode="w", compression=compression) as archive:
+        for name, size, mtime, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6])
+            info.compress_type = compression
+            info.file_size = size
+            force_zip64 = size > zipfile.ZIP64_LIMIT
+            with archive.open(info, mode="w", force_zip64=force_zip64) as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    yield from _drained(writer)
+            yield from _drained(writer)
+
+    yield from _drained(writer)
+
+
+def _drained(writer):
+    data = writer.drain()
+    if data:
+        yield data
+
+
+def _tar_members(entries):
+    for name, size, mtime, chunks in entries:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+
+        # the header announced `size` bytes, stick to it even if the
+        # file changed meanwhile so the archive stays readable
+        remaining = size
+        for chunk in chunks:
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+            if remaining == 0:
+                break
+        if remaining:
+            yield b"\0" * remaining
+
+        padding = -size % TAR_BLOCK_SIZE
+        if padding:
+            yield b"\0" * padding
+
+    yield b"\0" * (2 * TAR_BLOCK_SIZE)
+
+
+def tar_stream(entries, gzip=False):
+    """Yield a (gzip compressed) ustar/pax archive of the entries."""
+    if not gzip:
+        yield from _tar_members(entries)
+        return
+
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for block in _tar_members(entries):
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
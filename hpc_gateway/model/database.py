@@ -1,28 +1,163 @@
 """This module serve as the model of the HPC gateway to interafcing for the
 users and jobs collection of the DB."""
 
+import os
+import threading
+from datetime import datetime, timedelta
+
 from bson.objectid import ObjectId
-from flask import current_app, g
-from flask_pymongo import PyMongo
+from flask import current_app
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    IndexModel,
+    MongoClient,
+    ReturnDocument,
+    UpdateOne,
+)
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from werkzeug.local import LocalProxy
 
+from hpc_gateway.model.job import SWEEP_TASK_FOLDER
+
 
 class EntityNotFoundError(Exception):
     """raised when entity not in db."""
 
 
+class MongoConnection:
+    """Hold one MongoClient (and its connection pool) for the lifetime of the app.
+
+    The client is created lazily on first use from the app config, so the
+    configuration may be loaded after `create_app`. MongoClient is not
+    fork-safe, a gunicorn worker forked from a preloaded master will
+    therefore build its own client the first time it touches the db.
+
+    The indexes of the hot queries are ensured whenever a client is built
+    (unless MONGO_ENSURE_INDEXES is off), before the first query is served.
+    """
+
+    def __init__(self, app=None):
+        self._client = None
+        self._database = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MONGO_MAX_POOL_SIZE", 100)
+        app.config.setdefault("MONGO_MIN_POOL_SIZE", 0)
+        app.config.setdefault("MONGO_CONNECT_TIMEOUT_MS", 5000)
+        app.config.setdefault("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)
+        app.config.setdefault("MONGO_SOCKET_TIMEOUT_MS", None)
+        app.config.setdefault("MONGO_DBNAME", "hpcdb")
+        # create the indexes of the hot queries when the client is built
+        app.config.setdefault("MONGO_ENSURE_INDEXES", True)
+        app.extensions["mongo"] = self
+
+    def _connect(self, config):
+        client = MongoClient(
+            config["MONGO_URI"],
+            maxPoolSize=config["MONGO_MAX_POOL_SIZE"],
+            minPoolSize=config["MONGO_MIN_POOL_SIZE"],
+            connectTimeoutMS=config["MONGO_CONNECT_TIMEOUT_MS"],
+            serverSelectionTimeoutMS=config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+            socketTimeoutMS=config["MONGO_SOCKET_TIMEOUT_MS"],
+            connect=False,
+        )
+        database = client.get_default_database(default=config["MONGO_DBNAME"])
+
+        return client, database
+
+    @property
+    def client(self):
+        self._ensure_connected()
+        return self._client
+
+    @property
+    def db(self):
+        self._ensure_connected()
+        return self._database
+
+    def _ensure_connected(self):
+        pid = os.getpid()
+        if self._client is not None and self._pid == pid:
+            return
+
+        with self._lock:
+            if self._client is None or self._pid != pid:
+                # The client inherited from the parent process (if any) is
+                # dropped without closing, its sockets belong to the parent.
+                self._client, self._database = self._connect(current_app.config)
+                self._pid = pid
+                if current_app.config["MONGO_ENSURE_INDEXES"]:
+                    try:
+                        ensure_indexes(self._database)
+                    except PyMongoError as e:
+                        # e.g. duplicated emails, serve anyway with the
+                        # indexes that could be built
+                        current_app.logger.warning(f"Unable to ensure indexes: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._database = None
+            self._pid = None
+
+
 def get_db():
     """Configuration method to return db instance."""
-    db = getattr(g, "_database", None)
-    if db is None:
-        db = g._database = PyMongo(current_app).db
-
-    return db
+    return current_app.extensions["mongo"].db
 
 
 # Use LocalProxy to read the global db instance with just `db`
 db = LocalProxy(get_db)
 
+# Indexes of the queries run on (nearly) every API call
+INDEXES = {
+    "users": [IndexModel([("email", ASCENDING)], unique=True)],
+    "jobs": [
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("state", ASCENDING)]),
+        # active jobs of the job state tracker
+        IndexModel([("state", ASCENDING)]),
+        # state change events
+        IndexModel([("user_id", ASCENDING), ("state_updated_at", ASCENDING)]),
+        # jobs packed in a task farm
+        IndexModel([("farm_id", ASCENDING)], sparse=True),
+        # tasks of a job array
+        IndexModel([("parent_id", ASCENDING)], sparse=True),
+    ],
+    # task farms not collected yet, of the job packer
+    "farms": [IndexModel([("collected", ASCENDING)])],
+    # recorded responses are removed by mongo once expired
+    "idempotency_keys": [IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)],
+    "transfers": [IndexModel([("task_id", ASCENDING)], unique=True)],
+    # operations due and operations of lost workers, claimed by the workers
+    "operations": [
+        IndexModel([("status", ASCENDING), ("not_before", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)]),
+    ],
+}
+
+
+def utcnow():
+    """Current time with the millisecond precision of stored dates, so a
+    document built locally equals the one read back."""
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def ensure_indexes(database):
+    """Create the missing indexes, existing ones are left untouched."""
+    for collection, indexes in INDEXES.items():
+        database[collection].create_indexes(indexes)
+
+
 """
 User: Create/Get User
 
@@ -39,14 +174,17 @@ def create_user(email, name, home):
     email is the exclusive key, can not have two users with the same email.
     If user already in the DB return it.
     """
-    user = db.users.find_one({"email": email})
-    if user:
-        return user
-    else:
-        user_info = {"name": name, "email": email, "home": home}
-        _id = db.users.insert_one(user_info).inserted_id
-        user = db.users.find_one({"_id": _id})
-        return user
+    user_info = {"name": name, "email": email, "home": home}
+    try:
+        return db.users.find_one_and_update(
+            {"email": email},
+            {"$setOnInsert": user_info},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # a concurrent upsert of the same user won the race
+        return db.users.find_one({"email": email})
 
 
 def get_user(email):
@@ -66,42 +204,187 @@ Job: Create/Update/Delete/Get simulation jobs
 - update_job: only for update the state of the job
     State can be:
     - CREATED: the job created but not launched
-    - ATTACHED: the job has been trigger to run, there is no real state stored since
-        the real state is read from remote on the fly by f7t.
-- get_jobs
+    - QUEUED: the job waits to be packed in a task farm
+    - PACKING: the job is being submitted in a task farm
+    - ACTIVATED: the job has been trigger to run, its state is not known yet
+    - the SLURM state of the job (PENDING, RUNNING, COMPLETED...), recorded
+        by the job state tracker
+- begin_job_submission, release_job_submission: mark the job submitted by
+    an operation or request, so it is never submitted twice
+- find_jobs: filtered, projected page of jobs
 - get_job
+- get_jobs_by_ids: several jobs in one query
+- create_sweep_jobs: the parent job and the task jobs of a job array
+- get_array_tasks: the task jobs of job arrays
+- get_active_jobs: launched jobs not in a terminal state
+- set_job_states: record state transitions
+- queue_job, get_queued_jobs: jobs waiting to be packed in a task farm
+- claim_queued_jobs: take queued jobs for a task farm
+- find_job_transitions, watch_job_transitions: state changes of the jobs of a user
 """
 
-
-def create_job(user_id, remote_folder):
+CREATED = "CREATED"
+QUEUED = "QUEUED"
+PACKING = "PACKING"
+ACTIVATED = "ACTIVATED"
+# SLURM states a job never leaves
+TERMINAL_STATES = (
+    "BOOT_FAIL",
+    "CANCELLED",
+    "COMPLETED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+)
+
+
+def create_job(
+    user_id, remote_folder, f7t_job_id=None, machine=None, job_id=None, params=None
+):
     """Create job to DB.
 
     Args:
         user_id (str): attached user
         remote_folder (str): absolute path the remote folder name a uuid in user's repository folder
+        f7t_job_id (str): id of the job if already submitted, recorded as ACTIVATED
+        machine (str): machine the job is submitted to
+        job_id (str): id given to the job in advance, e.g. by an asynchronous
+            operation, raise DuplicateKeyError if already created
+        params (dict): parameters of the job script, to pack the job in a
+            task farm
     """
-    state = "CREATED"
+    state = CREATED
+    now = utcnow()
     job_info = {
         "user_id": ObjectId(user_id),
         "remote_folder": remote_folder,
         "state": state,
+        "created_at": now,
     }
-    _id = db.jobs.insert_one(job_info).inserted_id
-    job = db.jobs.find_one({"_id": _id})
+    if f7t_job_id is not None:
+        job_info.update(
+            state=ACTIVATED,
+            f7t_job_id=f7t_job_id,
+            state_updated_at=now,
+            state_history=[{"state": ACTIVATED, "at": now}],
+        )
+    if machine is not None:
+        job_info["machine"] = machine
+    if job_id is not None:
+        job_info["_id"] = ObjectId(job_id)
+    if params is not None:
+        job_info["params"] = params
+    # insert_one sets the `_id` of the document
+    db.jobs.insert_one(job_info)
+
+    return job_info
+
+
+def create_sweep_jobs(user_id, remote_folder, tasks, f7t_job_id, machine):
+    """Record a submitted parameter sweep (SLURM job array): a parent job
+    for the array and a child job per task, inserted at once.
 
-    return job
+    Args:
+        tasks (list): parameters (dict) of every task, the task `i` is the
+            array task `{f7t_job_id}_{i}` running in its own folder
+    Returns:
+        the parent job and the list of child jobs
+    """
+    now = utcnow()
+    activated = {
+        "state": ACTIVATED,
+        "state_updated_at": now,
+        "state_history": [{"state": ACTIVATED, "at": now}],
+        "machine": machine,
+        "created_at": now,
+    }
+    parent = {
+        "user_id": ObjectId(user_id),
+        "remote_folder": remote_folder,
+        "f7t_job_id": f7t_job_id,
+        "array_size": len(tasks),
+        **activated,
+    }
+    db.jobs.insert_one(parent)
+
+    children = [
+        {
+            "user_id": ObjectId(user_id),
+            "remote_folder": os.path.join(
+                remote_folder, SWEEP_TASK_FOLDER.format(index=index)
+            ),
+            "f7t_job_id": f"{f7t_job_id}_{index}",
+            "parent_id": parent["_id"],
+            "array_index": index,
+            "parameters": parameters,
+            **activated,
+            "state_history": list(activated["state_history"]),
+        }
+        for index, parameters in enumerate(tasks)
+    ]
+    try:
+        db.jobs.insert_many(children)
+    except PyMongoError:
+        # no array recorded in part
+        db.jobs.delete_many(
+            {"$or": [{"_id": parent["_id"]}, {"parent_id": parent["_id"]}]}
+        )
+        raise
+
+    return parent, children
+
+
+def get_array_tasks(parent_ids):
+    """State of the task jobs of the job arrays `parent_ids`."""
+    return db.jobs.find(
+        {"parent_id": {"$in": [ObjectId(parent_id) for parent_id in parent_ids]}},
+        {"parent_id": 1, "state": 1},
+    )
 
 
-def update_job(job_id: str, f7t_job_id: str):
-    """Set the f7t job id and update job state to ACTIVATED"""
-    db.jobs.update_one(
+def update_job(job_id: str, f7t_job_id: str, machine: str = None):
+    """Set the f7t job id (and machine) and update job state to ACTIVATED"""
+    now = utcnow()
+    fields = {"state": ACTIVATED, "f7t_job_id": f7t_job_id, "state_updated_at": now}
+    if machine is not None:
+        fields["machine"] = machine
+    job = db.jobs.find_one_and_update(
         {"_id": ObjectId(job_id)},
-        {"$set": {"state": "ACTIVATED", "f7t_job_id": f7t_job_id}},
+        {
+            "$set": fields,
+            "$unset": {"submitting": ""},
+            "$push": {"state_history": {"state": ACTIVATED, "at": now}},
+        },
+        return_document=ReturnDocument.AFTER,
     )
-    job = db.jobs.find_one({"_id": ObjectId(job_id)})
     return job
 
 
+def begin_job_submission(job_id, submission_id):
+    """Mark the created job as being submitted (`submission_id`: the
+    operation or request submitting it), unless it was submitted, is being
+    (or may have been) submitted already or is queued for a task farm.
+    Return whether the job may be submitted."""
+    job = db.jobs.find_one_and_update(
+        {
+            "_id": ObjectId(job_id),
+            "state": CREATED,
+            "f7t_job_id": None,
+            "submitting": None,
+        },
+        {"$set": {"submitting": ObjectId(submission_id)}},
+    )
+    return job is not None
+
+
+def release_job_submission(job_id):
+    """Unmark a job which was certainly not submitted."""
+    db.jobs.update_one({"_id": ObjectId(job_id)}, {"$unset": {"submitting": ""}})
+
+
 def delete_job(job_id):
     """
     Given a job ID, deletes a job from the jobs collection
@@ -109,14 +392,469 @@ def delete_job(job_id):
     db.jobs.delete_one({"_id": ObjectId(job_id)})
 
 
-def get_jobs(user_id):
-    """get jobs of the users"""
-    response = db.jobs.find({"user_id": ObjectId(user_id)})
+def find_jobs(
+    user_id,
+    after=None,
+    limit=None,
+    fields=None,
+    states=None,
+    created_after=None,
+    created_before=None,
+):
+    """Cursor over the jobs of the user in `_id` order (keyset pagination).
 
-    return list(response)
+    Args:
+        after (ObjectId): only the jobs after this one
+        limit (int): maximum number of jobs
+        fields (list): fields to return, `_id` is always returned
+        states (list): only the jobs in one of these states
+        created_after, created_before (datetime): creation time range
+    """
+    query = {"user_id": ObjectId(user_id)}
+    if after is not None:
+        query["_id"] = {"$gt": ObjectId(after)}
+    if states:
+        query["state"] = {"$in": list(states)}
+    if created_after is not None or created_before is not None:
+        query["created_at"] = {}
+        if created_after is not None:
+            query["created_at"]["$gte"] = created_after
+        if created_before is not None:
+            query["created_at"]["$lt"] = created_before
+
+    projection = {field: 1 for field in fields} if fields else None
+    cursor = db.jobs.find(query, projection).sort("_id", ASCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    return cursor
 
 
 def get_job(job_id):
     job = db.jobs.find_one({"_id": ObjectId(job_id)})
 
     return job
+
+
+def get_jobs_by_ids(job_ids, user_id=None, fields=None):
+    """Jobs among `job_ids` (of the user if given), in one query."""
+    query = {"_id": {"$in": [ObjectId(job_id) for job_id in job_ids]}}
+    if user_id is not None:
+        query["user_id"] = ObjectId(user_id)
+    projection = {field: 1 for field in fields} if fields else None
+
+    return db.jobs.find(query, projection)
+
+
+def get_active_jobs():
+    """Launched jobs of all users whose state may still change, the state
+    of a job array is the one of its tasks."""
+    return db.jobs.find(
+        {
+            "f7t_job_id": {"$exists": True, "$ne": None},
+            "state": {"$nin": list(TERMINAL_STATES)},
+            "array_size": {"$exists": False},
+        },
+        {"f7t_job_id": 1, "state": 1, "machine": 1, "parent_id": 1},
+    )
+
+
+def set_job_states(transitions, now=None):
+    """Record state transitions, a list of (job_id, old_state, new_state),
+    that happened at `now` (default: current time).
+
+    A transition only applies if the job is still in `old_state`, so
+    concurrent trackers can not move a job backwards. Return the number of
+    jobs updated.
+    """
+    if not transitions:
+        return 0
+
+    now = now or utcnow()
+    result = db.jobs.bulk_write(
+        [
+            UpdateOne(
+                {"_id": ObjectId(job_id), "state": old_state},
+                {
+                    "$set": {"state": new_state, "state_updated_at": now},
+                    "$push": {"state_history": {"state": new_state, "at": now}},
+                },
+            )
+            for job_id, old_state, new_state in transitions
+        ],
+        ordered=False,
+    )
+
+    return result.modified_count
+
+
+def queue_job(job_id, machine):
+    """Queue a created job to be packed in a task farm of `machine`, return
+    the job or None if it is not in the CREATED state or being submitted."""
+    now = utcnow()
+    return db.jobs.find_one_and_update(
+        {"_id": ObjectId(job_id), "state": CREATED, "submitting": None},
+        {
+            "$set": {
+                "state": QUEUED,
+                "machine": machine,
+                "queued_at": now,
+                "state_updated_at": now,
+            },
+            "$push": {"state_history": {"state": QUEUED, "at": now}},
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def get_queued_jobs():
+    """Jobs of all users waiting to be packed, in queuing order."""
+    return db.jobs.find({"state": QUEUED}).sort("queued_at", ASCENDING)
+
+
+def claim_queued_jobs(farm_id, job_ids):
+    """Move the jobs still queued (not cancelled meanwhile) to PACKING in
+    the farm, return them."""
+    now = utcnow()
+    claimed = []
+    for job_id in job_ids:
+        job = db.jobs.find_one_and_update(
+            {"_id": ObjectId(job_id), "state": QUEUED},
+            {
+                "$set": {
+                    "state": PACKING,
+                    "farm_id": ObjectId(farm_id),
+                    "state_updated_at": now,
+                },
+                "$push": {"state_history": {"state": PACKING, "at": now}},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is not None:
+            claimed.append(job)
+
+    return claimed
+
+
+def find_job_transitions(user_id, after=None, limit=100):
+    """Jobs of the user in the order of their last state change, from the
+    position `after`: (state_updated_at, job_id or None) excluded."""
+    query = {"user_id": ObjectId(user_id), "state_updated_at": {"$ne": None}}
+    if after is not None:
+        updated_at, job_id = after
+        query["$or"] = [{"state_updated_at": {"$gt": updated_at}}]
+        if job_id is not None:
+            query["$or"].append(
+                {"state_updated_at": updated_at, "_id": {"$gt": ObjectId(job_id)}}
+            )
+
+    return (
+        db.jobs.find(query, {"state": 1, "state_updated_at": 1})
+        .sort([("state_updated_at", ASCENDING), ("_id", ASCENDING)])
+        .limit(limit)
+    )
+
+
+def watch_job_transitions(user_id, max_await_time_ms=1000):
+    """Change stream of the state changes of the jobs of the user, and of
+    the jobs inserted with a state (submitted at once), raise PyMongoError
+    if the deployment has no change streams (standalone)."""
+    pipeline = [
+        {
+            "$match": {
+                "fullDocument.user_id": ObjectId(user_id),
+                "$or": [
+                    {
+                        "operationType": "insert",
+                        "fullDocument.state_updated_at": {"$ne": None},
+                    },
+                    {
+                        "operationType": "update",
+                        "updateDescription.updatedFields.state": {"$exists": True},
+                    },
+                ],
+            }
+        }
+    ]
+    return db.jobs.watch(
+        pipeline, full_document="updateLookup", max_await_time_ms=max_await_time_ms
+    )
+
+
+"""
+Farm: task farms, one SLURM job running several packed jobs
+
+- create_farm: record a farm before its submission
+- activate_farm: record the submission of a farm and activate its jobs
+- release_farm: forget a farm which was not submitted, queue its jobs again
+- get_active_farms: submitted farms whose job states are not all collected
+- update_farm
+"""
+
+
+def create_farm(farm_id, machine, remote_folder, job_ids):
+    """Record the farm of the (claimed) jobs before it is submitted: a farm
+    whose submission outcome is unknown stays PACKING, its jobs are never
+    packed again. Return the farm."""
+    farm = {
+        "_id": ObjectId(farm_id),
+        "machine": machine,
+        "remote_folder": remote_folder,
+        "f7t_job_id": None,
+        "job_ids": [ObjectId(job_id) for job_id in job_ids],
+        "state": PACKING,
+        "collected": False,
+        "created_at": utcnow(),
+    }
+    db.farms.insert_one(farm)
+
+    return farm
+
+
+def activate_farm(farm_id, f7t_job_id):
+    """Record the SLURM job of the submitted farm and mark its jobs
+    ACTIVATED."""
+    now = utcnow()
+    db.farms.update_one(
+        {"_id": ObjectId(farm_id)},
+        {"$set": {"f7t_job_id": f7t_job_id, "state": ACTIVATED}},
+    )
+    db.jobs.update_many(
+        {"farm_id": ObjectId(farm_id), "state": PACKING},
+        {
+            "$set": {"state": ACTIVATED, "state_updated_at": now},
+            "$push": {"state_history": {"state": ACTIVATED, "at": now}},
+        },
+    )
+
+
+def release_farm(farm_id):
+    """Queue the jobs of a farm which was certainly not submitted again."""
+    now = utcnow()
+    db.jobs.update_many(
+        {"farm_id": ObjectId(farm_id), "state": PACKING},
+        {
+            "$set": {"state": QUEUED, "state_updated_at": now},
+            "$unset": {"farm_id": ""},
+            "$push": {"state_history": {"state": QUEUED, "at": now}},
+        },
+    )
+    db.farms.delete_one({"_id": ObjectId(farm_id)})
+
+
+def get_active_farms():
+    return db.farms.find({"collected": False, "f7t_job_id": {"$ne": None}})
+
+
+def update_farm(farm_id, **fields):
+    db.farms.update_one({"_id": ObjectId(farm_id)}, {"$set": fields})
+
+
+"""
+Lease: exclusive ownership of a background task among the worker processes
+
+- acquire_lease
+"""
+
+
+def acquire_lease(name, owner, ttl):
+    """Take or extend the lease `name` for `ttl` seconds, return whether
+    `owner` holds it. An expired lease is taken over by the next owner."""
+    now = datetime.utcnow()
+    try:
+        db.leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # held by another owner
+        return False
+
+    return True
+
+
+"""
+Operation: asynchronous job operations run by the background workers
+
+- create_operation
+- claim_operation: take the next operation due, or one of a lost worker
+- finish_operation: record the outcome of an attempt
+- get_operation
+    Status can be:
+    - pending: waiting for a worker (again, after a failed attempt)
+    - running: attempted by the worker holding its lease
+    - succeeded, failed: done, with its `result` or `error`
+"""
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+def create_operation(kind, email, params, job_id=None):
+    """Queue an operation of `kind` with its parameters, for the job
+    `job_id` if any."""
+    now = utcnow()
+    operation = {
+        "kind": kind,
+        "email": email,
+        "job_id": ObjectId(job_id) if job_id is not None else None,
+        "params": params,
+        "status": PENDING,
+        "attempts": 0,
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+        "not_before": now,
+    }
+    db.operations.insert_one(operation)
+
+    return operation
+
+
+def claim_operation(owner, ttl):
+    """Take the oldest operation due, or running with an expired lease (its
+    worker died), for `ttl` seconds. Return it with its attempts counted, or
+    None if there is nothing to do."""
+    now = utcnow()
+    return db.operations.find_one_and_update(
+        {
+            "$or": [
+                {"status": PENDING, "not_before": {"$lte": now}},
+                {"status": RUNNING, "lease_expires_at": {"$lt": now}},
+            ]
+        },
+        {
+            "$set": {
+                "status": RUNNING,
+                "owner": owner,
+                "lease_expires_at": now + timedelta(seconds=ttl),
+                "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def finish_operation(
+    operation_id, owner, status, result=None, error=None, retry_at=None
+):
+    """Record the outcome of the attempt of `owner`, back to PENDING until
+    `retry_at` for a retry. Return False if the lease was taken over, the
+    outcome is then ignored."""
+    now = utcnow()
+    fields = {
+        "status": status,
+        "result": result,
+        "error": error,
+        "updated_at": now,
+        "lease_expires_at": None,
+    }
+    if retry_at is not None:
+        fields["not_before"] = retry_at
+    response = db.operations.update_one(
+        {"_id": ObjectId(operation_id), "owner": owner, "status": RUNNING},
+        {"$set": fields},
+    )
+
+    return response.modified_count == 1
+
+
+def get_operation(operation_id):
+    return db.operations.find_one({"_id": ObjectId(operation_id)})
+
+
+"""
+Idempotency key: responses of requests retried with the same key
+
+- begin_idempotent_request: take the key, or get the record of the key
+- complete_idempotent_request: record the response of the request
+- release_idempotent_request: forget the key of a failed request
+"""
+
+
+def begin_idempotent_request(key, fingerprint, owner, ttl, lock_ttl):
+    """Take `key` for a request (`fingerprint` identifies its method, path
+    and payload) run by `owner`, kept for `ttl` seconds. Return None if the
+    request must run, or the record of the key: completed with its
+    response, or in progress. A key in progress for more than `lock_ttl`
+    seconds (its worker died) is taken over."""
+    now = utcnow()
+    lock = {
+        "fingerprint": fingerprint,
+        "owner": owner,
+        "status": "in_progress",
+        "locked_until": now + timedelta(seconds=lock_ttl),
+        "expires_at": now + timedelta(seconds=ttl),
+    }
+    try:
+        db.idempotency_keys.insert_one({"_id": key, **lock})
+        return None
+    except DuplicateKeyError:
+        pass
+
+    record = db.idempotency_keys.find_one_and_update(
+        {
+            "_id": key,
+            "fingerprint": fingerprint,
+            "status": "in_progress",
+            "locked_until": {"$lt": now},
+        },
+        {"$set": lock},
+    )
+    if record is not None:
+        return None
+
+    # the record may have expired in between, then a retry takes the key
+    return db.idempotency_keys.find_one({"_id": key}) or {"status": "in_progress"}
+
+
+def complete_idempotent_request(key, owner, response):
+    """Record the response (status, body, headers) of the request of `key`,
+    unless the key was taken over from `owner` meanwhile."""
+    db.idempotency_keys.update_one(
+        {"_id": key, "owner": owner, "status": "in_progress"},
+        {"$set": {"status": "completed", "response": response}},
+    )
+
+
+def release_idempotent_request(key, owner):
+    db.idempotency_keys.delete_one(
+        {"_id": key, "owner": owner, "status": "in_progress"}
+    )
+
+
+"""
+Transfer: staged (object storage) file transfers of jobs
+
+- create_transfer
+- get_transfer
+"""
+
+
+def create_transfer(task_id, email, job_id, direction, filename):
+    """Record a staged transfer, the firecrest task id is the key.
+
+    Args:
+        direction (str): "upload" or "download"
+    """
+    transfer = {
+        "task_id": task_id,
+        "email": email,
+        "job_id": ObjectId(job_id),
+        "direction": direction,
+        "filename": filename,
+        "created_at": datetime.utcnow(),
+    }
+    db.transfers.insert_one(transfer)
+
+    return transfer
+
+
+def get_transfer(task_id):
+    return db.transfers.find_one({"task_id": task_id})
@@ -1,41 +1,302 @@
+import hashlib
+import io
+import math
 import os
 import pathlib
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
 
 import firecrest as f7t
+import firecrest.BasicClient
 import requests
+from firecrest.FirecrestException import ERROR_HEADERS, UnauthorizedException
 from flask import current_app
+from requests.adapters import HTTPAdapter
+
+from hpc_gateway.cache import MongoTTLCache, SingleFlight, TTLCache
+from hpc_gateway.model import resilience
+
+
+class PooledRequests:
+    """Stand-in for the `requests` module used inside pyfirecrest.
+
+    pyfirecrest calls `requests.get/post/...` directly, which opens a new
+    TCP/TLS connection for every call. Route those calls through one
+    `requests.Session` per process so connections to the firecrest and
+    token endpoints are kept alive and reused.
+    """
+
+    def __init__(self, pool_maxsize=20):
+        self._pool_maxsize = pool_maxsize
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool_maxsize(self):
+        return self._pool_maxsize
+
+    @pool_maxsize.setter
+    def pool_maxsize(self, pool_maxsize):
+        """Resize the pool, the session of this process gets a new adapter
+        (the connections of the previous one are closed once idle)."""
+        with self._lock:
+            if pool_maxsize == self._pool_maxsize:
+                return
+            self._pool_maxsize = pool_maxsize
+            if self._session is not None and self._pid == os.getpid():
+                self._mount(self._session)
+
+    def _mount(self, session):
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self._pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    @property
+    def session(self):
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    session = requests.Session()
+                    self._mount(session)
+                    self._session = session
+                    self._pid = pid
+
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = resilience.current_timeout()
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+pooled_requests = PooledRequests()
+firecrest.BasicClient.requests = pooled_requests
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_clients_pid = None
+
+
+def _digest(secret):
+    return hashlib.sha256(str(secret).encode()).hexdigest()
 
 
 def create_f7t_client():
-    if os.environ.get("DEPLOYMENT", "MC") == "IWM":
+    """Return the process-wide firecrest client of the current deployment.
+
+    Clients are kept in a registry keyed by (deployment, machine, credentials)
+    so the access token and the pooled HTTP connections are shared by every
+    request (and thread) of the worker process.
+    """
+    global _clients_pid
+
+    config = current_app.config
+    deployment = os.environ.get("DEPLOYMENT", "MC")
+    if deployment == "IWM":
+        credentials = (config["F7T_AUTH_URL"], _digest(config["F7T_TOKEN"]))
+    else:
+        credentials = (
+            config["F7T_AUTH_URL"],
+            config["F7T_TOKEN_URL"],
+            config["F7T_CLIENT_ID"],
+            _digest(config["F7T_CLIENT_SECRET"]),
+        )
+    key = (deployment, config["MACHINE"], credentials)
+
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+
+        client = _clients.get(key)
+        if client is None:
+            pooled_requests.pool_maxsize = config["F7T_POOL_MAXSIZE"]
+            client = _clients[key] = _new_f7t_client(deployment, config)
+
+    return client
+
+
+def _new_f7t_client(deployment, config):
+    policy = resilience.ResiliencePolicy.from_config(config)
+    if deployment == "IWM":
         hardcode = HardCodeTokenAuth(
-            token=current_app.config["F7T_TOKEN"],
+            token=config["F7T_TOKEN"],
+        )
+        auth_url = config["F7T_AUTH_URL"]
+        client = Firecrest(
+            firecrest_url=auth_url, authorization=hardcode, policy=policy
         )
-        auth_url = current_app.config["F7T_AUTH_URL"]
-        client = Firecrest(firecrest_url=auth_url, authorization=hardcode)
 
         return client
 
     else:
-        client_id = current_app.config["F7T_CLIENT_ID"]
-        client_secret = current_app.config["F7T_CLIENT_SECRET"]
-        token_url = current_app.config["F7T_TOKEN_URL"]
-        auth_url = current_app.config["F7T_AUTH_URL"]
+        client_id = config["F7T_CLIENT_ID"]
+        client_secret = config["F7T_CLIENT_SECRET"]
+        token_url = config["F7T_TOKEN_URL"]
+        auth_url = config["F7T_AUTH_URL"]
 
         # Create an authorization object with Client Credentials authorization grant
-        keycloak = f7t.ClientCredentialsAuth(
+        keycloak = CachedClientCredentialsAuth(
             client_id,
             client_secret,
             token_url,
+            min_token_validity=config["F7T_TOKEN_MIN_VALIDITY"],
+            refresh_ahead=config["F7T_TOKEN_REFRESH_AHEAD"],
         )
 
         # Setup the client for the specific account
-        client = Firecrest(firecrest_url=auth_url, authorization=keycloak)
+        client = Firecrest(
+            firecrest_url=auth_url, authorization=keycloak, policy=policy
+        )
 
         return client
 
 
+_SIZE_UNITS = {"B": 1, "KB": 2**10, "MB": 2**20, "GB": 2**30}
+
+
+def get_max_file_size(f7t_client):
+    """Size limit (in bytes) of simple upload/download of the firecrest
+    deployment, read once from `parameters()` and kept by the app. While
+    the parameters can not be read no file is staged (no limit): the
+    transfers stay direct as without staging."""
+    limits = current_app.extensions.setdefault("f7t_max_file_size", {})
+    url = f7t_client._firecrest_url
+    if url not in limits:
+        try:
+            parameters = f7t_client.parameters()
+        except Exception as e:
+            current_app.logger.warning(f"Unable to read the firecrest limits: {e}")
+            return math.inf
+
+        limit = current_app.config["F7T_DEFAULT_MAX_FILE_SIZE"]
+        for parameter in parameters.get("utilities", []):
+            if parameter["name"] == "UTILITIES_MAX_FILE_SIZE":
+                unit = _SIZE_UNITS.get(parameter.get("unit", "MB").upper(), 2**20)
+                limit = int(float(parameter["value"]) * unit)
+                break
+        limits[url] = limit
+
+    return limits[url]
+
+
+def start_external_upload(f7t_client, machine, local_path, target_path):
+    """Stage a local file to the machine through object storage.
+
+    The file is pushed to object storage by a background thread and the
+    local copy (and its folder) is removed once done. Return the id of the
+    firecrest task to follow the transfer.
+    """
+    transfer = f7t_client.external_upload(
+        machine=machine, source_path=local_path, target_path=target_path
+    )
+
+    def finish_upload():
+        try:
+            transfer.finish_upload()
+        finally:
+            shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
+
+    threading.Thread(target=finish_upload, daemon=True).start()
+
+    return transfer._task_id
+
+
+def start_external_download(f7t_client, machine, source_path):
+    """Ask firecrest to stage a remote file to object storage, return the
+    id of the task. Once finished the task data is the download URL."""
+    transfer = f7t_client.external_download(machine=machine, source_path=source_path)
+
+    return transfer._task_id
+
+
+def get_transfer_task(f7t_client, task_id):
+    """The firecrest task of a staged transfer (status, description, data)."""
+    return f7t_client._tasks(task_id, [])
+
+
+def get_upload_executor():
+    """Thread pool bounding the concurrent transfers of the worker process."""
+    executor = current_app.extensions.get("upload_executor")
+    if executor is None:
+        executor = current_app.extensions["upload_executor"] = ThreadPoolExecutor(
+            max_workers=current_app.config["FILE_UPLOAD_WORKERS"],
+            thread_name_prefix="transfer",
+        )
+
+    return executor
+
+
+def get_listing_cache():
+    """Short-lived cache of job folder listings of the current app."""
+    extensions = current_app.extensions
+    if "listing_cache" not in extensions:
+        config = current_app.config
+        if config["LISTING_CACHE_BACKEND"] == "mongo":
+            cache = MongoTTLCache("listing_cache", ttl=config["LISTING_CACHE_TTL"])
+        else:
+            cache = TTLCache(
+                maxsize=config["LISTING_CACHE_MAXSIZE"],
+                ttl=config["LISTING_CACHE_TTL"],
+            )
+        extensions["listing_cache"] = cache
+        extensions["listing_flight"] = SingleFlight()
+
+    return extensions["listing_cache"]
+
+
+def list_job_files(f7t_client, machine, remote_folder):
+    """List the files of a job folder through the listing cache.
+
+    Concurrent identical listings of this process trigger a single
+    firecrest call."""
+    cache = get_listing_cache()
+    key = f"{machine}:{remote_folder}"
+    files = cache.get(key)
+    if files is not None:
+        return files
+
+    def list_files():
+        files = f7t_client.list_files(machine=machine, target_path=remote_folder)
+        cache.set(key, files)
+        return files
+
+    return current_app.extensions["listing_flight"].do(key, list_files)
+
+
+def invalidate_job_files(machine, remote_folder):
+    """Forget the cached listing of a job folder after modifying it."""
+    get_listing_cache().pop(f"{machine}:{remote_folder}")
+
+
+def clear_f7t_clients():
+    """Drop all registered clients, e.g. after the configuration changed."""
+    with _clients_lock:
+        _clients.clear()
+
+
 # Create an authorization object with Client Credentials authorization grant
 class HardCodeTokenAuth:
     def __init__(self, token):
@@ -45,41 +306,332 @@ class HardCodeTokenAuth:
         return self._token
 
 
+class CachedClientCredentialsAuth(f7t.ClientCredentialsAuth):
+    """Thread-safe client credentials authorization.
+
+    The access token is reused until `min_token_validity` seconds before it
+    expires. Once it enters the last `refresh_ahead` seconds of its lifetime
+    a single background thread fetches the next token while callers keep
+    using the current one, so requests rarely wait on the token endpoint.
+    """
+
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        token_uri,
+        min_token_validity=30,
+        refresh_ahead=60,
+    ):
+        super().__init__(client_id, client_secret, token_uri, min_token_validity)
+        self._refresh_ahead = refresh_ahead
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _request_token(self):
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": self._client_id,
+            "client_secret": self._client_secret,
+        }
+        resp = pooled_requests.post(self._token_uri, headers=headers, data=data)
+        if not resp.ok:
+            # the body of a failed token request is not always JSON
+            raise UnauthorizedException([resp])
+
+        resp_json = resp.json()
+
+        return resp_json["access_token"], time.time() + resp_json["expires_in"]
+
+    def _refresh(self):
+        try:
+            token, expiration_ts = self._request_token()
+            with self._lock:
+                self._access_token = token
+                self._token_expiration_ts = expiration_ts
+        except Exception:
+            # The current token is still valid, the synchronous path will
+            # retry (and raise) once it is not.
+            pass
+        finally:
+            self._refreshing = False
+
+    def _is_valid(self, now):
+        return (
+            self._access_token is not None
+            and now <= self._token_expiration_ts - self._min_token_validity
+        )
+
+    def get_access_token(self):
+        now = time.time()
+        if self._is_valid(now):
+            if (
+                now > self._token_expiration_ts - self._refresh_ahead
+                and not self._refreshing
+            ):
+                with self._lock:
+                    start = not self._refreshing
+                    self._refreshing = True
+                if start:
+                    threading.Thread(target=self._refresh, daemon=True).start()
+
+            return self._access_token
+
+        with self._lock:
+            if not self._is_valid(time.time()):
+                self._access_token, self._token_expiration_ts = self._request_token()
+
+            return self._access_token
+
+
+# Operations going through the resilience layer, the ones not bound to a
+# machine are guarded by a breaker of the firecrest deployment.
+GUARDED_OPERATIONS = (
+    "checksum",
+    "file_type",
+    "list_files",
+    "mkdir",
+    "mv",
+    "copy",
+    "stat",
+    "simple_download",
+    "simple_delete",
+    "view",
+    "submit",
+    "poll",
+    "poll_active",
+    "cancel",
+    "external_upload",
+    "external_download",
+)
+SERVICE_OPERATIONS = ("_tasks", "all_systems", "parameters")
+
+
+def _guarded(operation, func=None):
+    """Method calling `func` (by default the pyfirecrest implementation of
+    `operation`) through the resilience layer."""
+
+    def method(self, *args, **kwargs):
+        target = (
+            func.__get__(self)
+            if func is not None
+            else getattr(super(Firecrest, self), operation)
+        )
+        if operation in SERVICE_OPERATIONS:
+            name = self._firecrest_url
+        else:
+            name = kwargs["machine"] if "machine" in kwargs else args[0]
+
+        on_retry = None
+        if operation == "simple_download":
+            target_path = kwargs.get("target_path", args[2] if len(args) > 2 else None)
+            on_retry = _rewind(target_path)
+
+        return resilience.call(
+            name, operation, target, self.policy, args, kwargs, on_retry=on_retry
+        )
+
+    method.__name__ = operation
+    method.__doc__ = (func or getattr(f7t.Firecrest, operation)).__doc__
+    return method
+
+
+def _rewind(target):
+    """Callback restoring a download target stream before a retry."""
+    if not hasattr(target, "seek"):
+        return None
+
+    position = target.tell()
+
+    def rewind():
+        target.seek(position)
+        target.truncate()
+
+    return rewind
+
+
 class Firecrest(f7t.Firecrest):
+    """Firecrest client safe to share between threads.
+
+    pyfirecrest keeps the responses of the ongoing call in
+    `_current_method_requests`, make it thread local.
+
+    Remote operations go through the resilience layer of `policy`
+    (timeouts, retries, circuit breakers and bulkheads, see `resilience`)."""
+
+    def __init__(self, *args, policy=None, **kwargs):
+        self._local = threading.local()
+        self.policy = policy or resilience.ResiliencePolicy()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def _current_method_requests(self):
+        if not hasattr(self._local, "responses"):
+            self._local.responses = []
+        return self._local.responses
+
+    @_current_method_requests.setter
+    def _current_method_requests(self, value):
+        self._local.responses = value
+
     def simple_upload(self, machine, source_path, target_path, filename):
         """Blocking call to upload a small file.
         The file that will be uploaded will have the same name as the source_path.
         The maximum size of file that is allowed can be found from the parameters() call.
-        :param source_path: binary stream
-        :type source_path: binary stream
+        The multipart body is streamed, the file is never held in memory as a whole.
+        :param source_path: the source path of the file, bytes or binary stream
+        :type source_path: string, bytes or binary stream
         :param target_path: the absolute target path of the directory where the file will be uploaded
         :type target_path: string
         :calls: POST `/utilities/upload`
         :rtype: None
         """
-        # This method is implemented to pyfirecrest, but not release yet.
-        # THis part can be removed after bump pyfirecrest version to 1.3.0.
+        # pyfirecrest (also from 1.3.0 on) lets requests build the multipart
+        # body in memory, which costs twice the file size per upload.
 
         url = f"{self._firecrest_url}/utilities/upload"
+        if isinstance(source_path, (str, pathlib.PurePath)):
+            context = open(source_path, "rb")
+        elif isinstance(source_path, (bytes, bytearray)):
+            context = nullcontext(io.BytesIO(source_path))
+        else:
+            context = nullcontext(source_path)
+
+        with context as f:
+            # Set filename
+            if filename is None:
+                filename = os.path.basename(getattr(f, "name", "file"))
+            body = MultipartStream({"targetPath": target_path}, "file", filename, f)
+            headers = {
+                "Authorization": f"Bearer {self._authorization.get_access_token()}",
+                "X-Machine-Name": machine,
+                "Content-Type": body.content_type,
+            }
+            resp = pooled_requests.post(
+                url=url, headers=headers, data=body, verify=self._verify
+            )
+
+        self._json_response([resp], 201)
+
+    simple_upload = _guarded("simple_upload", simple_upload)
+
+    def stream_download(self, machine, source_path, byte_range=None):
+        """Start downloading a file and return the response without reading
+        its body, the caller iterates over `iter_content` and closes it.
+
+        :param byte_range: (start, stop) to ask firecrest for a slice only,
+            firecrest may ignore it and answer 200 with the whole file.
+        :type byte_range: tuple, optional
+        :calls: GET `/utilities/download`
+        :rtype: requests.Response
+        """
+        url = f"{self._firecrest_url}/utilities/download"
         headers = {
             "Authorization": f"Bearer {self._authorization.get_access_token()}",
             "X-Machine-Name": machine,
         }
-        context = (
-            open(source_path, "rb")
-            if isinstance(source_path, str)
-            or isinstance(source_path, pathlib.PosixPath)
-            else nullcontext(source_path)
+        if byte_range is not None:
+            headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1] - 1}"
+        params = {"sourcePath": source_path}
+        resp = pooled_requests.get(
+            url=url, headers=headers, params=params, verify=self._verify, stream=True
         )
+        if resp.status_code not in (200, 206) or any(
+            h in resp.headers for h in ERROR_HEADERS
+        ):
+            # raise the proper firecrest exception
+            self._json_response([resp], 200)
 
-        with context as f:
-            # Set filename
-            if filename is not None:
-                f = (filename, f)
-            data = {"targetPath": target_path}
-            files = {"file": f}
-            resp = requests.post(
-                url=url, headers=headers, data=data, files=files, verify=self._verify
-            )
+        return resp
 
-        self._json_response([resp], 201)
+    stream_download = _guarded("stream_download", stream_download)
+
+
+for operation in GUARDED_OPERATIONS + SERVICE_OPERATIONS:
+    setattr(Firecrest, operation, _guarded(operation))
+
+
+# escapes of a form-data parameter value, as the HTML5 form encoding of
+# urllib3: a quote or a line break can not end the value or the header
+_FORM_PARAM_ESCAPES = {
+    ord('"'): "%22",
+    ord("\\"): "\\\\",
+    **{code: f"%{code:02X}" for code in range(0x20) if code != 0x1B},
+}
+
+
+class MultipartStream:
+    """File-like `multipart/form-data` body read chunk by chunk.
+
+    The form fields are encoded up front, the file part is read from
+    `fileobj` (from its current position) only while the body is sent, so
+    the memory footprint does not depend on the file size. The length is
+    known in advance, so requests sends a `Content-Length` header.
+    """
+
+    def __init__(self, fields, file_field, filename, fileobj, chunk_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.chunk_size = chunk_size
+
+        head = b""
+        for name, value in fields.items():
+            head += (
+                f"--{self.boundary}\r\n"
+                "Content-Disposition: form-data; "
+                f'name="{name.translate(_FORM_PARAM_ESCAPES)}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode()
+        head += (
+            f"--{self.boundary}\r\n"
+            "Content-Disposition: form-data; "
+            f'name="{file_field.translate(_FORM_PARAM_ESCAPES)}"; '
+            f'filename="{filename.translate(_FORM_PARAM_ESCAPES)}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        file_size = fileobj.tell() - position
+        fileobj.seek(position)
+
+        self._length = len(head) + file_size + len(tail)
+        self._parts = iter([head, fileobj, tail])
+        self._current = None
+        self._buffer = b""
+
+    def __len__(self):
+        return self._length
+
+    def _next_chunk(self):
+        while True:
+            if self._current is None:
+                self._current = next(self._parts, None)
+                if self._current is None:
+                    return b""
+                if isinstance(self._current, bytes):
+                    chunk, self._current = self._current, None
+                    return chunk
+
+            chunk = self._current.read(self.chunk_size)
+            if chunk:
+                return chunk
+            self._current = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._buffer + b"".join(iter(self._next_chunk, b""))
+
+        while len(self._buffer) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self._buffer += chunk
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b"")
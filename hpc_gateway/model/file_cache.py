@@ -0,0 +1,111 @@
+"""Local disk cache of downloaded job files.
+
+Entries are keyed by (job, path, remote size, remote mtime), so a changed
+remote file simply maps to a new entry while the stale one ages out. The
+modification time of an entry on disk records its last access, the least
+recently used entries are evicted once the byte budget is exceeded. The
+cache directory may be shared by all the worker processes: entries are
+handed out as open files, which stay readable when another process evicts
+them meanwhile.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+from flask import current_app
+
+_TMP_PREFIX = ".tmp-"
+
+
+class FileCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(job_id, path, size, mtime):
+        return hashlib.sha256(f"{job_id}:{path}:{size}:{mtime}".encode()).hexdigest()
+
+    def get(self, key):
+        """The cached file opened for reading or None, mark it as recently
+        used."""
+        path = os.path.join(self.directory, key)
+        try:
+            fh = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        os.utime(fh.fileno())
+        return fh
+
+    def put(self, key, chunks):
+        """Write the chunks to the cache and return the entry opened for
+        reading.
+
+        The file is written aside and moved in place once complete, readers
+        never see a partial entry. A file larger than the whole budget is
+        not kept, only the returned file can be read."""
+        fd, tmp_path = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=self.directory)
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    size += len(chunk)
+            fh = open(tmp_path, "rb")
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return fh
+
+        os.replace(tmp_path, os.path.join(self.directory, key))
+        self.evict(keep=key)
+        return fh
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until within the byte budget,
+        never the entry `keep` (just written)."""
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.startswith(_TMP_PREFIX) or not entry.is_file():
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    total += stat.st_size
+                    if entry.name != keep:
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+def get_file_cache():
+    """The download cache of the current app, None if FILE_CACHE_DIR is unset."""
+    directory = current_app.config["FILE_CACHE_DIR"]
+    if not directory:
+        return None
+
+    max_bytes = current_app.config["FILE_CACHE_MAX_BYTES"]
+    cache = current_app.extensions.get("file_cache")
+    if cache is None or (cache.directory, cache.max_bytes) != (directory, max_bytes):
+        cache = current_app.extensions["file_cache"] = FileCache(directory, max_bytes)
+
+    return cache
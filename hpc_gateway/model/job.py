@@ -1,23 +1,234 @@
 """Job scripts and singularity
+
+The job script templates are compiled once per process by the
+`TemplateRegistry` (with a persistent bytecode cache if
+JOB_TEMPLATES_CACHE_DIR is set), rendering a script is an in-memory
+operation. The template of a script is selected per machine and partition
+by JOB_TEMPLATES.
 """
-from jinja2 import Environment, FileSystemLoader
+import itertools
+import math
+import os
+import re
+import shlex
+
+from flask import current_app, has_app_context
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, meta
+
+from hpc_gateway.config import Config
+
+JOB_SCRIPT_FILENAME = "job.sh"
+# folder of a task of a sweep in the job folder, created by the job script
+SWEEP_TASK_FOLDER = "task-{index}"
+# the sweep parameters are exported as environment variables
+SWEEP_PARAMETER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# job states reported by a task farm, one "<jobid> <state>" line per change
+FARM_STATES_FILENAME = "farm_states"
+# output of a job run in a task farm, in its job folder
+FARM_OUTPUT_FILENAME = "farm.out"
+TEMPLATE_EXTENSION = "j2"
+
+
+class TemplateRegistry:
+    """The compiled job templates of a directory and their variables.
+
+    selection: `{kind: {key: template name}}` where the key is
+    "<machine>:<partition>", "<machine>" or "*", tried in this order.
+    """
+
+    def __init__(self, directory, selection, cache_dir=None):
+        self.selection = selection
+        bytecode_cache = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        self.environment = Environment(
+            loader=FileSystemLoader(directory),
+            bytecode_cache=bytecode_cache,
+            auto_reload=False,
+        )
+        self.environment.filters["quote"] = lambda value: shlex.quote(str(value))
+
+        self.templates = {}
+        self.variables = {}
+        for name in self.environment.list_templates(extensions=[TEMPLATE_EXTENSION]):
+            source, _, _ = self.environment.loader.get_source(self.environment, name)
+            self.variables[name] = meta.find_undeclared_variables(
+                self.environment.parse(source)
+            )
+            self.templates[name] = self.environment.get_template(name)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config["JOB_TEMPLATES_DIR"],
+            config["JOB_TEMPLATES"],
+            cache_dir=config["JOB_TEMPLATES_CACHE_DIR"],
+        )
+
+    def select(self, kind, machine=None, partition=None):
+        """Name of the template of `kind` ("job", "farm") for the machine and
+        partition."""
+        templates = self.selection[kind]
+        for key in (f"{machine}:{partition}", machine, "*"):
+            if key in templates:
+                return templates[key]
+
+        raise ValueError(f"no {kind} template for {machine}:{partition}")
 
-environment = Environment(loader=FileSystemLoader("templates/"))
+    def render(self, name, options=None, **context):
+        """Render the template `name`, `options` are the optional parameters
+        given by the user: raise ValueError if the template does not use
+        them."""
+        options = options or {}
+        unknown = set(options) - self.variables[name]
+        if unknown:
+            raise ValueError(
+                f"unknown parameters {', '.join(sorted(unknown))} of template {name}"
+            )
+
+        return self.templates[name].render(**context, **options)
+
+
+_default_registry = None
+
+
+def get_template_registry():
+    """The template registry of the current app, or the one of the default
+    configuration outside of an app."""
+    global _default_registry
+    if not has_app_context():
+        if _default_registry is None:
+            _default_registry = TemplateRegistry.from_config(vars(Config))
+        return _default_registry
+
+    registry = current_app.extensions.get("job_templates")
+    if registry is None:
+        registry = TemplateRegistry.from_config(current_app.config)
+        current_app.extensions["job_templates"] = registry
+
+    return registry
+
+
+def init_job_templates(app):
+    """Compile the job templates with the first request of a worker process,
+    once the configuration is loaded."""
+
+    @app.before_first_request
+    def load_job_templates():
+        app.extensions["job_templates"] = TemplateRegistry.from_config(app.config)
 
 
 def create_job_script(
-    job_name, image, email, partition, ntasks_per_node, executable_cmd
+    job_name,
+    image,
+    email,
+    partition,
+    ntasks_per_node,
+    executable_cmd,
+    sweep_tasks=None,
+    machine=None,
+    **options,
 ) -> str:
-    """The content of the job script"""
-    template = environment.get_template("cscs_job_script.j2")
+    """The content of the job script.
+
+    sweep_tasks: the parameters (dict) of every task of a parameter sweep,
+    the script is then a SLURM job array whose task `i` runs in its own
+    folder with the parameters of `sweep_tasks[i]` as environment variables.
+    machine: the template is selected for the machine and partition.
+    options: further parameters of the selected template.
 
-    content = template.render(
+    Raise ValueError for invalid parameters.
+    """
+    if not isinstance(ntasks_per_node, int) or ntasks_per_node < 1:
+        raise ValueError(f"invalid ntasks_per_node {ntasks_per_node!r}")
+
+    registry = get_template_registry()
+    name = registry.select("job", machine, partition)
+
+    sweep_parameters = {}
+    for index, task in enumerate(sweep_tasks or []):
+        for key, value in task.items():
+            sweep_parameters.setdefault(key, [""] * len(sweep_tasks))[index] = value
+
+    return registry.render(
+        name,
+        options=options,
         job_name=job_name,
         email=email,
         ntasks_per_node=ntasks_per_node,
         partition=partition,
         image=image,
         executable_cmd=executable_cmd,
+        array_size=len(sweep_tasks or []),
+        sweep_parameters=sweep_parameters,
+        task_folder=SWEEP_TASK_FOLDER.format(index="$SLURM_ARRAY_TASK_ID"),
+    )
+
+
+def create_farm_script(
+    job_name, image, partition, ntasks_per_node, time_limit, jobs, machine=None
+) -> str:
+    """The content of the script of a task farm: one allocation of
+    `ntasks_per_node` tasks running the packed `jobs` concurrently.
+
+    jobs: `jobid`, `remote_folder`, `ntasks_per_node` and `executable_cmd` of
+    every packed job, a job runs in its own folder as a job step and its
+    state is reported in FARM_STATES_FILENAME of the farm folder.
+    """
+    registry = get_template_registry()
+
+    return registry.render(
+        registry.select("farm", machine, partition),
+        job_name=job_name,
+        image=image,
+        partition=partition,
+        ntasks_per_node=ntasks_per_node,
+        time_limit=time_limit,
+        jobs=jobs,
+        states_file=FARM_STATES_FILENAME,
+        output_file=FARM_OUTPUT_FILENAME,
     )
 
-    return content
+
+def expand_sweep(parameters, max_tasks=None):
+    """The tasks of a parameter grid `{name: [values]}`: one dict per
+    combination of the values, the last parameter varying fastest."""
+    if not isinstance(parameters, dict) or not parameters:
+        raise ValueError("the sweep needs a grid of parameters")
+    for name, values in parameters.items():
+        if not SWEEP_PARAMETER_PATTERN.match(name):
+            raise ValueError(f"invalid sweep parameter name {name!r}")
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"sweep parameter {name} needs a list of values")
+
+    size = math.prod(len(values) for values in parameters.values())
+    if max_tasks is not None and size > max_tasks:
+        raise ValueError(f"{size} tasks in the sweep, at most {max_tasks}")
+
+    names = list(parameters)
+    return [
+        dict(zip(names, combination))
+        for combination in itertools.product(*parameters.values())
+    ]
+
+
+def upload_job_script(f7t_client, machine, remote_folder, job_script):
+    """Create the job folder (if missing) and upload the job script to it."""
+    f7t_client.mkdir(machine=machine, target_path=remote_folder, p=True)
+    f7t_client.simple_upload(
+        machine=machine,
+        source_path=job_script.encode(),
+        target_path=remote_folder,
+        filename=JOB_SCRIPT_FILENAME,
+    )
+
+
+def submit_job_script(f7t_client, machine, remote_folder):
+    """Submit the job script of the job folder, return the SLURM job id."""
+    response = f7t_client.submit(
+        machine=machine,
+        job_script=os.path.join(remote_folder, JOB_SCRIPT_FILENAME),
+        local_file=False,
+    )
+    return response.get("jobid")
@@ -0,0 +1,220 @@
+"""Asynchronous job operations run by a pool of background workers.
+
+An operation (create or launch a job) is queued in the operations
+collection by the API, which answers `202 Accepted` right away. The
+workers of every process claim the operations due with a lease, run the
+firecrest work and record the outcome (status, attempts, result, error),
+so the request latency does not depend on the cluster. An operation whose
+worker died is claimed again once its lease expires, failed attempts are
+retried with backoff as long as the operation can safely be repeated.
+"""
+import os
+import random
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+from flask import current_app
+from pymongo.errors import DuplicateKeyError
+
+from hpc_gateway.model.database import (
+    FAILED,
+    PENDING,
+    SUCCEEDED,
+    begin_job_submission,
+    claim_operation,
+    create_job,
+    finish_operation,
+    get_job,
+    release_job_submission,
+    update_job,
+    utcnow,
+)
+from hpc_gateway.model.f7t import create_f7t_client
+from hpc_gateway.model.job import submit_job_script, upload_job_script
+from hpc_gateway.model.resilience import RejectedError, is_transient
+
+CREATE_JOB = "create_job"
+LAUNCH_JOB = "launch_job"
+
+
+class SubmissionUnknownError(Exception):
+    """raised when the job of a launch may have been submitted already, by
+    a worker which died or timed out while submitting, or is launched by a
+    request or in a task farm."""
+
+
+def run_create_job(operation):
+    """Create the job folder and script, then record the job with the id
+    given at queuing: a repeated attempt creates no second job."""
+    params = operation["params"]
+    upload_job_script(
+        create_f7t_client(),
+        params["machine"],
+        params["remote_folder"],
+        params["job_script"],
+    )
+    try:
+        create_job(
+            user_id=params["user_id"],
+            remote_folder=params["remote_folder"],
+            job_id=operation["job_id"],
+            params=params.get("job_params"),
+        )
+    except DuplicateKeyError:
+        # recorded by a previous attempt
+        pass
+
+    return {"jobid": str(operation["job_id"])}
+
+
+def run_launch_job(operation):
+    """Submit the job script, unless a previous attempt already did.
+
+    The job is marked before it is submitted: an attempt finding the mark
+    (its worker died or timed out meanwhile) fails instead of submitting
+    the job a second time."""
+    job = get_job(operation["job_id"])
+    if job.get("f7t_job_id"):
+        return {"jobid": str(job["_id"]), "f7t_job_id": job["f7t_job_id"]}
+
+    if not begin_job_submission(job["_id"], operation["_id"]):
+        raise SubmissionUnknownError(
+            f"Job {job['_id']} is launched otherwise or by a lost attempt."
+        )
+
+    machine = operation["params"]["machine"]
+    try:
+        f7t_job_id = submit_job_script(
+            create_f7t_client(), machine, job["remote_folder"]
+        )
+    except Exception as e:
+        if isinstance(e, RejectedError) or not is_transient(e):
+            # not attempted or refused, the launch can be retried
+            release_job_submission(job["_id"])
+        raise
+    update_job(job_id=job["_id"], f7t_job_id=f7t_job_id, machine=machine)
+
+    return {"jobid": str(job["_id"]), "f7t_job_id": f7t_job_id}
+
+
+OPERATION_HANDLERS = {
+    CREATE_JOB: run_create_job,
+    LAUNCH_JOB: run_launch_job,
+}
+
+# Operations repeated after a transient failure, a submission is only
+# repeated when it was not attempted (the job may have been submitted).
+RETRIED_ON_TRANSIENT = {CREATE_JOB}
+
+
+def is_retryable(kind, error):
+    if isinstance(error, RejectedError):
+        return True
+    return kind in RETRIED_ON_TRANSIENT and is_transient(error)
+
+
+def run_operation(operation, owner):
+    """Run a claimed operation and record its outcome, return its status."""
+    config = current_app.config
+    kind = operation["kind"]
+    attempts = operation["attempts"]
+    if attempts > config["OPERATION_MAX_ATTEMPTS"]:
+        # claimed again after its workers died
+        finish_operation(
+            operation["_id"], owner, FAILED, error="Too many attempts, worker lost."
+        )
+        return FAILED
+
+    try:
+        result = OPERATION_HANDLERS[kind](operation)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if is_retryable(kind, e) and attempts < config["OPERATION_MAX_ATTEMPTS"]:
+            delay = getattr(e, "retry_after", 0) or random.uniform(
+                0, config["OPERATION_RETRY_BACKOFF"] * 2**attempts
+            )
+            finish_operation(
+                operation["_id"],
+                owner,
+                PENDING,
+                error=error,
+                retry_at=utcnow() + timedelta(seconds=delay),
+            )
+            return PENDING
+
+        current_app.logger.warning(f"Operation {operation['_id']} failed: {error}")
+        finish_operation(operation["_id"], owner, FAILED, error=error)
+        return FAILED
+
+    finish_operation(operation["_id"], owner, SUCCEEDED, result=result)
+    return SUCCEEDED
+
+
+class OperationWorkers:
+    def __init__(self, app, threads):
+        self.app = app
+        self.threads = threads
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._wake = threading.Condition()
+
+    def start(self):
+        for index in range(self.threads):
+            threading.Thread(
+                target=self._run, name=f"operation-worker-{index}", daemon=True
+            ).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.notify(all=True)
+
+    def notify(self, all=False):
+        """Wake up an idle worker, e.g. for an operation just queued."""
+        with self._wake:
+            if all:
+                self._wake.notify_all()
+            else:
+                self._wake.notify()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    done = self.run_once()
+                except Exception:
+                    self.app.logger.exception("Operation worker failed.")
+                    done = False
+            if not done:
+                with self._wake:
+                    self._wake.wait(self.app.config["OPERATION_POLL_INTERVAL"])
+
+    def run_once(self):
+        """Claim and run one operation, return whether there was one."""
+        operation = claim_operation(
+            self.owner, ttl=current_app.config["OPERATION_LEASE_TTL"]
+        )
+        if operation is None:
+            return False
+
+        run_operation(operation, self.owner)
+        return True
+
+
+def get_operation_workers():
+    """The operation workers of this process, None if not running."""
+    return current_app.extensions.get("operation_workers")
+
+
+def init_operation_workers(app):
+    """Start OPERATION_WORKERS threads with the first request of a worker
+    process (never in a preloading master process)."""
+
+    @app.before_first_request
+    def start_operation_workers():
+        if app.config["OPERATION_WORKERS"]:
+            app.extensions["operation_workers"] = OperationWorkers(
+                app, app.config["OPERATION_WORKERS"]
+            ).start()
@@ -0,0 +1,244 @@
+"""Background packer of small jobs into task farms.
+
+Jobs launched with packing are QUEUED in the DB. Every
+`JOB_PACKER_INTERVAL` seconds the queued jobs are grouped per (machine,
+image, partition), a group is launched as a task farm once it has
+`JOB_PACKER_MAX_JOBS` jobs or its oldest job waited `JOB_PACKER_MAX_WAIT`
+seconds: one SLURM job whose script runs the packed jobs concurrently as
+job steps, each in its own job folder. The state of every packed job is
+read back from the states file of the farm. A lease in the DB makes a
+single worker process pack at a time.
+"""
+import os
+import socket
+import threading
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from hpc_gateway.model.database import (
+    ACTIVATED,
+    TERMINAL_STATES,
+    acquire_lease,
+    activate_farm,
+    claim_queued_jobs,
+    create_farm,
+    get_active_farms,
+    get_jobs_by_ids,
+    get_queued_jobs,
+    release_farm,
+    set_job_states,
+    update_farm,
+    utcnow,
+)
+from hpc_gateway.model.f7t import create_f7t_client
+from hpc_gateway.model.job import (
+    FARM_STATES_FILENAME,
+    create_farm_script,
+    submit_job_script,
+    upload_job_script,
+)
+from hpc_gateway.model.resilience import RejectedError, is_transient
+from hpc_gateway.model.tracker import poll_job_states
+
+LEASE_NAME = "job_packer"
+FARMS_FOLDER = "farms"
+
+
+def parse_farm_states(content):
+    """Last state of every job in the states file of a farm."""
+    states = {}
+    for line in content.splitlines():
+        job_id, _, state = line.strip().partition(" ")
+        if job_id and state:
+            states[job_id] = state
+
+    return states
+
+
+class JobPacker:
+    def __init__(self, app):
+        self.app = app
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="job-packer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.app.config["JOB_PACKER_INTERVAL"]):
+            with self.app.app_context():
+                try:
+                    self.run_once()
+                except Exception:
+                    self.app.logger.exception("Job packing failed.")
+
+    def run_once(self):
+        """One packing round, return the number of farms submitted."""
+        config = current_app.config
+        if not acquire_lease(
+            LEASE_NAME, self.owner, ttl=3 * config["JOB_PACKER_INTERVAL"]
+        ):
+            return 0
+
+        f7t_client = create_f7t_client()
+        submitted = self.pack_queued_jobs(f7t_client)
+        self.collect_farm_states(f7t_client)
+
+        return submitted
+
+    def pack_queued_jobs(self, f7t_client):
+        """Launch the groups of queued jobs which are due as task farms."""
+        config = current_app.config
+        max_jobs = config["JOB_PACKER_MAX_JOBS"]
+        due = utcnow() - timedelta(seconds=config["JOB_PACKER_MAX_WAIT"])
+
+        groups = defaultdict(list)
+        for job in get_queued_jobs():
+            params = job["params"]
+            groups[(job["machine"], params["image"], params["partition"])].append(job)
+
+        submitted = 0
+        for key, jobs in groups.items():
+            # in queuing order, the first job waited the longest
+            if len(jobs) < max_jobs and jobs[0]["queued_at"] > due:
+                continue
+            for start in range(0, len(jobs), max_jobs):
+                try:
+                    farm = self.submit_farm(
+                        f7t_client, *key, jobs[start : start + max_jobs]
+                    )
+                except Exception as e:
+                    current_app.logger.warning(f"Unable to submit farm {key}: {e}")
+                    break
+                if farm is not None:
+                    submitted += 1
+
+        return submitted
+
+    def submit_farm(self, f7t_client, machine, image, partition, jobs):
+        """Submit the jobs still queued as a farm, return the farm (None if
+        all were cancelled meanwhile).
+
+        The jobs are claimed and the farm recorded before the submission: a
+        farm is submitted once, its jobs are queued again only if it was
+        certainly not submitted."""
+        config = current_app.config
+        farm_id = ObjectId()
+        remote_folder = os.path.join(config["CLUSTER_HOME"], FARMS_FOLDER, str(farm_id))
+        jobs = claim_queued_jobs(farm_id, [job["_id"] for job in jobs])
+        if not jobs:
+            return None
+
+        farm = create_farm(
+            farm_id, machine, remote_folder, [job["_id"] for job in jobs]
+        )
+        farm_jobs = [
+            {
+                "jobid": str(job["_id"]),
+                "remote_folder": job["remote_folder"],
+                "ntasks_per_node": job["params"]["ntasks_per_node"],
+                "executable_cmd": job["params"]["executable_cmd"],
+            }
+            for job in jobs
+        ]
+        farm_script = create_farm_script(
+            job_name=f"farm-{farm_id}",
+            image=image,
+            partition=partition,
+            # a job larger than the farm would never run
+            ntasks_per_node=max(
+                [config["JOB_PACKER_NTASKS"]]
+                + [job["ntasks_per_node"] for job in farm_jobs]
+            ),
+            time_limit=config["JOB_PACKER_TIME_LIMIT"],
+            jobs=farm_jobs,
+            machine=machine,
+        )
+        try:
+            upload_job_script(f7t_client, machine, remote_folder, farm_script)
+        except Exception:
+            release_farm(farm_id)
+            raise
+        try:
+            f7t_job_id = submit_job_script(f7t_client, machine, remote_folder)
+        except Exception as e:
+            if isinstance(e, RejectedError) or not is_transient(e):
+                # not attempted or refused, the jobs are packed again
+                release_farm(farm_id)
+            else:
+                # the farm may run: its jobs stay PACKING, never submitted again
+                current_app.logger.error(
+                    f"Farm {farm_id} may have been submitted, its jobs are kept."
+                )
+            raise
+        activate_farm(farm_id, f7t_job_id)
+        farm.update(f7t_job_id=f7t_job_id, state=ACTIVATED)
+
+        return farm
+
+    def collect_farm_states(self, f7t_client):
+        """Poll the SLURM state of the farms and record the state of their
+        jobs from the states file of the started farms. Jobs without a final
+        state in a finished farm take the state of the farm (FAILED if the
+        farm completed)."""
+        farms = {farm["_id"]: farm for farm in get_active_farms()}
+        for farm_id, _, state in poll_job_states(f7t_client, farms.values()):
+            update_farm(farm_id, state=state)
+            farms[farm_id]["state"] = state
+
+        for farm in farms.values():
+            if farm["state"] in (ACTIVATED, "PENDING"):
+                # not started, no states file yet
+                continue
+
+            finished = farm["state"] in TERMINAL_STATES
+            try:
+                content = f7t_client.view(
+                    farm["machine"],
+                    os.path.join(farm["remote_folder"], FARM_STATES_FILENAME),
+                )
+            except Exception as e:
+                current_app.logger.warning(
+                    f"Unable to read the states of farm {farm['_id']}: {e}"
+                )
+                # a farm which ended before any job started has no states file
+                if not finished or is_transient(e):
+                    continue
+                content = ""
+
+            states = parse_farm_states(content)
+            transitions = []
+            for job in get_jobs_by_ids(farm["job_ids"], fields=["state"]):
+                if job["state"] in TERMINAL_STATES:
+                    continue
+                state = states.get(str(job["_id"]))
+                if finished and state not in TERMINAL_STATES:
+                    state = "FAILED" if farm["state"] == "COMPLETED" else farm["state"]
+                if state and state != job["state"]:
+                    transitions.append((job["_id"], job["state"], state))
+
+            set_job_states(transitions)
+            if finished:
+                update_farm(farm["_id"], collected=True)
+
+
+def init_job_packer(app):
+    """Start the packer with the first request of a worker process (never
+    in a preloading master process), if JOB_PACKER_ENABLED."""
+
+    @app.before_first_request
+    def start_job_packer():
+        if app.config["JOB_PACKER_ENABLED"]:
+            app.extensions["job_packer"] = JobPacker(app).start()
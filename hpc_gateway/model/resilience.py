@@ -0,0 +1,408 @@
+"""Resilience of the calls to firecrest: timeouts, retries, circuit breakers
+and bulkheads.
+
+- every operation runs with its own (socket) timeout,
+- idempotent operations are retried on transient failures with jittered
+  exponential backoff,
+- a circuit breaker per machine opens after consecutive transient failures
+  and rejects calls right away (`CircuitOpenError`) until a trial call
+  succeeds after `reset_timeout` seconds,
+- a bulkhead per machine and operation class caps the calls in flight,
+  callers queue for a bounded time and are rejected (`BulkheadFullError`)
+  when the queue is full, instead of piling up on the firecrest rate limit.
+  A streamed download holds its slot until its response is closed.
+"""
+import random
+import threading
+import time
+
+import requests
+from firecrest.FirecrestException import FirecrestException
+
+# Operations that can be repeated without changing the result.
+IDEMPOTENT_OPERATIONS = {
+    "_tasks",
+    "all_systems",
+    "checksum",
+    "file_type",
+    "list_files",
+    "parameters",
+    "poll",
+    "poll_active",
+    "simple_download",
+    "stat",
+    "stream_download",
+    "view",
+}
+
+# Operation classes sharing a bulkhead, the other operations are "listing".
+OPERATION_CLASSES = {
+    "simple_upload": "transfer",
+    "simple_download": "transfer",
+    "stream_download": "transfer",
+    "external_upload": "transfer",
+    "external_download": "transfer",
+    "mv": "transfer",
+    "copy": "transfer",
+    "submit": "submit",
+    "cancel": "submit",
+    "poll": "submit",
+    "poll_active": "submit",
+}
+
+# Operations returning a response whose body is read by the caller, the
+# bulkhead slot is released when the response is closed.
+STREAMED_OPERATIONS = {"stream_download"}
+
+# firecrest reports these as errors although the request may succeed later
+TRANSIENT_ERROR_HEADERS = {"X-Machine-Not-Available", "X-Timeout"}
+
+
+class RejectedError(Exception):
+    """raised when a call is not attempted to protect firecrest."""
+
+    retry_after = 1
+
+
+class CircuitOpenError(RejectedError):
+    """raised when calls to a machine are rejected by its circuit breaker."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit of {name} is open, retry in {retry_after:.0f}s.")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BulkheadFullError(RejectedError):
+    """raised when too many calls of a class are in flight for a machine."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Too many concurrent {name} calls.")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def is_transient(error):
+    """Whether an error tells that firecrest (or the machine) is unhealthy,
+    in opposition to an error of the request itself, e.g. a missing file."""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+
+    if isinstance(error, FirecrestException) and error.responses:
+        response = error.responses[-1]
+        if response.status_code >= 500:
+            return True
+        return any(h in response.headers for h in TRANSIENT_ERROR_HEADERS)
+
+    return False
+
+
+class ResiliencePolicy:
+    """Settings of the resilience layer, read from the app config once."""
+
+    def __init__(
+        self,
+        timeouts=None,
+        default_timeout=30,
+        retries=2,
+        backoff_base=0.5,
+        backoff_max=8,
+        failure_threshold=5,
+        reset_timeout=30,
+        bulkhead_limits=None,
+        bulkhead_max_queue=32,
+        bulkhead_max_wait=5,
+    ):
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.bulkhead_limits = bulkhead_limits or {}
+        self.bulkhead_max_queue = bulkhead_max_queue
+        self.bulkhead_max_wait = bulkhead_max_wait
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            timeouts=config["F7T_TIMEOUTS"],
+            default_timeout=config["F7T_DEFAULT_TIMEOUT"],
+            retries=config["F7T_RETRIES"],
+            backoff_base=config["F7T_BACKOFF_BASE"],
+            backoff_max=config["F7T_BACKOFF_MAX"],
+            failure_threshold=config["F7T_BREAKER_FAILURE_THRESHOLD"],
+            reset_timeout=config["F7T_BREAKER_RESET_TIMEOUT"],
+            bulkhead_limits=config["F7T_BULKHEAD_LIMITS"],
+            bulkhead_max_queue=config["F7T_BULKHEAD_MAX_QUEUE"],
+            bulkhead_max_wait=config["F7T_BULKHEAD_MAX_WAIT"],
+        )
+
+    def timeout(self, operation):
+        return self.timeouts.get(operation, self.default_timeout)
+
+    def backoff(self, attempt):
+        """Full jitter: uniform in [0, min(max, base * 2**attempt)]."""
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2**attempt)
+        )
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call must not go through."""
+        with self._lock:
+            self.calls += 1
+            if self.state == self.CLOSED:
+                return
+
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed >= self.reset_timeout and not self._trial_running:
+                # let a single trial call probe the machine
+                self.state = self.HALF_OPEN
+                self._trial_running = True
+                return
+
+            self.rejected += 1
+            raise CircuitOpenError(self.name, max(self.reset_timeout - elapsed, 1))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self._trial_running = False
+            if (
+                self.state == self.HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_ignored(self):
+        """The call failed for a reason unrelated to the machine health."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+            self._trial_running = False
+            self.consecutive_failures = 0
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "opened": self.opened,
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, policy):
+    """The process-wide circuit breaker of a machine."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=policy.failure_threshold,
+                reset_timeout=policy.reset_timeout,
+            )
+
+    return breaker
+
+
+def breaker_stats():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+
+    return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+class Bulkhead:
+    """Cap the calls in flight, with a bounded queue and waiting time."""
+
+    def __init__(self, name, limit=8, max_queue=32, max_wait=5):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return
+
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise BulkheadFullError(self.name, self.max_wait)
+
+            self.waiting += 1
+            try:
+                acquired = self._condition.wait_for(
+                    lambda: self.in_flight < self.limit, timeout=self.max_wait
+                )
+            finally:
+                self.waiting -= 1
+            if not acquired:
+                self.rejected += 1
+                raise BulkheadFullError(self.name, self.max_wait)
+
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+_bulkheads = {}
+_bulkheads_lock = threading.Lock()
+
+
+def get_bulkhead(name, operation, policy):
+    """The process-wide bulkhead of the class of `operation` on a machine."""
+    operation_class = OPERATION_CLASSES.get(operation, "listing")
+    key = f"{name}:{operation_class}"
+    with _bulkheads_lock:
+        bulkhead = _bulkheads.get(key)
+        if bulkhead is None:
+            bulkhead = _bulkheads[key] = Bulkhead(
+                key,
+                limit=policy.bulkhead_limits.get(operation_class, 8),
+                max_queue=policy.bulkhead_max_queue,
+                max_wait=policy.bulkhead_max_wait,
+            )
+
+    return bulkhead
+
+
+def bulkhead_stats():
+    with _bulkheads_lock:
+        bulkheads = list(_bulkheads.values())
+
+    return {bulkhead.name: bulkhead.stats() for bulkhead in bulkheads}
+
+
+def _release_on_close(response, bulkhead):
+    """Hand the bulkhead slot of a call over to its streamed response."""
+    close = response.close
+    lock = threading.Lock()
+    held = [True]
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            with lock:
+                release, held[0] = held[0], False
+            if release:
+                bulkhead.release()
+
+    response.close = close_and_release
+    return response
+
+
+_local = threading.local()
+
+
+def current_timeout():
+    """Timeout of the firecrest operation running in this thread, if any."""
+    return getattr(_local, "timeout", None)
+
+
+def call(name, operation, func, policy, args=(), kwargs=None, on_retry=None):
+    """Call `func` for the firecrest `operation` of the machine `name`
+    through its bulkhead and circuit breaker, with the operation timeout and
+    retries if the operation is idempotent. `on_retry` is called before every retry,
+    e.g. to rewind a partially written stream.
+
+    The result of a streamed operation keeps the slot of the bulkhead until
+    it is closed, the caller must close it.
+
+    Nested calls (pyfirecrest polling its tasks within `submit`) go
+    straight through and are accounted to the outer operation.
+    """
+    kwargs = kwargs or {}
+    if getattr(_local, "operation", None) is not None:
+        return func(*args, **kwargs)
+
+    bulkhead = get_bulkhead(name, operation, policy)
+    breaker = get_breaker(name, policy)
+    retries = policy.retries if operation in IDEMPOTENT_OPERATIONS else 0
+    attempt = 0
+    while True:
+        # no slot is held while backing off
+        bulkhead.acquire()
+        streamed = False
+        try:
+            breaker.before_call()
+            _local.operation, _local.timeout = operation, policy.timeout(operation)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    breaker.record_ignored()
+                    raise
+                breaker.record_failure()
+                if attempt >= retries:
+                    raise
+            else:
+                breaker.record_success()
+                if operation in STREAMED_OPERATIONS:
+                    streamed = True
+                    return _release_on_close(result, bulkhead)
+                return result
+            finally:
+                _local.operation, _local.timeout = None, None
+        finally:
+            if not streamed:
+                bulkhead.release()
+
+        time.sleep(policy.backoff(attempt))
+        attempt += 1
+        if on_retry is not None:
+            on_retry()
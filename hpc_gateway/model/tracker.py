@@ -0,0 +1,160 @@
+"""Background tracker of the SLURM state of the launched jobs.
+
+Every `JOB_TRACKER_INTERVAL` seconds the launched jobs not yet in a
+terminal state are collected from the DB, their state is queried with one
+batched firecrest `poll` (sacct) per machine and the transitions are
+recorded in the jobs collection, the state of a job array follows the
+states of its tasks. A lease in the DB makes a single worker process poll
+at a time, the state endpoint answers from the DB.
+"""
+import os
+import socket
+import threading
+import uuid
+from collections import defaultdict
+
+from flask import current_app
+
+from hpc_gateway.model.database import (
+    ACTIVATED,
+    TERMINAL_STATES,
+    acquire_lease,
+    get_active_jobs,
+    get_array_tasks,
+    get_jobs_by_ids,
+    set_job_states,
+)
+from hpc_gateway.model.f7t import create_f7t_client
+
+LEASE_NAME = "job_state_tracker"
+
+
+def normalize_state(state):
+    """SLURM state without details, e.g. "CANCELLED by 1234" -> "CANCELLED"."""
+    return state.split()[0].rstrip("+") if state else state
+
+
+def poll_job_states(f7t_client, jobs):
+    """Query the SLURM state of launched jobs with one firecrest poll per
+    machine (and batch), return the transitions (job_id, old, new).
+
+    A machine which can not be polled is skipped."""
+    config = current_app.config
+    jobs_by_machine = defaultdict(dict)
+    for job in jobs:
+        machine = job.get("machine", config["MACHINE"])
+        jobs_by_machine[machine][str(job["f7t_job_id"])] = job
+
+    batch_size = config["JOB_TRACKER_BATCH_SIZE"]
+    transitions = []
+    for machine, jobs in jobs_by_machine.items():
+        f7t_job_ids = list(jobs)
+        for start in range(0, len(f7t_job_ids), batch_size):
+            batch = f7t_job_ids[start : start + batch_size]
+            try:
+                states = f7t_client.poll(machine=machine, jobs=batch)
+            except Exception as e:
+                # keep tracking the other machines
+                current_app.logger.warning(f"Unable to poll {machine}: {e}")
+                break
+
+            for info in states:
+                job = jobs.get(str(info.get("jobid")))
+                state = normalize_state(info.get("state"))
+                if job is not None and state and state != job["state"]:
+                    transitions.append((job["_id"], job["state"], state))
+
+    return transitions
+
+
+def array_state(states):
+    """State of a job array from the states of its tasks: running until all
+    tasks ended, then completed if all completed."""
+    if all(state in TERMINAL_STATES for state in states):
+        if all(state == "COMPLETED" for state in states):
+            return "COMPLETED"
+        if "FAILED" in states:
+            return "FAILED"
+        return next(state for state in states if state != "COMPLETED")
+    if any(state == "RUNNING" or state in TERMINAL_STATES for state in states):
+        return "RUNNING"
+    return "PENDING" if "PENDING" in states else ACTIVATED
+
+
+def array_transitions(parent_ids):
+    """Transitions (job_id, old, new) of the job arrays `parent_ids` to the
+    state of their tasks."""
+    states = defaultdict(list)
+    for task in get_array_tasks(parent_ids):
+        states[task["parent_id"]].append(task["state"])
+
+    transitions = []
+    for parent in get_jobs_by_ids(parent_ids, fields=["state"]):
+        if parent["state"] in TERMINAL_STATES or not states[parent["_id"]]:
+            continue
+        state = array_state(states[parent["_id"]])
+        if state != parent["state"]:
+            transitions.append((parent["_id"], parent["state"], state))
+
+    return transitions
+
+
+class JobStateTracker:
+    def __init__(self, app):
+        self.app = app
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="job-state-tracker", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.app.config["JOB_TRACKER_INTERVAL"]):
+            with self.app.app_context():
+                try:
+                    self.run_once()
+                except Exception:
+                    self.app.logger.exception("Job state tracking failed.")
+
+    def run_once(self):
+        """One polling round, return the number of recorded transitions."""
+        config = current_app.config
+        if not acquire_lease(
+            LEASE_NAME, self.owner, ttl=3 * config["JOB_TRACKER_INTERVAL"]
+        ):
+            return 0
+
+        f7t_client = create_f7t_client()
+        jobs = {job["_id"]: job for job in get_active_jobs()}
+        transitions = poll_job_states(f7t_client, jobs.values())
+        recorded = set_job_states(transitions)
+
+        parent_ids = {
+            jobs[job_id]["parent_id"]
+            for job_id, _, _ in transitions
+            if jobs[job_id].get("parent_id")
+        }
+        if parent_ids:
+            recorded += set_job_states(array_transitions(parent_ids))
+
+        return recorded
+
+
+def init_job_tracker(app):
+    """Start the tracker with the first request of a worker process (never
+    in a preloading master process), if JOB_TRACKER_ENABLED and
+    JOB_TRACKER_THREAD."""
+
+    @app.before_first_request
+    def start_job_tracker():
+        config = app.config
+        if config["JOB_TRACKER_ENABLED"] and config["JOB_TRACKER_THREAD"]:
+            app.extensions["job_tracker"] = JobStateTracker(app).start()
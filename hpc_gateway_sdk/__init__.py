@@ -1,3 +1,6 @@
+import os
+from contextlib import ExitStack
+
 from marketplace import MarketPlaceClient
 from marketplace.app.v0 import MarketPlaceApp
 from marketplace.app.v0.utils import _encode_metadata
@@ -70,6 +73,42 @@ class HpcGatewayApp(MarketPlaceApp):
         ).json()
         return response_json.get("jobid", "")
 
+    def create_sweep(self, new_transformation: dict, parameters: dict) -> dict:
+        """Create and launch a parameter sweep, one job per combination of
+        the values of `parameters` (`{name: [values]}`), return the jobid of
+        the sweep and the `tasks` (jobid and parameters of every job)."""
+        response = self._client.post(
+            self._proxy_path("newTransformationSweep"),
+            json=dict(new_transformation, parameters=parameters),
+        )
+        if response.status_code != 200:
+            raise RuntimeError("request fail, check access token is renewed.")
+
+        return response.json()
+
+    def iter_jobs(self, page_size: int = 100, **filters):
+        """Iterate over the pages of the jobs of the user, every page is a
+        dict of `jobid: details`.
+
+        filters: `fields`, `state` (comma separated) and `created_after`,
+        `created_before` (ISO 8601) of the job listing.
+        """
+        params = dict(filters, limit=page_size)
+        while True:
+            response = self._client.get(
+                self._proxy_path("getTransformationList"),
+                params=params,
+            )
+            if response.status_code != 200:
+                raise RuntimeError("request fail, check access token is renewed.")
+
+            response_json = response.json()
+            yield response_json.get("jobs", {})
+
+            if not response_json.get("next"):
+                break
+            params["cursor"] = response_json["next"]
+
     def launch_job(
         self,
         jobid: str,
@@ -94,6 +133,24 @@ class HpcGatewayApp(MarketPlaceApp):
 
         return response_json
 
+    def check_job_states(
+        self,
+        jobids: list,
+    ) -> dict:
+        """State of several jobs in one request, return `jobid: state` of
+        the jobs found (jobs not found are left out)."""
+        response = self._client.get(
+            self._proxy_path("getTransformationStates"),
+            params={"jobids": ",".join(jobids)},
+        )
+        if response.status_code != 200:
+            raise RuntimeError("request fail, check access token is renewed.")
+
+        return {
+            jobid: details.get("state")
+            for jobid, details in response.json().get("states", {}).items()
+        }
+
     def cancel_job(self, jobid: str):
         return self._client.delete(
             self._proxy_path("deleteTransformation"),
@@ -140,3 +197,31 @@ class HpcGatewayApp(MarketPlaceApp):
                 headers=_encode_metadata({}),
                 files=files,
             )
+
+    def upload_files(
+        self,
+        jobid: str,
+        source_paths: list,
+    ):
+        """Upload several files to the job folder in one request, the
+        gateway transfers them concurrently and reports a status per file."""
+        params = {"jobid": jobid}
+
+        with ExitStack() as stack:
+            files = [
+                (
+                    "file",
+                    (
+                        os.path.basename(source_path),
+                        stack.enter_context(open(source_path, "rb")),
+                        "multipart/form-data",
+                    ),
+                )
+                for source_path in source_paths
+            ]
+            return self._client.put(
+                self._proxy_path("createDataset"),
+                params=params,
+                headers=_encode_metadata({}),
+                files=files,
+            )
@@ -1,4 +1,9 @@
+import io
+import json
+import os
 import pathlib
+import tarfile
+import zipfile
 from contextlib import nullcontext
 from types import MethodType
 
@@ -174,6 +179,10 @@ def test_launch_job(
     assert job.get("state") == "ACTIVATED"
     assert job.get("f7t_job_id") == expected_f7t_job_id
 
+    # submitted once
+    response = client.patch(f"/api/v1/job/launch/{job_id}", headers=auth_header)
+    assert response.status_code == 409
+
 
 def test_cancel_job(
     app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, job_json
@@ -363,7 +372,8 @@ def test_file_operations_repo(
 
         assert filename in ["dummy.in", "moredummy.in", "job.sh"]
 
-        assert isinstance(f, bytes)
+        # job script is uploaded from bytes, user files are streamed
+        assert isinstance(f, bytes) or hasattr(f, "read")
 
     def mock_simple_download(cls, machine, source_path, target_path):
         # mock that content is read from source_path
@@ -381,6 +391,16 @@ def test_file_operations_repo(
         assert _dummy_filename in target_path
         return None
 
+    def mock_stat(cls, machine, target_path, dereference=False):
+        return {"size": len(expected_download), "mtime": 1670000000}
+
+    def mock_parameters(cls):
+        return {
+            "utilities": [
+                {"name": "UTILITIES_MAX_FILE_SIZE", "unit": "MB", "value": "5"}
+            ]
+        }
+
     # monkeypatch the mkdir/submit/cancel operation of f7t
     monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
     monkeypatch.setattr(
@@ -397,6 +417,10 @@ def test_file_operations_repo(
         "firecrest.Firecrest.simple_download",
         MethodType(mock_simple_download, Firecrest),
     )
+    monkeypatch.setattr("firecrest.Firecrest.stat", MethodType(mock_stat, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.parameters", MethodType(mock_parameters, Firecrest)
+    )
 
     # moketpach the db
     monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
@@ -458,3 +482,1359 @@ def test_file_operations_repo(
     )
 
     assert response.status_code == 200
+
+
+def test_stream_download_range(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, job_json
+):
+    """Streamed download honours Range/If-Range and sets ETag/Content-Length."""
+    content = b"0123456789abcdef"
+    stat = {"size": len(content), "mtime": 1670000000}
+
+    client = app.test_client()
+    userinfo_url = app.config["MP_USERINFO_URL"]
+
+    class MockResponse:
+        status_code = 200
+        closed = False
+
+        def iter_content(self, chunk_size):
+            for i in range(0, len(content), 5):
+                yield content[i : i + 5]
+
+        def close(self):
+            self.closed = True
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        return "mkdir!"
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        return "simple_upload!"
+
+    def mock_stat(cls, machine, target_path, dereference=False):
+        return stat
+
+    def mock_stream_download(cls, machine, source_path, byte_range=None):
+        return MockResponse()
+
+    def mock_parameters(cls):
+        return {
+            "utilities": [
+                {"name": "UTILITIES_MAX_FILE_SIZE", "unit": "MB", "value": "5"}
+            ]
+        }
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr("firecrest.Firecrest.stat", MethodType(mock_stat, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.parameters", MethodType(mock_parameters, Firecrest)
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.stream_download",
+        MethodType(mock_stream_download, Firecrest),
+    )
+
+    # moketpach the db
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    requests_mock.get(userinfo_url, json=userinfo, status_code=200)
+
+    app.config.update({"FILE_STREAM_DOWNLOAD": True})
+
+    # create user and job
+    client.put("/api/v1/user/create", headers=auth_header)
+    response = client.post("/api/v1/job/create", headers=auth_header, json=job_json)
+    job_id = response.json["jobid"]
+
+    url = f"/api/v1/file/download/{job_id}?filename=out.dat"
+    response = client.get(url, headers=auth_header)
+    assert response.status_code == 200
+    assert response.data == content
+    assert response.headers["Content-Length"] == str(len(content))
+    etag = response.headers["ETag"]
+
+    response = client.get(url, headers={"Range": "bytes=3-11", **auth_header})
+    assert response.status_code == 206
+    assert response.data == content[3:12]
+    assert response.headers["Content-Range"] == f"bytes 3-11/{len(content)}"
+
+    # resume against a changed file gives the whole file
+    response = client.get(
+        url, headers={"Range": "bytes=3-", "If-Range": '"other"', **auth_header}
+    )
+    assert response.status_code == 200
+    assert response.data == content
+
+    response = client.get(url, headers={"If-None-Match": etag, **auth_header})
+    assert response.status_code == 304
+
+    response = client.get(url, headers={"Range": "bytes=100-", **auth_header})
+    assert response.status_code == 416
+
+
+def test_staged_transfers(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, job_json
+):
+    """Files above the firecrest small-file limit go through object storage."""
+    _dummy_filename = "dummy.in"
+    staged_url = "https://object-storage.example.com/staged"
+
+    client = app.test_client()
+    userinfo_url = app.config["MP_USERINFO_URL"]
+
+    class MockTransfer:
+        _task_id = "task-0001"
+
+        def finish_upload(self):
+            return None
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        return "mkdir!"
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        assert filename == "job.sh"
+
+    def mock_parameters(cls):
+        # 4 bytes limit
+        return {
+            "utilities": [
+                {"name": "UTILITIES_MAX_FILE_SIZE", "unit": "B", "value": "4"}
+            ]
+        }
+
+    def mock_stat(cls, machine, target_path, dereference=False):
+        return {"size": 1000, "mtime": 1670000000}
+
+    def mock_external_upload(cls, machine, source_path, target_path):
+        assert os.path.basename(source_path) == _dummy_filename
+        return MockTransfer()
+
+    def mock_external_download(cls, machine, source_path):
+        transfer = MockTransfer()
+        transfer._task_id = "task-0002"
+        return transfer
+
+    def mock_tasks(cls, task_id=None, responses=None):
+        return {"status": "117", "description": "Finished", "data": staged_url}
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr("firecrest.Firecrest.stat", MethodType(mock_stat, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.parameters", MethodType(mock_parameters, Firecrest)
+    )
+    monkeypatch.setattr(
+        "firecrest.Firecrest.external_upload",
+        MethodType(mock_external_upload, Firecrest),
+    )
+    monkeypatch.setattr(
+        "firecrest.Firecrest.external_download",
+        MethodType(mock_external_download, Firecrest),
+    )
+    monkeypatch.setattr("firecrest.Firecrest._tasks", MethodType(mock_tasks, Firecrest))
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+
+    # moketpach the db
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    requests_mock.get(userinfo_url, json=userinfo, status_code=200)
+
+    # create user and job
+    client.put("/api/v1/user/create", headers=auth_header)
+    response = client.post("/api/v1/job/create", headers=auth_header, json=job_json)
+    job_id = response.json["jobid"]
+
+    with open(f"tests/static/{_dummy_filename}", "rb") as fh:
+        response = client.put(
+            f"/api/v1/file/upload/{job_id}",
+            data={"file": (fh, _dummy_filename)},
+            content_type="multipart/form-data",
+            headers=auth_header,
+        )
+
+    assert response.status_code == 202
+    assert response.json["task_id"] == MockTransfer._task_id
+
+    # a path is never staged out of the staging folder
+    with open(f"tests/static/{_dummy_filename}", "rb") as fh:
+        response = client.put(
+            f"/api/v1/file/upload/{job_id}",
+            query_string={"filename": f"../../{_dummy_filename}"},
+            data={"file": (fh, _dummy_filename)},
+            content_type="multipart/form-data",
+            headers=auth_header,
+        )
+    assert response.status_code == 202
+
+    with open(f"tests/static/{_dummy_filename}", "rb") as fh:
+        response = client.put(
+            f"/api/v1/file/upload/{job_id}",
+            query_string={"filename": "sub/.."},
+            data={"file": (fh, _dummy_filename)},
+            content_type="multipart/form-data",
+            headers=auth_header,
+        )
+    assert response.status_code == 400
+
+    response = client.get(
+        f"/api/v1/file/download/{job_id}",
+        headers=auth_header,
+        query_string={"filename": "out.dat"},
+    )
+    assert response.status_code == 202
+    task_id = response.json["task_id"]
+
+    response = client.get(f"/api/v1/file/transfer/{task_id}", headers=auth_header)
+    assert response.status_code == 200
+    assert response.json["done"]
+    assert response.json["url"] == staged_url
+
+
+def test_staged_transfer_failures(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, tmp_path
+):
+    """A staged upload which fails to start leaves no local copy, downloads
+    stay direct while the firecrest limits can not be read."""
+    from hpc_gateway.model.database import create_job, create_user
+
+    limits = {"utilities": [{"name": "UTILITIES_MAX_FILE_SIZE", "value": "0"}]}
+
+    def mock_parameters(cls):
+        if limits is None:
+            raise RuntimeError("parameters unavailable")
+        return limits
+
+    def mock_stat(cls, machine, target_path, dereference=False):
+        return {"size": 1000, "mtime": 1670000000}
+
+    def mock_external_upload(cls, machine, source_path, target_path):
+        raise RuntimeError("object storage unavailable")
+
+    def mock_simple_download(cls, machine, source_path, target_path):
+        target_path.write(b"direct")
+
+    for name, mock in [
+        ("parameters", mock_parameters),
+        ("stat", mock_stat),
+        ("external_upload", mock_external_upload),
+        ("simple_download", mock_simple_download),
+    ]:
+        monkeypatch.setattr(f"firecrest.Firecrest.{name}", MethodType(mock, Firecrest))
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    app.config["FILE_STAGING_DIR"] = str(tmp_path)
+    userinfo = dict(userinfo, email="staged@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+    with app.app_context():
+        user = create_user(userinfo["email"], "staged", "/home/staged")
+        job = create_job(user["_id"], "/scratch/staged/0")
+
+    client = app.test_client()
+    response = client.put(
+        f"/api/v1/file/upload/{job['_id']}",
+        data={"file": (io.BytesIO(b"large"), "large.in")},
+        content_type="multipart/form-data",
+        headers=auth_header,
+    )
+    assert response.status_code == 500
+    assert list(tmp_path.iterdir()) == []
+
+    app.extensions.pop("f7t_max_file_size")
+    limits = None
+    response = client.get(
+        f"/api/v1/file/download/{job['_id']}",
+        headers=auth_header,
+        query_string={"filename": "out.dat"},
+    )
+    assert response.status_code == 200
+    assert response.data == b"direct"
+
+
+def test_list_job_repo_cached(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, job_json
+):
+    """Listings are cached for a few seconds and invalidated by a delete."""
+    client = app.test_client()
+    userinfo_url = app.config["MP_USERINFO_URL"]
+    list_calls = []
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        return "mkdir!"
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        return "simple_upload!"
+
+    def mock_simple_delete(cls, machine, target_path):
+        return None
+
+    def mock_list_files(cls, machine, target_path):
+        list_calls.append(target_path)
+        return [{"name": "job.sh", "type": "f"}]
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.list_files", MethodType(mock_list_files, Firecrest)
+    )
+    monkeypatch.setattr(
+        "firecrest.Firecrest.simple_delete", MethodType(mock_simple_delete, Firecrest)
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+
+    # moketpach the db
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    requests_mock.get(userinfo_url, json=userinfo, status_code=200)
+
+    client.put("/api/v1/user/create", headers=auth_header)
+    response = client.post("/api/v1/job/create", headers=auth_header, json=job_json)
+    job_id = response.json["jobid"]
+
+    for _ in range(3):
+        response = client.get(f"/api/v1/file/list/{job_id}", headers=auth_header)
+        assert response.status_code == 200
+    response = client.get(f"/api/v1/job/state/{job_id}", headers=auth_header)
+    assert response.status_code == 200
+
+    assert len(list_calls) == 1
+
+    client.delete(
+        f"/api/v1/file/delete/{job_id}",
+        headers=auth_header,
+        query_string={"filename": "job.sh"},
+    )
+    client.get(f"/api/v1/file/list/{job_id}", headers=auth_header)
+
+    assert len(list_calls) == 2
+
+
+def test_batch_upload(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, job_json
+):
+    """Several files of one request are uploaded with a status per file."""
+    client = app.test_client()
+    userinfo_url = app.config["MP_USERINFO_URL"]
+    uploaded = []
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        return "mkdir!"
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        if filename == "broken.in":
+            raise RuntimeError("upload failed")
+        if filename != "job.sh":
+            uploaded.append((filename, source_path.read()))
+
+    def mock_parameters(cls):
+        return {
+            "utilities": [
+                {"name": "UTILITIES_MAX_FILE_SIZE", "unit": "MB", "value": "5"}
+            ]
+        }
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.parameters", MethodType(mock_parameters, Firecrest)
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+
+    # moketpach the db
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    requests_mock.get(userinfo_url, json=userinfo, status_code=200)
+
+    client.put("/api/v1/user/create", headers=auth_header)
+    response = client.post("/api/v1/job/create", headers=auth_header, json=job_json)
+    job_id = response.json["jobid"]
+
+    data = {
+        "file": [
+            (io.BytesIO(b"pair_style lj/cut"), "colloid.in"),
+            (io.BytesIO(b"#!/bin/bash"), "run.sh"),
+        ]
+    }
+    response = client.put(
+        f"/api/v1/file/batch/{job_id}",
+        data=data,
+        content_type="multipart/form-data",
+        headers=auth_header,
+    )
+    assert response.status_code == 200
+    assert [f["status"] for f in response.json["files"]] == ["uploaded"] * 2
+    assert sorted(uploaded) == [
+        ("colloid.in", b"pair_style lj/cut"),
+        ("run.sh", b"#!/bin/bash"),
+    ]
+
+    # the single upload endpoint accepts several files as well
+    data = {
+        "file": [
+            (io.BytesIO(b"pair_style lj/cut"), "colloid.in"),
+            (io.BytesIO(b"garbage"), "broken.in"),
+        ]
+    }
+    response = client.put(
+        f"/api/v1/file/upload/{job_id}",
+        data=data,
+        content_type="multipart/form-data",
+        headers=auth_header,
+    )
+    assert response.status_code == 207
+    statuses = {f["filename"]: f["status"] for f in response.json["files"]}
+    assert statuses == {"colloid.in": "uploaded", "broken.in": "failed"}
+
+    # a file is never uploaded out of the job folder
+    uploaded.clear()
+    data = {
+        "file": [
+            (io.BytesIO(b"pair_style lj/cut"), "../../colloid.in"),
+            (io.BytesIO(b"garbage"), ".."),
+        ]
+    }
+    response = client.put(
+        f"/api/v1/file/batch/{job_id}",
+        data=data,
+        content_type="multipart/form-data",
+        headers=auth_header,
+    )
+    assert response.status_code == 207
+    assert [f["status"] for f in response.json["files"]] == ["uploaded", "failed"]
+    assert uploaded == [("colloid.in", b"pair_style lj/cut")]
+
+
+def test_archive_download(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, job_json
+):
+    """The job folder is streamed as a zip or tar archive."""
+    contents = {"out.log": b"step 1\nstep 2\n" * 100, "res.dat": b"\x00\x01" * 700}
+
+    client = app.test_client()
+    userinfo_url = app.config["MP_USERINFO_URL"]
+
+    class MockResponse:
+        status_code = 200
+
+        def __init__(self, content):
+            self.content = content
+
+        def iter_content(self, chunk_size):
+            for i in range(0, len(self.content), 100):
+                yield self.content[i : i + 100]
+
+        def close(self):
+            pass
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        return "mkdir!"
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        return "simple_upload!"
+
+    def mock_parameters(cls):
+        return {
+            "utilities": [
+                {"name": "UTILITIES_MAX_FILE_SIZE", "unit": "MB", "value": "5"}
+            ]
+        }
+
+    def mock_list_files(cls, machine, target_path):
+        files = [
+            {
+                "name": name,
+                "type": "-",
+                "size": str(len(content)),
+                "last_modified": "2022-12-03T09:17:51",
+            }
+            for name, content in contents.items()
+        ]
+        files.append({"name": "sub", "type": "d", "size": "4096"})
+        return files
+
+    def mock_stream_download(cls, machine, source_path, byte_range=None):
+        return MockResponse(contents[os.path.basename(source_path)])
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.parameters", MethodType(mock_parameters, Firecrest)
+    )
+    monkeypatch.setattr(
+        "firecrest.Firecrest.list_files", MethodType(mock_list_files, Firecrest)
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.stream_download",
+        MethodType(mock_stream_download, Firecrest),
+    )
+
+    # moketpach the db
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    requests_mock.get(userinfo_url, json=userinfo, status_code=200)
+
+    client.put("/api/v1/user/create", headers=auth_header)
+    response = client.post("/api/v1/job/create", headers=auth_header, json=job_json)
+    job_id = response.json["jobid"]
+
+    response = client.get(f"/api/v1/file/archive/{job_id}", headers=auth_header)
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert sorted(archive.namelist()) == sorted(contents)
+        for name, content in contents.items():
+            assert archive.read(name) == content
+
+    response = client.get(
+        f"/api/v1/file/archive/{job_id}",
+        headers=auth_header,
+        query_string={"format": "tar.gz", "include": "*.log"},
+    )
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.data), mode="r:gz") as archive:
+        assert archive.getnames() == ["out.log"]
+        assert archive.extractfile("out.log").read() == contents["out.log"]
+
+
+def test_archive_entries_bounded():
+    """An archive holds at most `prefetch` + 1 downloads open, a download
+    rejected while started ahead is started again in its turn."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from hpc_gateway.api.file import _archive_entries
+    from hpc_gateway.model.resilience import BulkheadFullError
+
+    opened, rejected = [], ["f2"]
+
+    class MockResponse:
+        def __init__(self, name):
+            self.name = name
+            opened.append(name)
+
+        def iter_content(self, chunk_size):
+            yield self.name.encode()
+
+        def close(self):
+            opened.remove(self.name)
+
+    class MockClient:
+        def stream_download(self, machine, source_path):
+            name = os.path.basename(source_path)
+            if name in rejected:
+                rejected.remove(name)
+                raise BulkheadFullError("transfer", retry_after=1)
+            return MockResponse(name)
+
+    files = [(f"f{i}", 2, 0) for i in range(6)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        entries = _archive_entries(
+            MockClient(), "daint", "/scratch", files, executor, 1, 1024
+        )
+        streamed = []
+        for _, _, _, chunks in entries:
+            assert len(opened) <= 2
+            streamed.append(b"".join(chunks).decode())
+
+    assert streamed == [f[0] for f in files]
+    assert opened == []
+
+
+def test_download_from_file_cache(
+    app,
+    auth_header,
+    userinfo,
+    mock_db,
+    monkeypatch,
+    requests_mock,
+    job_json,
+    tmp_path,
+):
+    """Unchanged remote files are fetched once and then served from disk."""
+    content = b"wavefunction" * 100
+    stat = {"size": len(content), "mtime": 1670000000}
+    downloads = []
+
+    client = app.test_client()
+    userinfo_url = app.config["MP_USERINFO_URL"]
+
+    class MockResponse:
+        status_code = 200
+
+        def iter_content(self, chunk_size):
+            yield content
+
+        def close(self):
+            pass
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        return "mkdir!"
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        return "simple_upload!"
+
+    def mock_stat(cls, machine, target_path, dereference=False):
+        return stat
+
+    def mock_parameters(cls):
+        return {
+            "utilities": [
+                {"name": "UTILITIES_MAX_FILE_SIZE", "unit": "MB", "value": "5"}
+            ]
+        }
+
+    def mock_stream_download(cls, machine, source_path, byte_range=None):
+        downloads.append(source_path)
+        return MockResponse()
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr("firecrest.Firecrest.stat", MethodType(mock_stat, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.parameters", MethodType(mock_parameters, Firecrest)
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.stream_download",
+        MethodType(mock_stream_download, Firecrest),
+    )
+
+    # moketpach the db
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    requests_mock.get(userinfo_url, json=userinfo, status_code=200)
+
+    app.config.update({"FILE_CACHE_DIR": str(tmp_path)})
+
+    client.put("/api/v1/user/create", headers=auth_header)
+    response = client.post("/api/v1/job/create", headers=auth_header, json=job_json)
+    job_id = response.json["jobid"]
+
+    url = f"/api/v1/file/download/{job_id}?filename=wfc.dat"
+    for _ in range(3):
+        response = client.get(url, headers=auth_header)
+        assert response.status_code == 200
+        assert response.data == content
+
+    assert len(downloads) == 1
+
+    response = client.get(url, headers={"Range": "bytes=0-11", **auth_header})
+    assert response.status_code == 206
+    assert response.data == b"wavefunction"
+
+    # the remote file changed
+    stat["mtime"] += 1
+    response = client.get(url, headers=auth_header)
+    assert response.data == content
+    assert len(downloads) == 2
+
+    # a file larger than the cache is streamed, not cached
+    app.config.update({"FILE_CACHE_MAX_BYTES": len(content) - 1})
+    stat["mtime"] += 1
+    response = client.get(url, headers=auth_header)
+    assert response.data == content
+    assert len(downloads) == 3
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_circuit_open_fails_fast(app, mock_db, monkeypatch):
+    """While the firecrest circuit is open, handlers answer 503 with
+    Retry-After instead of a generic error."""
+    from hpc_gateway.model.database import create_job
+    from hpc_gateway.model.resilience import CircuitOpenError
+
+    def mock_list_files(cls, machine, target_path):
+        raise CircuitOpenError(machine, 12.5)
+
+    monkeypatch.setattr(
+        "firecrest.Firecrest.list_files", MethodType(mock_list_files, Firecrest)
+    )
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    with app.app_context():
+        job = create_job(user_id=ObjectId(), remote_folder="/scratch/circuit")
+
+    response = app.test_client().get(f"/api/v1/job/state/{job['_id']}")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "13"
+
+    response = app.test_client().get("/status")
+    assert response.status_code == 200
+    assert "firecrest" in response.json
+
+
+def test_list_jobs_paginated(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock
+):
+    """Jobs are listed page by page following the `next` cursor, with
+    projection and state filters."""
+    from hpc_gateway.model.database import create_job, create_user, update_job
+
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="pages@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+
+    with app.app_context():
+        user = create_user(userinfo["email"], "pages", "/home/pages")
+        job_ids = [
+            str(create_job(user["_id"], f"/scratch/pages/{i}")["_id"]) for i in range(5)
+        ]
+        update_job(job_ids[1], f7t_job_id="1")
+
+    client = app.test_client()
+    listed, cursor = [], None
+    for _ in range(3):
+        query = {"limit": 2, "fields": "remote_folder"}
+        if cursor:
+            query["cursor"] = cursor
+        response = client.get("/api/v1/job/", headers=auth_header, query_string=query)
+        assert response.status_code == 200
+        jobs = response.json["jobs"]
+        assert len(jobs) <= 2
+        assert all(set(job) == {"_id", "remote_folder"} for job in jobs.values())
+        listed += list(jobs)
+        cursor = response.json["next"]
+        if cursor is None:
+            break
+    assert listed == job_ids
+    assert cursor is None
+
+    response = client.get(
+        "/api/v1/job/", headers=auth_header, query_string={"state": "ACTIVATED"}
+    )
+    assert list(response.json["jobs"]) == [job_ids[1]]
+    assert response.json["next"] is None
+
+    response = client.get(
+        "/api/v1/job/", headers=auth_header, query_string={"cursor": "bogus"}
+    )
+    assert response.status_code == 400
+
+
+def test_list_jobs_interrupted(app):
+    """A DB error while the listing is streamed still closes the JSON."""
+    from pymongo.errors import AutoReconnect
+
+    from hpc_gateway.api.job import decode_cursor, stream_jobs
+
+    first, second = ObjectId(), ObjectId()
+
+    def jobs():
+        yield {"_id": str(first), "state": "CREATED"}
+        yield {"_id": str(second), "state": "CREATED"}
+        raise AutoReconnect("connection lost")
+
+    with app.test_request_context():
+        listing = json.loads("".join(stream_jobs(jobs(), limit=10)))
+
+    assert list(listing["jobs"]) == [str(first), str(second)]
+    assert decode_cursor(listing["next"]) == second
+    assert "error" in listing
+
+
+def test_job_state_from_db(app, mock_db, monkeypatch):
+    """With the job state tracker, the state endpoint does not call firecrest
+    unless the files of the job are requested."""
+    from hpc_gateway.model.database import create_job, set_job_states, update_job
+
+    def mock_list_files(cls, machine, target_path):
+        raise AssertionError("firecrest called")
+
+    monkeypatch.setattr(
+        "firecrest.Firecrest.list_files", MethodType(mock_list_files, Firecrest)
+    )
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    app.config.update({"JOB_TRACKER_ENABLED": True})
+
+    with app.app_context():
+        job = create_job(user_id=ObjectId(), remote_folder="/scratch/tracked")
+        update_job(job["_id"], "42")
+        set_job_states([(job["_id"], "ACTIVATED", "RUNNING")])
+
+    response = app.test_client().get(f"/api/v1/job/state/{job['_id']}")
+    assert response.status_code == 200
+    assert response.json["state"] == "RUNNING"
+    assert response.json["state_updated_at"]
+
+    response = app.test_client().get(f"/api/v1/job/state/{job['_id']}?files")
+    assert response.status_code == 500
+    # the tests run the tracking rounds themselves
+    assert "job_tracker" not in app.extensions
+
+
+def test_job_states_bulk(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock
+):
+    """The states of several jobs come from one DB query and one poll, jobs
+    of other users are reported missing."""
+    from hpc_gateway.model.database import create_job, create_user, update_job
+
+    polls = []
+
+    def mock_poll(cls, machine, jobs=None, start_time=None, end_time=None):
+        polls.append(list(jobs))
+        return [{"jobid": job, "state": "RUNNING"} for job in jobs]
+
+    monkeypatch.setattr("firecrest.Firecrest.poll", MethodType(mock_poll, Firecrest))
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="bulk@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+
+    with app.app_context():
+        user = create_user(userinfo["email"], "bulk", "/home/bulk")
+        created = create_job(user["_id"], "/scratch/bulk/0")
+        launched = [create_job(user["_id"], f"/scratch/bulk/{i}") for i in (1, 2)]
+        for i, job in enumerate(launched):
+            update_job(job["_id"], f"bulk-{i}")
+        other = create_job(ObjectId(), "/scratch/other")
+
+    job_ids = [str(job["_id"]) for job in [created, *launched, other]]
+    response = app.test_client().get(
+        "/api/v1/job/states",
+        headers=auth_header,
+        query_string={"jobids": ",".join(job_ids)},
+    )
+    assert response.status_code == 200
+    states = response.json["states"]
+    assert states[job_ids[0]]["state"] == "CREATED"
+    assert states[job_ids[1]]["state"] == "RUNNING"
+    assert states[job_ids[2]]["state"] == "RUNNING"
+    assert response.json["missing"] == [job_ids[3]]
+    assert polls == [["bulk-0", "bulk-1"]]
+    assert mock_db.jobs.find_one({"_id": launched[0]["_id"]})["state"] == "RUNNING"
+
+    response = app.test_client().get(
+        "/api/v1/job/states", headers=auth_header, query_string={"jobids": "bogus"}
+    )
+    assert response.status_code == 400
+
+
+def test_job_events(app, auth_header, userinfo, mock_db, monkeypatch, requests_mock):
+    """State changes are streamed as Server-Sent Events (polling without
+    change streams) and resumed from the last event id."""
+    from pymongo.errors import OperationFailure
+
+    from hpc_gateway.model.database import create_job, create_user, set_job_states
+
+    def mock_watch(user_id, max_await_time_ms=1000):
+        raise OperationFailure("$changeStream is only supported on replica sets")
+
+    monkeypatch.setattr("hpc_gateway.api.job.watch_job_transitions", mock_watch)
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="events@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+    app.config.update(
+        {
+            "JOB_EVENTS_POLL_INTERVAL": 0.01,
+            "JOB_EVENTS_HEARTBEAT": 0.05,
+            "JOB_EVENTS_MAX_DURATION": 0.2,
+        }
+    )
+
+    with app.app_context():
+        user = create_user(userinfo["email"], "events", "/home/events")
+        jobs = [create_job(user["_id"], f"/scratch/events/{i}") for i in range(2)]
+        set_job_states([(job["_id"], "CREATED", "RUNNING") for job in jobs])
+
+    def read_events(**headers):
+        response = app.test_client().get(
+            "/api/v1/job/events", headers=dict(auth_header, **headers)
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+        body = response.get_data(as_text=True)
+        events = [
+            dict(line.split(": ", 1) for line in block.splitlines())
+            for block in body.split("\n\n")
+            if block.startswith("id: ")
+        ]
+        return body, events
+
+    # without Last-Event-ID only the changes from now on are sent
+    body, events = read_events()
+    assert events == []
+    assert body.startswith("retry: ")
+    assert ": heartbeat" in body
+
+    _, events = read_events(**{"Last-Event-ID": "0-"})
+    assert [json.loads(e["data"])["jobid"] for e in events] == [
+        str(job["_id"]) for job in jobs
+    ]
+    assert all(json.loads(e["data"])["state"] == "RUNNING" for e in events)
+
+    # resume after the first event
+    _, resumed = read_events(**{"Last-Event-ID": events[0]["id"]})
+    assert [e["id"] for e in resumed] == [events[1]["id"]]
+
+
+def test_job_events_change_stream(app, mock_db, monkeypatch):
+    """The changes of a bulk write share their time and come in write order,
+    none is lost and the ones of the backlog are not repeated."""
+    from datetime import datetime
+
+    from hpc_gateway.api.job import EPOCH, stream_job_events
+    from hpc_gateway.model.database import create_job, set_job_states
+
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    app.config.update({"JOB_EVENTS_HEARTBEAT": 10, "JOB_EVENTS_MAX_DURATION": 0.2})
+    user_id = ObjectId()
+
+    with app.app_context():
+        jobs = [create_job(user_id, f"/scratch/stream/{i}") for i in range(3)]
+        set_job_states([(jobs[0]["_id"], "CREATED", "RUNNING")])
+        backlog = mock_db.jobs.find_one({"_id": jobs[0]["_id"]})
+    updated_at = datetime.utcnow().replace(microsecond=0)
+    changes = [backlog] + [
+        {"_id": job["_id"], "state": "RUNNING", "state_updated_at": updated_at}
+        for job in reversed(jobs[1:])
+    ]
+
+    class MockChangeStream:
+        def try_next(self):
+            return {"fullDocument": changes.pop(0)} if changes else None
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(
+        "hpc_gateway.api.job.watch_job_transitions",
+        lambda user_id, max_await_time_ms: MockChangeStream(),
+    )
+
+    with app.test_request_context():
+        body = "".join(stream_job_events(user_id, (EPOCH, None)))
+
+    sent = [
+        json.loads(line[len("data: ") :])["jobid"]
+        for line in body.splitlines()
+        if line.startswith("data: ")
+    ]
+    assert sent == [str(jobs[0]["_id"]), str(jobs[2]["_id"]), str(jobs[1]["_id"])]
+
+
+def test_submit_job(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock, job_json
+):
+    """One request creates the folder, uploads the script and inputs,
+    submits and records the job, with the timings of every stage."""
+    uploads = []
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        uploads.append(("mkdir", target_path))
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        if filename == "broken.in":
+            raise RuntimeError("upload failed")
+        if not isinstance(source_path, bytes):
+            source_path = source_path.read()
+        uploads.append((filename, target_path, source_path))
+
+    def mock_submit(cls, machine, job_script, local_file=False):
+        return {"jobid": "4242"}
+
+    def mock_simple_delete(cls, machine, target_path):
+        uploads.append(("delete", target_path))
+
+    def mock_parameters(cls):
+        return {"utilities": [{"name": "UTILITIES_MAX_FILE_SIZE", "value": "5"}]}
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr(
+        "firecrest.Firecrest.submit", MethodType(mock_submit, Firecrest)
+    )
+    monkeypatch.setattr(
+        "firecrest.Firecrest.parameters", MethodType(mock_parameters, Firecrest)
+    )
+    monkeypatch.setattr(
+        "firecrest.Firecrest.simple_delete",
+        MethodType(mock_simple_delete, Firecrest),
+    )
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+
+    client = app.test_client()
+    client.put("/api/v1/user/create", headers=auth_header)
+    uploads.clear()
+
+    data = {
+        "params": json.dumps(job_json),
+        "file": [
+            (io.BytesIO(b"input 1"), "a.in"),
+            (io.BytesIO(b"input 2"), "b.in"),
+        ],
+    }
+    response = client.post("/api/v1/job/submit", headers=auth_header, data=data)
+    assert response.status_code == 200
+    assert response.json["f7t_job_id"] == "4242"
+    timings = response.json["timings"]
+    assert set(timings) == {"mkdir", "upload", "submit", "db", "total"}
+
+    job = mock_db.jobs.find_one({"_id": ObjectId(response.json["jobid"])})
+    assert job["state"] == "ACTIVATED"
+    assert job["f7t_job_id"] == "4242"
+
+    assert uploads[0] == ("mkdir", job["remote_folder"])
+    uploaded = {upload[0]: upload[2] for upload in uploads[1:]}
+    assert set(uploaded) == {"job.sh", "a.in", "b.in"}
+    assert uploaded["b.in"] == b"input 2"
+    assert all(upload[1] == job["remote_folder"] for upload in uploads[1:])
+
+    response = client.post("/api/v1/job/submit", headers=auth_header, data={})
+    assert response.status_code == 400
+
+    # a failed upload leaves neither a job folder nor a job
+    uploads.clear()
+    job_count = mock_db.jobs.count_documents({})
+    data = {
+        "params": json.dumps(job_json),
+        "file": [(io.BytesIO(b"garbage"), "broken.in")],
+    }
+    response = client.post("/api/v1/job/submit", headers=auth_header, data=data)
+    assert response.status_code == 400
+    assert uploads[0][0] == "mkdir"
+    assert uploads[-1] == ("delete", uploads[0][1])
+    assert mock_db.jobs.count_documents({}) == job_count
+
+
+def test_create_and_launch_job_async(
+    app, auth_header, userinfo, job_json, mock_db, monkeypatch, requests_mock
+):
+    """Async create and launch answer 202 with an operation run by the
+    workers, its outcome is polled from the operation endpoint."""
+    from hpc_gateway.model.database import create_user
+    from hpc_gateway.model.operations import OperationWorkers
+
+    calls = []
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        calls.append(("mkdir", target_path))
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        calls.append(("upload", filename))
+
+    def mock_submit(cls, machine, job_script, local_file=False):
+        calls.append(("submit", job_script))
+        return {"jobid": "async-1"}
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr(
+        "firecrest.Firecrest.submit", MethodType(mock_submit, Firecrest)
+    )
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="async@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+    with app.app_context():
+        create_user(userinfo["email"], "async", "/home/async")
+
+    client = app.test_client()
+    response = client.post(
+        "/api/v1/job/create?async=true", json=job_json, headers=auth_header
+    )
+    assert response.status_code == 202
+    assert calls == []
+    jobid = response.json["jobid"]
+    location = response.headers["Location"]
+    assert client.get(location, headers=auth_header).json["status"] == "pending"
+
+    workers = OperationWorkers(app, threads=0)
+    with app.app_context():
+        assert workers.run_once()
+        assert not workers.run_once()
+
+    response = client.get(location, headers=auth_header, query_string={"wait": 1})
+    assert response.json["status"] == "succeeded"
+    assert response.json["result"] == {"jobid": jobid}
+    assert [call[0] for call in calls] == ["mkdir", "upload"]
+    assert mock_db.jobs.find_one({"_id": ObjectId(jobid)})["state"] == "CREATED"
+
+    response = client.patch(
+        f"/api/v1/job/launch/{jobid}",
+        headers=dict(auth_header, Prefer="respond-async"),
+    )
+    assert response.status_code == 202
+    with app.app_context():
+        assert workers.run_once()
+
+    response = client.get(response.headers["Location"], headers=auth_header)
+    assert response.json["status"] == "succeeded"
+    assert response.json["result"]["f7t_job_id"] == "async-1"
+    assert mock_db.jobs.find_one({"_id": ObjectId(jobid)})["state"] == "ACTIVATED"
+
+    # operations of other users are not found
+    requests_mock.get(
+        app.config["MP_USERINFO_URL"],
+        json=dict(userinfo, email="other@test.com"),
+        status_code=200,
+    )
+    other_header = dict(auth_header, Authorization="Bearer other_token")
+    assert client.get(location, headers=other_header).status_code == 404
+
+
+def test_create_sweep(
+    app, auth_header, userinfo, job_json, mock_db, monkeypatch, requests_mock
+):
+    """A sweep is one job array submission recorded as a parent job and a
+    child job per task, the tracker polls the tasks only and the parent
+    follows them. A failed submission leaves no folder and no job."""
+    from hpc_gateway.model.database import create_user, get_active_jobs
+    from hpc_gateway.model.tracker import JobStateTracker
+
+    calls = []
+    task_states = {}
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        calls.append("mkdir")
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        calls.append("upload")
+        assert b"#SBATCH --array=0-5" in source_path
+
+    def mock_submit(cls, machine, job_script, local_file=False):
+        calls.append("submit")
+        if not task_states:
+            raise RuntimeError("sbatch failed")
+        return {"jobid": "777"}
+
+    def mock_simple_delete(cls, machine, target_path):
+        calls.append("delete")
+
+    def mock_poll(cls, machine, jobs=None, start_time=None, end_time=None):
+        return [
+            {"jobid": job, "state": task_states[job]}
+            for job in jobs
+            if job in task_states
+        ]
+
+    for name, mock in [
+        ("mkdir", mock_mkdir),
+        ("submit", mock_submit),
+        ("simple_delete", mock_simple_delete),
+        ("poll", mock_poll),
+    ]:
+        monkeypatch.setattr(f"firecrest.Firecrest.{name}", MethodType(mock, Firecrest))
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="sweep@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+    with app.app_context():
+        create_user(userinfo["email"], "sweep", "/home/sweep")
+
+    client = app.test_client()
+    sweep_json = dict(job_json, parameters={"N": [1, 2, 3], "MODE": ["x", "y"]})
+    jobs_before = mock_db.jobs.count_documents({})
+    response = client.post("/api/v1/job/sweep", json=sweep_json, headers=auth_header)
+    assert response.status_code == 600
+    assert calls == ["mkdir", "upload", "submit", "delete"]
+    assert mock_db.jobs.count_documents({}) == jobs_before
+
+    calls.clear()
+    task_states.update({f"777_{index}": "PENDING" for index in range(6)})
+    response = client.post("/api/v1/job/sweep", json=sweep_json, headers=auth_header)
+    assert response.status_code == 200
+    assert calls == ["mkdir", "upload", "submit"]
+    assert response.json["f7t_job_id"] == "777"
+    tasks = response.json["tasks"]
+    assert len(tasks) == 6
+    assert tasks[5]["parameters"] == {"N": 3, "MODE": "y"}
+
+    parent = mock_db.jobs.find_one({"_id": ObjectId(response.json["jobid"])})
+    assert parent["array_size"] == 6
+    child = mock_db.jobs.find_one({"_id": ObjectId(tasks[5]["jobid"])})
+    assert child["parent_id"] == parent["_id"]
+    assert child["f7t_job_id"] == "777_5"
+    assert child["remote_folder"] == f"{parent['remote_folder']}/task-5"
+    assert child["state"] == "ACTIVATED"
+
+    with app.app_context():
+        active = {job["_id"] for job in get_active_jobs()}
+    assert child["_id"] in active
+    assert parent["_id"] not in active
+
+    mock_db.leases.delete_many({})
+    with app.app_context():
+        tracker = JobStateTracker(app)
+        task_states.update({"777_0": "COMPLETED", "777_1": "RUNNING"})
+        tracker.run_once()
+        assert mock_db.jobs.find_one(parent["_id"])["state"] == "RUNNING"
+        task_states.update({task: "COMPLETED" for task in task_states})
+        tracker.run_once()
+        assert mock_db.jobs.find_one(parent["_id"])["state"] == "COMPLETED"
+
+    sweep_json["parameters"] = {"N": []}
+    response = client.post("/api/v1/job/sweep", json=sweep_json, headers=auth_header)
+    assert response.status_code == 400
+
+
+def test_launch_job_packed(
+    app, auth_header, userinfo, mock_db, monkeypatch, requests_mock
+):
+    """A job launched with `pack` is queued for a task farm, a queued job
+    is cancelled by leaving the queue, a packed job can not be cancelled."""
+    from hpc_gateway.model.database import create_job, create_user
+
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="pack@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+    with app.app_context():
+        user = create_user(userinfo["email"], "pack", "/home/pack")
+        job = create_job(user["_id"], "/home/pack/0", params={"image": "alpine"})
+
+    client = app.test_client()
+    url = f"/api/v1/job/launch/{job['_id']}?pack=true"
+    assert client.patch(url, headers=auth_header).status_code == 400
+
+    app.config["JOB_PACKER_ENABLED"] = True
+    response = client.patch(url, headers=auth_header)
+    assert response.status_code == 202
+    assert response.json["state"] == "QUEUED"
+    assert client.patch(url, headers=auth_header).status_code == 409
+    # never submitted directly while queued
+    url = f"/api/v1/job/launch/{job['_id']}"
+    assert client.patch(url, headers=auth_header).status_code == 409
+
+    response = client.delete(f"/api/v1/job/cancel/{job['_id']}", headers=auth_header)
+    assert response.status_code == 200
+    assert mock_db.jobs.find_one({"_id": job["_id"]})["state"] == "CANCELLED"
+
+    mock_db.jobs.update_one(
+        {"_id": job["_id"]}, {"$set": {"state": "ACTIVATED", "farm_id": ObjectId()}}
+    )
+    response = client.delete(f"/api/v1/job/cancel/{job['_id']}", headers=auth_header)
+    assert response.status_code == 409
+
+
+def test_create_job_idempotency_key(
+    app, auth_header, userinfo, job_json, mock_db, monkeypatch, requests_mock
+):
+    """A create retried with the same Idempotency-Key replays the recorded
+    response without creating a second job, the key can not be reused for
+    another request."""
+    from hpc_gateway.model.database import create_user
+
+    mkdirs = []
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        mkdirs.append(target_path)
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        return "simple_upload!"
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="idempotent@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+    with app.app_context():
+        create_user(userinfo["email"], "idempotent", "/home/idempotent")
+
+    client = app.test_client()
+    headers = dict(auth_header, **{"Idempotency-Key": "create-1"})
+    first = client.post("/api/v1/job/create", json=job_json, headers=headers)
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+
+    retry = client.post("/api/v1/job/create", json=job_json, headers=headers)
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json["jobid"] == first.json["jobid"]
+    assert len(mkdirs) == 1
+
+    other_json = dict(job_json, job_name="job01")
+    response = client.post("/api/v1/job/create", json=other_json, headers=headers)
+    assert response.status_code == 422
+    assert len(mkdirs) == 1
+
+
+def test_idempotency_key_retried_after_upstream_failure(
+    app, auth_header, userinfo, job_json, mock_db, monkeypatch, requests_mock
+):
+    """A response caused by a firecrest failure is not replayed, a retry with
+    the same key runs again, an invalid request is answered as recorded."""
+    from hpc_gateway.model.database import create_user
+
+    failures = [RuntimeError("machine unavailable")]
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        if failures:
+            raise failures.pop()
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        return "simple_upload!"
+
+    monkeypatch.setattr("firecrest.Firecrest.mkdir", MethodType(mock_mkdir, Firecrest))
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    userinfo = dict(userinfo, email="upstream@test.com")
+    requests_mock.get(app.config["MP_USERINFO_URL"], json=userinfo, status_code=200)
+    with app.app_context():
+        create_user(userinfo["email"], "upstream", "/home/upstream")
+
+    client = app.test_client()
+    headers = dict(auth_header, **{"Idempotency-Key": "create-upstream"})
+    first = client.post("/api/v1/job/create", json=job_json, headers=headers)
+    assert first.status_code == 400
+
+    retry = client.post("/api/v1/job/create", json=job_json, headers=headers)
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+
+    headers = dict(auth_header, **{"Idempotency-Key": "create-invalid"})
+    invalid_json = dict(job_json, ntasks_per_node="2")
+    response = client.post("/api/v1/job/create", json=invalid_json, headers=headers)
+    assert response.status_code == 400
+    response = client.post("/api/v1/job/create", json=invalid_json, headers=headers)
+    assert response.status_code == 400
+    assert response.headers["Idempotent-Replayed"] == "true"
+
+
+def test_idempotency_fingerprint_raw_body(app):
+    """The raw body of an upload retried with an Idempotency-Key is not read
+    to fingerprint the request, it is left to the upload."""
+    from flask import request
+
+    from hpc_gateway.api.utils import request_fingerprint
+
+    headers = {"Idempotency-Key": "upload-1"}
+    fingerprints = []
+    for body in [b"0" * 1024, b"1" * 1024, b"0" * 2048]:
+        with app.test_request_context(
+            "/api/v1/file/upload/0",
+            method="PUT",
+            data=body,
+            content_type="application/octet-stream",
+            headers=headers,
+        ):
+            fingerprints.append(request_fingerprint())
+            assert request.stream.read() == body
+
+    # identified by type and length, as the files of a multipart upload
+    assert fingerprints[0] == fingerprints[1]
+    assert fingerprints[0] != fingerprints[2]
@@ -1,3 +1,10 @@
+import json
+import time
+
+import jwt
+import pytest
+
+
 # Tests of @token_required decorator
 def test_auth_no_auth_fail(client):
     response = client.put("/api/v1/user/create")
@@ -29,3 +36,121 @@ def test_auth_invalid_userinfo_url(app):
     }
     response = client.put("/api/v1/user/create", headers=headers)
     assert "Connection error" in response.json["message"]
+
+
+def test_auth_userinfo_cached(app, requests_mock):
+    """Repeated calls with the same token only query the marketplace once."""
+    from hpc_gateway.auth import fetch_userinfo, get_token_cache, token_digest
+
+    token = "cached_token"
+    userinfo_url = app.config["MP_USERINFO_URL"]
+    requests_mock.get(userinfo_url, json={"email": "a@b.c"}, status_code=200)
+
+    with app.app_context():
+        for _ in range(3):
+            assert fetch_userinfo(token) == {"email": "a@b.c"}
+
+        assert requests_mock.call_count == 1
+        cache = get_token_cache()
+        assert cache.stats()["hits"] == 2
+        assert cache.get(token) is None
+        assert cache.get(token_digest(token)) == {"email": "a@b.c"}
+
+
+def test_auth_rejected_token_negative_cached(app, requests_mock):
+    token = "rejected_token"
+    userinfo_url = app.config["MP_USERINFO_URL"]
+    requests_mock.get(userinfo_url, status_code=401)
+
+    client = app.test_client()
+    headers = {"Authorization": f"Bearer {token}"}
+    for _ in range(2):
+        response = client.put("/api/v1/user/create", headers=headers)
+        assert response.json["message"] == "Invalid Authentication token!"
+
+    assert requests_mock.call_count == 1
+
+
+@pytest.fixture()
+def rsa_key():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture()
+def jwt_app(app, rsa_key, requests_mock):
+    """App in local JWT verification mode with the realm JWKS mocked."""
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(rsa_key.public_key()))
+    jwk.update({"kid": "key-1", "use": "sig", "alg": "RS256"})
+    requests_mock.get(app.config["MP_JWKS_URL"], json={"keys": [jwk]})
+    app.config.update({"AUTH_MODE": "jwt"})
+
+    return app
+
+
+def _encode(app, rsa_key, kid="key-1", **claims):
+    payload = {
+        "iss": app.config["MP_ISSUER"],
+        "aud": app.config["AUTH_JWT_AUDIENCE"],
+        "exp": int(time.time()) + 300,
+        "email": "a@b.c",
+        "name": "A B",
+    }
+    payload.update(claims)
+
+    return jwt.encode(payload, rsa_key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_auth_jwt_local_verification(jwt_app, rsa_key, requests_mock):
+    from hpc_gateway.auth import authenticate
+
+    with jwt_app.app_context():
+        for _ in range(3):
+            user = authenticate(_encode(jwt_app, rsa_key))
+            assert user["email"] == "a@b.c"
+
+        # JWKS fetched once, userinfo never queried
+        assert requests_mock.call_count == 1
+
+        expired = _encode(jwt_app, rsa_key, exp=int(time.time()) - 10)
+        assert authenticate(expired) is None
+
+        wrong_issuer = _encode(jwt_app, rsa_key, iss="http://evil.example.com")
+        assert authenticate(wrong_issuer) is None
+
+        wrong_audience = _encode(jwt_app, rsa_key, aud="other-service")
+        assert authenticate(wrong_audience) is None
+
+        # fail closed without a configured audience
+        jwt_app.config["AUTH_JWT_AUDIENCE"] = None
+        assert authenticate(_encode(jwt_app, rsa_key)) is None
+
+
+def test_auth_jwks_unavailable(app, rsa_key, requests_mock):
+    """A token which can not be verified for want of signing keys is
+    answered with 503, the JWKS endpoint is not queried on every request."""
+    requests_mock.get(app.config["MP_JWKS_URL"], status_code=502)
+    app.config.update({"AUTH_MODE": "jwt"})
+
+    client = app.test_client()
+    headers = {"Authorization": f"Bearer {_encode(app, rsa_key)}"}
+    for _ in range(2):
+        response = client.put("/api/v1/user/create", headers=headers)
+        assert response.status_code == 503
+        assert response.json["message"] == "Unable to verify the Authentication token."
+
+    assert requests_mock.call_count == 1
+
+
+def test_auth_jwt_fallback_to_userinfo(jwt_app, rsa_key, requests_mock):
+    from hpc_gateway.auth import authenticate
+
+    userinfo_url = jwt_app.config["MP_USERINFO_URL"]
+    requests_mock.get(userinfo_url, json={"email": "a@b.c", "name": "A B"})
+
+    with jwt_app.app_context():
+        user = authenticate(_encode(jwt_app, rsa_key, email=None))
+
+    assert user["name"] == "A B"
+    assert requests_mock.request_history[-1].url == userinfo_url
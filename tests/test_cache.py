@@ -0,0 +1,68 @@
+import threading
+
+from hpc_gateway.cache import SingleFlight, TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expire():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=2, ttl=10, timer=timer)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=1)
+
+    timer.now = 5
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # "b" is now the least recently used
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_single_flight_coalesce():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_listing():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ["job.sh"]
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flight.do("key", slow_listing))
+    )
+    leader.start()
+    started.wait(5)
+    followers = [
+        threading.Thread(target=lambda: results.append(flight.do("key", slow_listing)))
+        for _ in range(3)
+    ]
+    for thread in followers:
+        thread.start()
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert results == [["job.sh"]] * 4
+    assert len(calls) == 1
@@ -1,6 +1,8 @@
 import os
 import uuid
 
+import mongomock
+import pymongo
 import pytest
 from bson.objectid import ObjectId
 
@@ -51,6 +53,29 @@ def test_create_user_exist(monkeypatch, mock_db):
     assert user2["name"] == name
 
 
+def test_create_user_race(monkeypatch, mock_db):
+    """A user inserted concurrently (duplicated email) is returned."""
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+
+    email = "race@test.com"
+    user = database.create_user(email, "first", "/home")
+
+    users = mock_db.users
+
+    class RacingUsers:
+        def find_one_and_update(self, *args, **kwargs):
+            raise pymongo.errors.DuplicateKeyError("E11000 duplicate key")
+
+        def __getattr__(self, name):
+            return getattr(users, name)
+
+    class RacingDB:
+        users = RacingUsers()
+
+    monkeypatch.setattr("hpc_gateway.model.database.db", RacingDB())
+    assert database.create_user(email, "second", "/home") == user
+
+
 def test_create_job(monkeypatch, mock_db, remote_folder, user_id):
     monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
 
@@ -69,9 +94,10 @@ def test_update_job(monkeypatch, mock_db, remote_folder, user_id):
     job_id = job.get("_id")
 
     f7t_job_id = "00"
-    database.update_job(job_id, f7t_job_id=f7t_job_id)
+    updated_job = database.update_job(job_id, f7t_job_id=f7t_job_id)
 
     find_job = mock_db.jobs.find_one({"remote_folder": remote_folder})
+    assert updated_job == find_job
     assert find_job["state"] == "ACTIVATED"
     assert find_job["remote_folder"] == remote_folder
     assert find_job["f7t_job_id"] == f7t_job_id
@@ -90,10 +116,134 @@ def test_delete_job(monkeypatch, mock_db, remote_folder, user_id):
     assert count_before_delete - count_after_delete == 1
 
 
-def test_get_jobs(monkeypatch, mock_db, remote_folder, user_id):
+def test_mongo_client_reused_across_requests(app, monkeypatch):
+    """The same MongoClient serves every request context of a worker
+    process and a fresh one is built after a fork."""
+    mongo = app.extensions["mongo"]
+
+    with app.test_request_context():
+        client = mongo.client
+        assert database.db.name == "hpcdb"
+
+    with app.test_request_context():
+        assert mongo.client is client
+
+    monkeypatch.setattr("os.getpid", lambda: -1)
+    with app.test_request_context():
+        assert mongo.client is not client
+
+
+def test_ensure_indexes():
+    """Indexes are created once, the unique email closes duplicated users."""
+    db = mongomock.MongoClient().db
+    database.ensure_indexes(db)
+    database.ensure_indexes(db)
+
+    assert db.users.index_information()["email_1"]["unique"]
+    assert "user_id_1_created_at_-1" in db.jobs.index_information()
+    assert "user_id_1_state_1" in db.jobs.index_information()
+
+    db.users.insert_one({"email": "a@b.c"})
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        db.users.insert_one({"email": "a@b.c"})
+
+
+@pytest.mark.skipif(
+    "MONGO_TEST_URI" not in os.environ,
+    reason="explain needs a MongoDB server, set MONGO_TEST_URI",
+)
+def test_hot_queries_use_index(user_id):
+    """The user lookup and the job listing do not scan the collections."""
+    client = pymongo.MongoClient(os.environ["MONGO_TEST_URI"])
+    db = client.get_default_database(default="hpcdb_test")
+    try:
+        database.ensure_indexes(db)
+        db.users.insert_one({"email": "explain@test.com"})
+        db.jobs.insert_many(
+            [{"user_id": user_id, "state": "CREATED"} for _ in range(10)]
+        )
+
+        def stages(plan):
+            yield plan["stage"]
+            for child in plan.get("inputStages", [plan.get("inputStage")]):
+                if child:
+                    yield from stages(child)
+
+        for cursor in (
+            db.users.find({"email": "explain@test.com"}),
+            db.jobs.find({"user_id": user_id}),
+            db.jobs.find({"user_id": user_id, "state": "CREATED"}),
+        ):
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            plan = plan.get("queryPlan", plan)
+            assert "IXSCAN" in set(stages(plan))
+            assert "COLLSCAN" not in set(stages(plan))
+    finally:
+        client.drop_database(db.name)
+        client.close()
+
+
+def test_idempotent_request_taken_over(monkeypatch, mock_db):
+    """A request which outlived the lock of its key neither records its
+    response nor releases the key of the request which took it over."""
     monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    key = f"test@test.com:{uuid.uuid4()}"
+
+    assert database.begin_idempotent_request(key, "f", "first", 60, -1) is None
+    # the lock expired right away, a retry takes the key over
+    assert database.begin_idempotent_request(key, "f", "retry", 60, 60) is None
+
+    database.complete_idempotent_request(key, "first", {"status": 200})
+    database.release_idempotent_request(key, "first")
+    record = mock_db.idempotency_keys.find_one({"_id": key})
+    assert record["owner"] == "retry"
+    assert record["status"] == "in_progress"
+
+    database.complete_idempotent_request(key, "retry", {"status": 201})
+    record = mock_db.idempotency_keys.find_one({"_id": key})
+    assert record["response"] == {"status": 201}
 
-    database.create_job(user_id, remote_folder)
-    database.create_job(user_id, remote_folder)
 
-    database.get_jobs(user_id)
+def test_watch_job_transitions_matches_inserts(monkeypatch, mock_db, user_id):
+    """The change stream reports the state changes and the jobs inserted
+    with a state, as the polled transitions do."""
+    pipelines = []
+
+    def mock_watch(pipeline, **kwargs):
+        pipelines.append(pipeline)
+
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    monkeypatch.setattr(mock_db.jobs, "watch", mock_watch, raising=False)
+    database.watch_job_transitions(user_id)
+
+    job = {"user_id": user_id, "state": "ACTIVATED", "state_updated_at": 1}
+    changes = mongomock.MongoClient().db.changes
+    changes.insert_many(
+        [
+            {"_id": 0, "operationType": "insert", "fullDocument": job},
+            {
+                "_id": 1,
+                "operationType": "insert",
+                "fullDocument": dict(job, state="CREATED", state_updated_at=None),
+            },
+            {
+                "_id": 2,
+                "operationType": "update",
+                "fullDocument": job,
+                "updateDescription": {"updatedFields": {"state": "RUNNING"}},
+            },
+            {
+                "_id": 3,
+                "operationType": "update",
+                "fullDocument": job,
+                "updateDescription": {"updatedFields": {"machine": "daint"}},
+            },
+            {
+                "_id": 4,
+                "operationType": "insert",
+                "fullDocument": dict(job, user_id=ObjectId()),
+            },
+        ]
+    )
+    match = pipelines[0][0]["$match"]
+    assert [change["_id"] for change in changes.find(match)] == [0, 2]
@@ -1,3 +1,8 @@
+import io
+import time
+
+import pytest
+from firecrest.FirecrestException import FirecrestException
 from flask import current_app
 
 from hpc_gateway.model.f7t import create_f7t_client
@@ -23,3 +28,282 @@ def test_f7t_list_home(app):
         )
 
         assert file_list is not None
+
+
+def test_f7t_client_reused(app, requests_mock, monkeypatch):
+    """One client per deployment and credentials, the access token is
+    requested once and shared."""
+    from hpc_gateway.model import f7t
+
+    monkeypatch.setenv("DEPLOYMENT", "MC")
+    monkeypatch.setattr(f7t, "_clients", {})
+    app.config.update({"F7T_CLIENT_ID": "client", "F7T_CLIENT_SECRET": "secret"})
+    requests_mock.post(
+        app.config["F7T_TOKEN_URL"],
+        json={"access_token": "token", "expires_in": 300},
+    )
+
+    with app.app_context():
+        f7t_client = create_f7t_client()
+        assert create_f7t_client() is f7t_client
+
+        for _ in range(3):
+            assert f7t_client._authorization.get_access_token() == "token"
+
+        assert requests_mock.call_count == 1
+
+        app.config.update({"F7T_CLIENT_SECRET": "other"})
+        assert create_f7t_client() is not f7t_client
+
+
+def test_f7t_token_refreshed_ahead_of_expiry(requests_mock):
+    from hpc_gateway.model.f7t import CachedClientCredentialsAuth
+
+    token_url = "https://auth.example.com/token"
+    requests_mock.post(
+        token_url,
+        [
+            {"json": {"access_token": "first", "expires_in": 60}},
+            {"json": {"access_token": "second", "expires_in": 300}},
+        ],
+    )
+    auth = CachedClientCredentialsAuth(
+        "client", "secret", token_url, min_token_validity=10, refresh_ahead=120
+    )
+
+    assert auth.get_access_token() == "first"
+    # still valid, the refresh runs in background
+    assert auth.get_access_token() == "first"
+    for _ in range(500):
+        if auth._access_token == "second":
+            break
+        time.sleep(0.01)
+
+    assert auth.get_access_token() == "second"
+    assert requests_mock.call_count == 2
+
+
+def test_f7t_token_request_rejected(requests_mock):
+    from firecrest.FirecrestException import UnauthorizedException
+
+    from hpc_gateway.model.f7t import CachedClientCredentialsAuth
+
+    token_url = "https://auth.example.com/token"
+    requests_mock.post(token_url, text="<html>Bad Gateway</html>", status_code=502)
+    auth = CachedClientCredentialsAuth("client", "secret", token_url)
+
+    with pytest.raises(UnauthorizedException):
+        auth.get_access_token()
+
+
+def test_pooled_requests_resized():
+    from hpc_gateway.model.f7t import PooledRequests
+
+    pooled_requests = PooledRequests(pool_maxsize=2)
+    session = pooled_requests.session
+    pooled_requests.pool_maxsize = 8
+
+    assert pooled_requests.session is session
+    assert session.get_adapter("https://firecrest.cscs.ch")._pool_maxsize == 8
+
+
+def test_simple_upload_streams_multipart(requests_mock):
+    """The multipart body is a stream parsable as a regular form upload."""
+    from werkzeug.formparser import parse_form_data
+
+    from hpc_gateway.model.f7t import Firecrest, HardCodeTokenAuth
+
+    url = "https://firecrest.example.com"
+    requests_mock.post(f"{url}/utilities/upload", status_code=201, json={})
+    content = b"0123456789" * 10000
+
+    client = Firecrest(firecrest_url=url, authorization=HardCodeTokenAuth("token"))
+    client.simple_upload(
+        machine="daint",
+        source_path=io.BytesIO(content),
+        target_path="/scratch/job",
+        filename="in.dat",
+    )
+
+    request = requests_mock.last_request
+    body = request.body
+    assert int(request.headers["Content-Length"]) == len(body)
+
+    data = body.read()
+    assert len(data) == len(body)
+    environ = {
+        "wsgi.input": io.BytesIO(data),
+        "CONTENT_LENGTH": str(len(data)),
+        "CONTENT_TYPE": request.headers["Content-Type"],
+        "REQUEST_METHOD": "POST",
+    }
+    _, form, files = parse_form_data(environ)
+    assert form["targetPath"] == "/scratch/job"
+    assert files["file"].filename == "in.dat"
+    assert files["file"].read() == content
+
+
+def test_multipart_stream_escapes_filename():
+    """A quote or a line break in the file name can not end the header or
+    inject a part."""
+    from werkzeug.formparser import parse_form_data
+
+    from hpc_gateway.model.f7t import MultipartStream
+
+    filename = 'in"; name="targetPath"\r\n\r\n/etc\r\n.dat'
+    body = MultipartStream(
+        {"targetPath": "/scratch/job"}, "file", filename, io.BytesIO(b"data")
+    )
+    data = body.read()
+    assert len(data) == len(body)
+    environ = {
+        "wsgi.input": io.BytesIO(data),
+        "CONTENT_LENGTH": str(len(data)),
+        "CONTENT_TYPE": body.content_type,
+        "REQUEST_METHOD": "POST",
+    }
+    _, form, files = parse_form_data(environ)
+    assert form.getlist("targetPath") == ["/scratch/job"]
+    assert list(files) == ["file"]
+    escaped = "in%22; name=%22targetPath%22%0D%0A%0D%0A/etc%0D%0A.dat"
+    assert files["file"].filename == escaped
+    assert files["file"].read() == b"data"
+
+
+def _resilient_client(**policy):
+    from hpc_gateway.model.f7t import Firecrest, HardCodeTokenAuth
+    from hpc_gateway.model.resilience import ResiliencePolicy
+
+    return Firecrest(
+        firecrest_url="https://firecrest.example.com",
+        authorization=HardCodeTokenAuth("token"),
+        policy=ResiliencePolicy(backoff_base=0, **policy),
+    )
+
+
+def test_f7t_retry_idempotent_operations(requests_mock):
+    """Idempotent operations are retried on transient errors, the others not,
+    every request carries the timeout of its operation."""
+    client = _resilient_client(retries=2, timeouts={"list_files": 7})
+    ls = requests_mock.get(
+        "https://firecrest.example.com/utilities/ls",
+        [
+            {"status_code": 503, "json": {}},
+            {"status_code": 200, "json": {"output": []}},
+        ],
+    )
+    mkdir = requests_mock.post(
+        "https://firecrest.example.com/utilities/mkdir",
+        status_code=503,
+        json={},
+    )
+
+    assert client.list_files(machine="retry", target_path="/scratch") == []
+    assert ls.call_count == 2
+    assert ls.last_request.timeout == 7
+
+    with pytest.raises(FirecrestException):
+        client.mkdir(machine="retry", target_path="/scratch/job")
+    assert mkdir.call_count == 1
+
+
+def test_f7t_circuit_breaker(requests_mock):
+    """The breaker opens after consecutive transient errors, rejects calls
+    without reaching firecrest and closes after a successful trial call."""
+    from hpc_gateway.model.resilience import CircuitOpenError, breaker_stats
+
+    client = _resilient_client(retries=0, failure_threshold=2, reset_timeout=0.2)
+    ls = requests_mock.get(
+        "https://firecrest.example.com/utilities/ls", status_code=500, json={}
+    )
+
+    for _ in range(2):
+        with pytest.raises(Exception):
+            client.list_files(machine="breaker", target_path="/scratch")
+    with pytest.raises(CircuitOpenError):
+        client.list_files(machine="breaker", target_path="/scratch")
+    assert ls.call_count == 2
+    assert breaker_stats()["breaker"]["state"] == "open"
+    assert breaker_stats()["breaker"]["rejected"] == 1
+
+    time.sleep(0.2)
+    requests_mock.get("https://firecrest.example.com/utilities/ls", json={"output": []})
+    assert client.list_files(machine="breaker", target_path="/scratch") == []
+    assert breaker_stats()["breaker"]["state"] == "closed"
+
+    # errors of the request itself do not open the circuit
+    requests_mock.get(
+        "https://firecrest.example.com/utilities/ls", status_code=400, json={}
+    )
+    for _ in range(3):
+        with pytest.raises(Exception):
+            client.list_files(machine="breaker", target_path="/scratch")
+    assert breaker_stats()["breaker"]["state"] == "closed"
+
+
+def test_f7t_bulkhead():
+    """Calls beyond the limit of a machine wait in a bounded queue, the ones
+    which do not fit are rejected without being attempted."""
+    import threading
+
+    from hpc_gateway.model import resilience
+
+    policy = resilience.ResiliencePolicy(
+        bulkhead_limits={"listing": 1}, bulkhead_max_queue=1, bulkhead_max_wait=5
+    )
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_listing():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+
+    def list_files():
+        resilience.call("bulkhead", "list_files", slow_listing, policy)
+
+    first = threading.Thread(target=list_files)
+    first.start()
+    started.wait(5)
+    queued = threading.Thread(target=list_files)
+    queued.start()
+    while resilience.bulkhead_stats()["bulkhead:listing"]["waiting"] == 0:
+        time.sleep(0.01)
+
+    with pytest.raises(resilience.BulkheadFullError):
+        list_files()
+    # other operation classes are not affected
+    assert resilience.call("bulkhead", "submit", lambda: "submitted", policy)
+
+    release.set()
+    first.join()
+    queued.join()
+    stats = resilience.bulkhead_stats()["bulkhead:listing"]
+    assert len(calls) == 2
+    assert stats["rejected"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_f7t_bulkhead_held_by_streamed_download():
+    """The slot of a streamed download is held until its response is
+    closed, not only while the headers are received."""
+    from hpc_gateway.model import resilience
+
+    class MockResponse:
+        closed = 0
+
+        def close(self):
+            self.closed += 1
+
+    policy = resilience.ResiliencePolicy(
+        bulkhead_limits={"transfer": 1}, bulkhead_max_queue=0, bulkhead_max_wait=0
+    )
+    response = resilience.call("streamed", "stream_download", MockResponse, policy)
+    with pytest.raises(resilience.BulkheadFullError):
+        resilience.call("streamed", "stream_download", MockResponse, policy)
+
+    response.close()
+    response.close()
+    assert response.closed == 2
+    assert resilience.bulkhead_stats()["streamed:transfer"]["in_flight"] == 0
+    resilience.call("streamed", "stream_download", MockResponse, policy).close()
@@ -0,0 +1,65 @@
+import os
+import time
+
+from hpc_gateway.model.file_cache import FileCache
+
+
+def test_file_cache_put_get(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1000)
+    key = FileCache.key("job", "/scratch/job/out", 4, 1670000000)
+
+    assert cache.get(key) is None
+    with cache.put(key, [b"ab", b"cd"]) as fh:
+        assert fh.read() == b"abcd"
+
+    with cache.get(key) as fh:
+        assert fh.read() == b"abcd"
+    # a new version of the remote file is a different entry
+    assert FileCache.key("job", "/scratch/job/out", 4, 1670000001) != key
+
+
+def test_file_cache_lru_eviction(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=250)
+    old = time.time() - 100
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, [b"x" * 100]).close()
+        os.utime(tmp_path / key, (old + i, old + i))
+
+    # "a" is used again, "b" is now the least recently used entry
+    cache.get("a").close()
+    cache.put("c", [b"x" * 100]).close()
+
+    assert sorted(os.listdir(tmp_path)) == ["a", "c"]
+
+
+def test_file_cache_keeps_new_entry(tmp_path):
+    """The entry just written is never evicted, an entry larger than the
+    whole budget is only handed out."""
+    cache = FileCache(str(tmp_path), max_bytes=250)
+    cache.put("a", [b"x" * 100]).close()
+    os.utime(tmp_path / "a", (time.time() + 100, time.time() + 100))
+
+    # "b" is older than "a" on a coarse clock, "a" is evicted
+    with cache.put("b", [b"y" * 200]) as fh:
+        assert fh.read() == b"y" * 200
+    assert os.listdir(tmp_path) == ["b"]
+
+    with cache.put("c", [b"z" * 300]) as fh:
+        assert fh.read() == b"z" * 300
+    assert os.listdir(tmp_path) == ["b"]
+
+
+def test_file_cache_failed_write_leaves_nothing(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1000)
+
+    def broken_download():
+        yield b"partial"
+        raise ConnectionError("lost connection")
+
+    try:
+        cache.put("key", broken_download())
+    except ConnectionError:
+        pass
+
+    assert cache.get("key") is None
+    assert os.listdir(tmp_path) == []
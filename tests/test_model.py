@@ -1,4 +1,6 @@
-from hpc_gateway.model.job import create_job_script
+import pytest
+
+from hpc_gateway.model.job import TemplateRegistry, create_job_script, expand_sweep
 
 
 def test_create_cscs_job_script():
@@ -12,3 +14,99 @@ def test_create_cscs_job_script():
     )
 
     assert "docker://alpine:latest" in got
+
+
+def test_create_sweep_job_script():
+    tasks = expand_sweep({"TEMPERATURE": [300, 400], "LABEL": ["a b", "c"]})
+    assert tasks[1] == {"TEMPERATURE": 300, "LABEL": "c"}
+
+    got = create_job_script(
+        job_name="sweep00",
+        image="docker://alpine:latest",
+        email="a@b.c",
+        partition="debug",
+        ntasks_per_node=2,
+        executable_cmd="run $TEMPERATURE",
+        sweep_tasks=tasks,
+    )
+
+    assert "#SBATCH --array=0-3" in got
+    assert "TEMPERATURE_VALUES=(300 300 400 400)" in got
+    assert "LABEL_VALUES=('a b' c 'a b' c)" in got
+    assert 'cd "task-$SLURM_ARRAY_TASK_ID"' in got
+
+    with pytest.raises(ValueError):
+        expand_sweep({"NOT-A-NAME": [1]})
+    with pytest.raises(ValueError):
+        expand_sweep({"A": [1, 2], "B": [1, 2]}, max_tasks=3)
+
+
+def test_template_registry(tmp_path):
+    """The templates are compiled once with a bytecode cache and selected
+    per machine and partition, unknown parameters are rejected."""
+    from hpc_gateway.config import Config
+
+    cache_dir = tmp_path / "cache"
+    selection = {
+        "job": {
+            "cluster": "slurm_job_script.j2",
+            "daint:debug": "slurm_job_script.j2",
+            "*": "cscs_job_script.j2",
+        }
+    }
+    registry = TemplateRegistry(Config.JOB_TEMPLATES_DIR, selection, str(cache_dir))
+    assert "cscs_job_script.j2" in registry.templates
+    assert "executable_cmd" in registry.variables["cscs_job_script.j2"]
+    assert list(cache_dir.iterdir())
+
+    assert registry.select("job", "cluster", "normal") == "slurm_job_script.j2"
+    assert registry.select("job", "daint", "debug") == "slurm_job_script.j2"
+    assert registry.select("job", "daint", "normal") == "cscs_job_script.j2"
+
+    with pytest.raises(ValueError):
+        registry.render("cscs_job_script.j2", options={"walltime": "01:00:00"})
+
+
+def test_create_job_script_validates_parameters():
+    params = dict(
+        job_name="job00",
+        image="docker://alpine:latest",
+        email="a@b.c",
+        partition="debug",
+        executable_cmd="bash -n",
+    )
+    with pytest.raises(ValueError):
+        create_job_script(ntasks_per_node="2", **params)
+    with pytest.raises(ValueError):
+        create_job_script(ntasks_per_node=2, account="other", **params)
+
+
+def test_farm_templates_per_site():
+    """The IWM farms are rendered without the CSCS account and modules."""
+    from hpc_gateway.config import Config, TestingIWMConfig
+
+    jobs = [
+        {
+            "jobid": "0",
+            "remote_folder": "/scratch/0",
+            "ntasks_per_node": 2,
+            "executable_cmd": "run",
+        }
+    ]
+    params = dict(
+        job_name="farm-0",
+        image="docker://alpine:latest",
+        ntasks_per_node=2,
+        time_limit="01:00:00",
+        jobs=jobs,
+        states_file="farm_states",
+        output_file="out",
+    )
+    for config, cscs in [(Config, True), (TestingIWMConfig, False)]:
+        registry = TemplateRegistry(Config.JOB_TEMPLATES_DIR, config.JOB_TEMPLATES)
+        got = registry.render(
+            registry.select("farm", "cluster", "debug"), partition="debug", **params
+        )
+        assert "srun --exclusive -N 1 -n 2" in got
+        assert ('--account="mrcloud"' in got) is cscs
+        assert ("module load" in got) is cscs
@@ -0,0 +1,133 @@
+from datetime import timedelta
+
+from bson.objectid import ObjectId
+
+from hpc_gateway.model import database
+from hpc_gateway.model.operations import (
+    CREATE_JOB,
+    LAUNCH_JOB,
+    OPERATION_HANDLERS,
+    run_operation,
+)
+from hpc_gateway.model.resilience import CircuitOpenError
+
+
+def _queue(kind, job_id=None, **params):
+    return database.create_operation(kind, "ops@test.com", params, job_id=job_id)
+
+
+def test_operation_retried_and_reclaimed(app, mock_db, monkeypatch):
+    """A rejected attempt is retried later, an operation whose worker died
+    is claimed again once its lease expired, then fails for good."""
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    mock_db.operations.delete_many({})
+    attempts = []
+
+    def rejected(operation):
+        attempts.append(operation["attempts"])
+        raise CircuitOpenError("daint", 5)
+
+    monkeypatch.setitem(OPERATION_HANDLERS, LAUNCH_JOB, rejected)
+
+    with app.app_context():
+        operation = _queue(LAUNCH_JOB, job_id=ObjectId(), machine="daint")
+        claimed = database.claim_operation("worker-a", ttl=60)
+        assert claimed["_id"] == operation["_id"]
+        assert run_operation(claimed, "worker-a") == database.PENDING
+
+        # not due before its retry time
+        assert database.claim_operation("worker-a", ttl=60) is None
+        record = database.get_operation(operation["_id"])
+        assert record["attempts"] == 1
+        assert record["error"].startswith("CircuitOpenError")
+
+        # the worker taking it dies, its lease expires
+        mock_db.operations.update_one(
+            {"_id": operation["_id"]},
+            {"$set": {"not_before": record["created_at"]}},
+        )
+        assert database.claim_operation("worker-b", ttl=60)["attempts"] == 2
+        mock_db.operations.update_one(
+            {"_id": operation["_id"]},
+            {"$set": {"lease_expires_at": record["created_at"] - timedelta(seconds=1)}},
+        )
+        claimed = database.claim_operation("worker-c", ttl=60)
+        assert claimed["attempts"] == 3
+        # the outcome of the lost worker is ignored
+        assert not database.finish_operation(
+            operation["_id"], "worker-b", database.SUCCEEDED
+        )
+
+        assert run_operation(claimed, "worker-c") == database.FAILED
+        assert database.get_operation(operation["_id"])["status"] == "failed"
+        assert attempts == [1, 3]
+
+
+def test_create_operation_is_repeatable(app, mock_db, monkeypatch):
+    """A repeated create attempt records no second job."""
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    monkeypatch.setattr(
+        "hpc_gateway.model.operations.upload_job_script", lambda *args: None
+    )
+    monkeypatch.setattr("hpc_gateway.model.operations.create_f7t_client", lambda: None)
+
+    with app.app_context():
+        job_id = ObjectId()
+        operation = _queue(
+            CREATE_JOB,
+            job_id=job_id,
+            user_id=ObjectId(),
+            machine="daint",
+            remote_folder="/scratch/ops",
+            job_script="#!/bin/bash",
+        )
+        for owner in ("worker-a", "worker-b"):
+            mock_db.operations.update_one(
+                {"_id": operation["_id"]},
+                {"$set": {"status": database.RUNNING, "owner": owner}},
+            )
+            claimed = dict(operation, attempts=1)
+            assert run_operation(claimed, owner) == database.SUCCEEDED
+
+        assert mock_db.jobs.count_documents({"_id": job_id}) == 1
+
+
+def test_launch_never_submits_twice(app, mock_db, monkeypatch):
+    """A launch attempt whose submission may have happened (the worker died
+    or timed out while submitting) is not submitted again, a rejected one
+    is retried."""
+    import requests
+
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    monkeypatch.setattr("hpc_gateway.model.operations.create_f7t_client", lambda: None)
+    submits = []
+
+    def submit_job_script(f7t_client, machine, remote_folder):
+        submits.append(remote_folder)
+        if len(submits) == 1:
+            raise CircuitOpenError(machine, 5)
+        raise requests.Timeout("no answer")
+
+    monkeypatch.setattr(
+        "hpc_gateway.model.operations.submit_job_script", submit_job_script
+    )
+
+    with app.app_context():
+        job = database.create_job(ObjectId(), "/scratch/launch")
+        operation = _queue(LAUNCH_JOB, job_id=job["_id"], machine="daint")
+        for attempts, status in [
+            (1, database.PENDING),
+            (2, database.FAILED),
+            (3, database.FAILED),
+        ]:
+            mock_db.operations.update_one(
+                {"_id": operation["_id"]},
+                {"$set": {"status": database.RUNNING, "owner": "worker"}},
+            )
+            claimed = dict(operation, attempts=attempts)
+            assert run_operation(claimed, "worker") == status
+
+        # the reclaimed attempt did not submit
+        assert len(submits) == 2
+        record = database.get_operation(operation["_id"])
+        assert record["error"].startswith("SubmissionUnknownError")
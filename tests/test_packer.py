@@ -0,0 +1,187 @@
+from types import MethodType
+
+from bson.objectid import ObjectId
+from firecrest import Firecrest
+from pymongo.errors import PyMongoError
+
+from hpc_gateway.model import database, packer
+from hpc_gateway.model.packer import JobPacker
+
+
+def test_packer_runs_jobs_in_farm(app, mock_db, monkeypatch):
+    """Queued jobs of an image and partition are launched in one farm, the
+    state of every job is read back from the states file of the farm."""
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    app.config.update({"JOB_PACKER_MAX_JOBS": 3, "JOB_PACKER_MAX_WAIT": 3600})
+    uploads, submits = [], []
+    farm_state = {"state": "PENDING", "content": ""}
+
+    def mock_mkdir(cls, machine, target_path, p=None):
+        pass
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        uploads.append(source_path.decode())
+
+    def mock_submit(cls, machine, job_script, local_file=False):
+        submits.append(job_script)
+        return {"jobid": "farm-1"}
+
+    def mock_poll(cls, machine, jobs=None, start_time=None, end_time=None):
+        return [{"jobid": job, "state": farm_state["state"]} for job in jobs]
+
+    def mock_view(cls, machine, target_path):
+        return farm_state["content"]
+
+    for name, mock in [
+        ("mkdir", mock_mkdir),
+        ("submit", mock_submit),
+        ("poll", mock_poll),
+        ("view", mock_view),
+    ]:
+        monkeypatch.setattr(f"firecrest.Firecrest.{name}", MethodType(mock, Firecrest))
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+    mock_db.leases.delete_many({})
+    mock_db.farms.delete_many({})
+
+    with app.app_context():
+        user_id = ObjectId()
+        jobs = []
+        for index, image in enumerate(["alpine", "alpine", "alpine", "ubuntu"]):
+            params = {
+                "image": image,
+                "partition": "debug",
+                "ntasks_per_node": 2,
+                "executable_cmd": f"run {index} > out",
+            }
+            job = database.create_job(user_id, f"/scratch/farm/{index}", params=params)
+            assert database.queue_job(job["_id"], "packed")["state"] == "QUEUED"
+            jobs.append(job["_id"])
+
+        packer = JobPacker(app)
+        # the full group is launched, the single ubuntu job waits
+        assert packer.run_once() == 1
+        assert len(submits) == 1
+        farm_script = uploads[-1]
+        assert farm_script.count("srun --exclusive") == 3
+        assert "cd /scratch/farm/0 ||" in farm_script
+        assert "alpine run 0 > out ;" in farm_script
+        assert database.get_job(jobs[0])["state"] == "ACTIVATED"
+        assert database.get_job(jobs[3])["state"] == "QUEUED"
+
+        farm_state.update(
+            state="RUNNING",
+            content=f"{jobs[0]} RUNNING\n{jobs[1]} RUNNING\n{jobs[0]} COMPLETED\n",
+        )
+        packer.run_once()
+        assert database.get_job(jobs[0])["state"] == "COMPLETED"
+        assert database.get_job(jobs[1])["state"] == "RUNNING"
+        assert database.get_job(jobs[2])["state"] == "ACTIVATED"
+
+        # the jobs without a final state in a finished farm failed
+        farm_state["state"] = "COMPLETED"
+        packer.run_once()
+        assert database.get_job(jobs[1])["state"] == "FAILED"
+        assert database.get_job(jobs[2])["state"] == "FAILED"
+        assert mock_db.farms.count_documents({"collected": False}) == 0
+
+
+def _mock_farm_submission(monkeypatch, uploads, submits):
+    def mock_mkdir(cls, machine, target_path, p=None):
+        pass
+
+    def mock_simple_upload(cls, machine, source_path, target_path, filename):
+        uploads.append(source_path.decode())
+
+    def mock_submit(cls, machine, job_script, local_file=False):
+        submits.append(job_script)
+        return {"jobid": f"farm-{len(submits)}"}
+
+    def mock_poll(cls, machine, jobs=None, start_time=None, end_time=None):
+        return [{"jobid": job, "state": "PENDING"} for job in jobs]
+
+    for name, mock in [
+        ("mkdir", mock_mkdir),
+        ("submit", mock_submit),
+        ("poll", mock_poll),
+    ]:
+        monkeypatch.setattr(f"firecrest.Firecrest.{name}", MethodType(mock, Firecrest))
+    monkeypatch.setattr(
+        "hpc_gateway.model.f7t.Firecrest.simple_upload",
+        MethodType(mock_simple_upload, Firecrest),
+    )
+
+
+def _queue_jobs(count):
+    jobs = []
+    for index in range(count):
+        params = {
+            "image": "alpine",
+            "partition": "debug",
+            "ntasks_per_node": 2,
+            "executable_cmd": f"run {index} > out",
+        }
+        job = database.create_job(ObjectId(), f"/scratch/race/{index}", params=params)
+        database.queue_job(job["_id"], "packed")
+        jobs.append(job["_id"])
+
+    return jobs
+
+
+def test_packer_skips_job_cancelled_while_packing(app, mock_db, monkeypatch):
+    """A job cancelled after the queued jobs were listed is not packed."""
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    app.config.update({"JOB_PACKER_MAX_JOBS": 3, "JOB_PACKER_MAX_WAIT": 3600})
+    uploads, submits = [], []
+    _mock_farm_submission(monkeypatch, uploads, submits)
+    mock_db.leases.delete_many({})
+    mock_db.farms.delete_many({})
+    mock_db.jobs.delete_many({})
+
+    with app.app_context():
+        jobs = _queue_jobs(3)
+
+        def get_queued_jobs():
+            queued = list(database.get_queued_jobs())
+            database.set_job_states([(jobs[1], "QUEUED", "CANCELLED")])
+            return queued
+
+        monkeypatch.setattr(packer, "get_queued_jobs", get_queued_jobs)
+        assert packer.JobPacker(app).run_once() == 1
+        assert uploads[-1].count("srun --exclusive") == 2
+        assert str(jobs[1]) not in uploads[-1]
+        assert database.get_job(jobs[1])["state"] == "CANCELLED"
+        assert database.get_job(jobs[0])["state"] == "ACTIVATED"
+        farm = mock_db.farms.find_one()
+        assert farm["job_ids"] == [jobs[0], jobs[2]]
+        assert farm["f7t_job_id"] == "farm-1"
+
+
+def test_packer_never_resubmits_farm(app, mock_db, monkeypatch):
+    """A farm whose submission is not recorded is not submitted again."""
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    app.config.update({"JOB_PACKER_MAX_JOBS": 2, "JOB_PACKER_MAX_WAIT": 3600})
+    uploads, submits = [], []
+    _mock_farm_submission(monkeypatch, uploads, submits)
+    mock_db.leases.delete_many({})
+    mock_db.farms.delete_many({})
+    mock_db.jobs.delete_many({})
+
+    failures = [PyMongoError("connection lost")]
+
+    def activate_farm(farm_id, f7t_job_id):
+        if failures:
+            raise failures.pop()
+        database.activate_farm(farm_id, f7t_job_id)
+
+    monkeypatch.setattr(packer, "activate_farm", activate_farm)
+
+    with app.app_context():
+        jobs = _queue_jobs(2)
+        job_packer = packer.JobPacker(app)
+        assert job_packer.run_once() == 0
+        assert job_packer.run_once() == 0
+        assert len(submits) == 1
+        assert database.get_job(jobs[0])["state"] == "PACKING"
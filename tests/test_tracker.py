@@ -0,0 +1,57 @@
+from types import MethodType
+
+from bson.objectid import ObjectId
+from firecrest import Firecrest
+
+from hpc_gateway.model import database
+from hpc_gateway.model.tracker import JobStateTracker
+
+
+def test_tracker_batches_polling(app, mock_db, monkeypatch):
+    """The active jobs are polled in one call per batch and machine, the
+    transitions are recorded with their time, terminal jobs are left out."""
+    monkeypatch.setattr("hpc_gateway.model.database.db", mock_db)
+    app.config.update({"JOB_TRACKER_BATCH_SIZE": 2})
+    polls = []
+
+    def mock_poll(cls, machine, jobs=None, start_time=None, end_time=None):
+        polls.append((machine, list(jobs)))
+        states = {"t1": "RUNNING", "t2": "COMPLETED", "t3": "CANCELLED by 42"}
+        return [{"jobid": job, "state": states.get(job, "PENDING")} for job in jobs]
+
+    monkeypatch.setattr("firecrest.Firecrest.poll", MethodType(mock_poll, Firecrest))
+    mock_db.jobs.delete_many({})
+    mock_db.leases.delete_many({})
+
+    with app.app_context():
+        user_id = ObjectId()
+        jobs = {}
+        for f7t_job_id in ("t1", "t2", "t3"):
+            job = database.create_job(user_id, f"/scratch/{f7t_job_id}")
+            database.update_job(job["_id"], f7t_job_id, machine="tracked")
+            jobs[f7t_job_id] = job["_id"]
+
+        tracker = JobStateTracker(app)
+        assert tracker.run_once() == 3
+
+        tracked_polls = [poll for poll in polls if poll[0] == "tracked"]
+        assert len(tracked_polls) == 2
+        polled = sorted(sum((jobs for _, jobs in tracked_polls), []))
+        assert polled == ["t1", "t2", "t3"]
+
+        job = database.get_job(jobs["t3"])
+        assert job["state"] == "CANCELLED"
+        history = [transition["state"] for transition in job["state_history"]]
+        assert history == ["ACTIVATED", "CANCELLED"]
+        assert job["state_updated_at"] == job["state_history"][-1]["at"]
+
+        # only the running job is polled again
+        polls.clear()
+        assert tracker.run_once() == 0
+        assert ("tracked", ["t1"]) in polls
+        assert len([poll for poll in polls if poll[0] == "tracked"]) == 1
+
+        # another worker does not poll while the lease is held
+        polls.clear()
+        assert JobStateTracker(app).run_once() == 0
+        assert polls == []